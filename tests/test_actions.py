@@ -0,0 +1,613 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import testtools
+import threading
+from mock import Mock, patch
+from zoidberg import actions
+from zoidberg import cache
+from zoidberg import exceptions
+from zoidberg import gitcache
+from zoidberg import gitexec
+from zoidberg import parser
+from zoidberg import retry
+
+
+def git(*args, **kwargs):
+    subprocess.check_call(
+        ('git',) + args, stdout=open(os.devnull, 'w'),
+        stderr=subprocess.STDOUT, **kwargs)
+
+
+def rev_parse(repo, ref):
+    return subprocess.check_output(
+        ['git', 'rev-parse', ref], cwd=repo).strip()
+
+
+class GitActionTestCase(testtools.TestCase):
+    """
+    Runs the git actions against real repos on disk, standing in for
+    the source and target gerrits.
+    """
+    def setUp(self):
+        super(GitActionTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.repos = {}
+        for name in ('source', 'target'):
+            self.repos[name] = os.path.join(self.tmp, name, 'stuff.git')
+            git('init', '--bare', '--quiet', self.repos[name])
+
+        # put a commit on master in the source
+        work = os.path.join(self.tmp, 'work')
+        git('clone', '--quiet', self.repos['source'], work)
+        git('-c', 'user.name=z', '-c', 'user.email=z@z', 'commit',
+            '--allow-empty', '-m', 'first', cwd=work)
+        git('push', '--quiet', 'origin', 'HEAD:refs/heads/master', cwd=work)
+        self.work = work
+
+        self.source = {'name': 'source', 'host': 'source-host'}
+        self.target = {
+            'name': 'target', 'host': 'target-host', 'client': Mock()}
+        self.cfg = Mock()
+        self.cfg.git = {'cache-dir': os.path.join(self.tmp, 'cache')}
+        self.cfg.gerrits = {'source': self.source, 'target': self.target}
+        self.addCleanup(gitcache._caches.clear)
+
+        patcher = patch.object(
+            actions.GitSshAction, 'get_git_url',
+            lambda action, gerrit, project: self.repos[gerrit['name']])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(
+            actions.GitSshAction, 'make_ssh_wrapper', return_value='')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def commit(self, message):
+        git('-c', 'user.name=z', '-c', 'user.email=z@z', 'commit',
+            '--allow-empty', '-m', message, cwd=self.work)
+        git('push', '--quiet', 'origin', 'HEAD:refs/heads/master',
+            cwd=self.work)
+        return rev_parse(self.work, 'HEAD')
+
+    def test_sync_branch_pushes_from_mirror(self):
+        """
+        SyncBranch pushes the branch from a persistent mirror of the
+        source, which is kept and updated for the next event.
+        """
+        action = actions.SyncBranchAction()
+        action.push_branch_to_target(
+            self.cfg, self.source, self.target, 'stuff', 'master')
+        self.assertEqual(
+            rev_parse(self.repos['source'], 'master'),
+            rev_parse(self.repos['target'], 'master'))
+
+        mirror_dir = os.path.join(
+            self.tmp, 'cache', 'source-host', 'stuff.git')
+        self.assertTrue(os.path.isdir(mirror_dir))
+
+        head = self.commit('second')
+        action.push_branch_to_target(
+            self.cfg, self.source, self.target, 'stuff', 'master')
+        self.assertEqual(head, rev_parse(self.repos['target'], 'master'))
+        self.assertEqual(head, rev_parse(mirror_dir, 'master'))
+
+    def test_startup_only_pushes_branches_that_differ(self):
+        """
+        Startup sync compares branch heads first, and only pushes the
+        branches that differ between source and target.
+        """
+        action = actions.SyncBranchAction()
+        action_cfg = {'projects': ['stuff'], 'branches': ['master', 'gone']}
+        with patch.object(
+                action, 'push_branches_to_target',
+                wraps=action.push_branches_to_target) as mock_push:
+            action._do_startup(self.cfg, action_cfg, self.source, self.target)
+            mock_push.assert_called_once_with(
+                self.cfg, self.source, self.target, 'stuff', ['master'])
+            self.assertEqual(
+                rev_parse(self.repos['source'], 'master'),
+                rev_parse(self.repos['target'], 'master'))
+
+            # already in sync, nothing more to push
+            action._do_startup(self.cfg, action_cfg, self.source, self.target)
+            self.assertEqual(1, mock_push.call_count)
+
+    def test_startup_pushes_all_branches_at_once(self):
+        """
+        Startup sync fetches and pushes all the branches of a project
+        that need syncing in a single fetch and a single push.
+        """
+        git('push', '--quiet', 'origin', 'HEAD:refs/heads/stable',
+            cwd=self.work)
+        action = actions.SyncBranchAction()
+        action_cfg = {'projects': ['stuff'], 'branches': ['master', 'stable']}
+        executor = gitexec.get_executor()
+        with patch.object(executor, 'run', wraps=executor.run) as mock_run:
+            action._do_startup(self.cfg, action_cfg, self.source, self.target)
+        git_commands = [c[0][0][1] for c in mock_run.call_args_list]
+        self.assertEqual(1, git_commands.count('fetch'))
+        self.assertEqual(1, git_commands.count('push'))
+        for branch in ('master', 'stable'):
+            self.assertEqual(
+                rev_parse(self.repos['source'], branch),
+                rev_parse(self.repos['target'], branch))
+
+    def test_failed_push_raises(self):
+        """
+        A failed push is reported to the caller, and startup sync
+        carries on with the other projects before raising too.
+        """
+        shutil.rmtree(self.repos['target'])
+        action = actions.SyncBranchAction()
+        self.assertRaises(
+            exceptions.GitCommandError, action.push_branch_to_target,
+            self.cfg, self.source, self.target, 'stuff', 'master')
+
+        action_cfg = {'projects': ['stuff', 'other'], 'branches': ['master']}
+        with patch.object(
+                action, 'branches_to_sync',
+                return_value=['master']) as mock_branches_to_sync:
+            self.assertRaises(
+                exceptions.GitCommandError, action._do_startup,
+                self.cfg, action_cfg, self.source, self.target)
+        self.assertEqual(2, mock_branches_to_sync.call_count)
+
+    def test_unlisted_source_fails_startup(self):
+        """
+        A project whose branches can't be listed on the source counts as
+        failed, not skipped, so the startup sync is tried again.
+        """
+        shutil.rmtree(self.repos['source'])
+        action = actions.SyncBranchAction()
+        action_cfg = {'projects': ['stuff', 'other'], 'branches': ['master']}
+        with patch.object(
+                action, 'ls_remote', wraps=action.ls_remote) as mock_ls:
+            error = self.assertRaises(
+                exceptions.GitCommandError, action._do_startup,
+                self.cfg, action_cfg, self.source, self.target)
+        listed = [c[0][0] for c in mock_ls.call_args_list]
+        self.assertEqual(2, listed.count(self.source))
+        self.assertIn('failed for 2 branches', str(error))
+
+    def test_branches_listed_at_once(self):
+        """
+        The source and target branches are listed at the same time, not
+        one after the other.
+        """
+        action = actions.SyncBranchAction()
+        listing = [threading.Event(), threading.Event()]
+        ls_remote = action.ls_remote
+
+        def slow_ls_remote(gerrit, *args):
+            listing[gerrit is self.target].set()
+            # each waits for the other to have started
+            if not listing[gerrit is not self.target].wait(5):
+                raise AssertionError('listed one after the other')
+            return ls_remote(gerrit, *args)
+
+        with patch.object(action, 'ls_remote', side_effect=slow_ls_remote):
+            self.assertEqual(
+                ['master'], action.branches_to_sync(
+                    self.source, self.target, 'stuff', ['master']))
+
+    def test_rejected_push_not_retried(self):
+        """
+        A push the target refuses fails with git's errors, and isn't
+        worth retrying.
+        """
+        action = actions.SyncBranchAction()
+        error = self.assertRaises(
+            exceptions.GitCommandError, action.push_from_mirror,
+            self.repos['source'], self.target, 'stuff',
+            ['refs/heads/nope:refs/heads/nope'])
+        self.assertNotEqual(0, error.returncode)
+        self.assertIn('refs/heads/nope', error.errors)
+        self.assertFalse(retry.is_retryable(error))
+
+    def ref_updated(self, old_rev, new_rev):
+        return parser.parse(
+            '{"type": "ref-updated", "refUpdate": {"project": "stuff", '
+            '"refname": "refs/heads/master", "oldRev": "%s", '
+            '"newRev": "%s"}}' % (old_rev, new_rev))
+
+    def test_ref_updated_pushes_new_rev(self):
+        """
+        Ref updates move the target's branch to the event's newRev.
+        """
+        action = actions.SyncBranchAction()
+        old_rev = rev_parse(self.repos['source'], 'master')
+        action.push_branch_to_target(
+            self.cfg, self.source, self.target, 'stuff', 'master')
+        new_rev = self.commit('second')
+        self.commit('third')
+        action._do_run(
+            self.ref_updated(old_rev, new_rev), self.cfg,
+            {'target': 'target'}, self.source)
+        self.assertEqual(new_rev, rev_parse(self.repos['target'], 'master'))
+
+    def test_stale_retry_does_not_rewind_branch(self):
+        """
+        A ref update retried after a newer one for the same branch has
+        been synced leaves the branch where the newer one put it.
+        """
+        action = actions.SyncBranchAction()
+        first_rev = rev_parse(self.repos['source'], 'master')
+        action.push_branch_to_target(
+            self.cfg, self.source, self.target, 'stuff', 'master')
+        second_rev = self.commit('second')
+        third_rev = self.commit('third')
+
+        # the target is down for the first update, so it's retried later
+        target_repo = self.repos['target']
+        os.rename(target_repo, target_repo + '.down')
+        error = self.assertRaises(
+            exceptions.GitCommandError, action._do_run,
+            self.ref_updated(first_rev, second_rev), self.cfg,
+            {'target': 'target'}, self.source)
+        self.assertTrue(retry.is_retryable(error))
+        os.rename(target_repo + '.down', target_repo)
+
+        # the newer update gets through before the retry does
+        action._do_run(
+            self.ref_updated(second_rev, third_rev), self.cfg,
+            {'target': 'target'}, self.source)
+        self.assertEqual(third_rev, rev_parse(target_repo, 'master'))
+
+        action._do_run(
+            self.ref_updated(first_rev, second_rev), self.cfg,
+            {'target': 'target'}, self.source)
+        self.assertEqual(third_rev, rev_parse(target_repo, 'master'))
+
+    def test_ref_updated_skipped_when_target_up_to_date(self):
+        """
+        Nothing is fetched or pushed when the target is already at
+        the event's newRev.
+        """
+        action = actions.SyncBranchAction()
+        action.push_branch_to_target(
+            self.cfg, self.source, self.target, 'stuff', 'master')
+        new_rev = rev_parse(self.repos['source'], 'master')
+        with patch.object(action, 'mirror') as mock_mirror:
+            action._do_run(
+                self.ref_updated(actions.NULL_SHA, new_rev), self.cfg,
+                {'target': 'target'}, self.source)
+        self.assertEqual(0, mock_mirror.call_count)
+
+    def test_ref_deleted_not_synced(self):
+        """Branch deletions are not synced."""
+        action = actions.SyncBranchAction()
+        with patch.object(action, '_run_cmd') as mock_run_cmd:
+            action._do_run(
+                self.ref_updated('a' * 40, actions.NULL_SHA), self.cfg,
+                {'target': 'target'}, self.source)
+        self.assertEqual(0, mock_run_cmd.call_count)
+
+    def test_corrupt_mirror_is_rebuilt(self):
+        """A mirror that git can't fetch into gets rebuilt."""
+        action = actions.SyncBranchAction()
+        action.push_branch_to_target(
+            self.cfg, self.source, self.target, 'stuff', 'master')
+        mirror_dir = os.path.join(
+            self.tmp, 'cache', 'source-host', 'stuff.git')
+        shutil.rmtree(os.path.join(mirror_dir, 'objects'))
+        os.makedirs(os.path.join(mirror_dir, 'objects'))
+
+        head = self.commit('second')
+        action.push_branch_to_target(
+            self.cfg, self.source, self.target, 'stuff', 'master')
+        self.assertEqual(head, rev_parse(self.repos['target'], 'master'))
+
+    def review_event(self):
+        head = self.commit('change')
+        git('push', '--quiet', 'origin', 'HEAD:refs/changes/01/1/1',
+            cwd=self.work)
+        return head, parser.parse(
+            '{"type": "patchset-created", '
+            '"change": {"project": "stuff", "branch": "master", '
+            '"topic": "orsm"}, '
+            '"patchset": {"ref": "refs/changes/01/1/1", '
+            '"revision": "%s"}}' % head)
+
+    def test_sync_review_code(self):
+        """SyncReviewCode pushes the patchset for review on the target."""
+        head, event = self.review_event()
+        action = actions.SyncReviewCodeAction()
+        with patch.object(action, 'push_from_mirror') as mock_push:
+            action._do_run(event, self.cfg, {'target': 'target'}, self.source)
+        mirror_dir, target, project, refspecs = mock_push.call_args[0]
+        self.assertEqual(['%s:refs/for/master/orsm' % head], refspecs)
+        self.assertEqual(head, rev_parse(mirror_dir, 'FETCH_HEAD'))
+
+    def test_sync_review_code_fetches_once_for_many_targets(self):
+        """
+        When several targets sync the same patchset, only the first one
+        fetches it from the source.
+        """
+        head, event = self.review_event()
+        action = actions.SyncReviewCodeAction()
+        with patch.object(action, 'push_from_mirror'):
+            with patch.object(
+                    action, 'update_mirror',
+                    wraps=action.update_mirror) as mock_update:
+                for i in range(3):
+                    action._do_run(
+                        event, self.cfg, {'target': 'target'}, self.source)
+        self.assertEqual(1, mock_update.call_count)
+
+
+class MirrorCacheTestCase(testtools.TestCase):
+    def setUp(self):
+        super(MirrorCacheTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def make_mirror(self, project, size, last_used):
+        mirror_dir = os.path.join(self.tmp, 'host', project + '.git')
+        os.makedirs(mirror_dir)
+        with open(os.path.join(mirror_dir, 'pack'), 'w') as f:
+            f.write('x' * size)
+        os.utime(mirror_dir, (last_used, last_used))
+        return mirror_dir
+
+    def test_existing_mirrors_found(self):
+        """Mirrors left by an earlier run are picked up again."""
+        mirror_dir = self.make_mirror('some/stuff', 10, 1)
+        cache = gitcache.MirrorCache(self.tmp)
+        self.assertEqual({mirror_dir: 10}, cache.sizes)
+
+    def test_least_recently_used_evicted(self):
+        """Over the size limit, the least recently used mirrors go first."""
+        oldest = self.make_mirror('old', 10, 1)
+        newer = self.make_mirror('new', 10, 2)
+        cache = gitcache.MirrorCache(self.tmp, max_size=15)
+        cache.evict()
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(newer))
+        self.assertEqual(10, cache.total_size())
+
+    def test_mirror_readers_share(self):
+        """
+        Any number of readers can use a mirror at once, but an update
+        has to wait for them.
+        """
+        lock = gitcache.MirrorLock()
+        lock.acquire_shared()
+        lock.acquire_shared()
+        self.assertFalse(lock.acquire_exclusive(blocking=False))
+        lock.release_shared()
+        lock.release_shared()
+        self.assertTrue(lock.acquire_exclusive(blocking=False))
+        lock.downgrade()
+        lock.acquire_shared()
+        self.assertFalse(lock.acquire_exclusive(blocking=False))
+
+    def test_mirror_writer_not_starved(self):
+        """
+        Readers turning up while an update waits for the mirror wait
+        behind the update.
+        """
+        lock = gitcache.MirrorLock()
+        lock.acquire_shared()
+        order = []
+
+        def write():
+            lock.acquire_exclusive()
+            order.append('write')
+            lock.release_exclusive()
+
+        def read():
+            lock.acquire_shared()
+            order.append('read')
+            lock.release_shared()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        for i in range(500):
+            if lock._writers_waiting:
+                break
+            threading.Event().wait(0.01)
+        reader = threading.Thread(target=read)
+        reader.start()
+        # the new reader is held back, not let in alongside the old one
+        reader.join(0.2)
+        self.assertTrue(reader.is_alive())
+        lock.release_shared()
+        writer.join(5)
+        reader.join(5)
+        self.assertEqual(['write', 'read'], order)
+
+    def test_mirrors_in_use_not_evicted(self):
+        """Mirrors somebody is using are left alone."""
+        oldest = self.make_mirror('old', 10, 1)
+        newer = self.make_mirror('new', 10, 2)
+        cache = gitcache.MirrorCache(self.tmp, max_size=15)
+        lock = cache.lock(oldest)
+        lock.acquire_shared()
+        cache.evict()
+        lock.release_shared()
+        self.assertTrue(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(newer))
+
+
+class SshWrapperTestCase(testtools.TestCase):
+    def setUp(self):
+        super(SshWrapperTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = patch.object(os, 'getcwd', return_value=self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.gerrit = {
+            'name': 'master', 'key_filename': '/some/key',
+            'ssh-control-persist': 60}
+
+    def test_wrapper_shares_connections(self):
+        """
+        The wrapper has ssh share one connection between git commands,
+        kept for the configured idle time.
+        """
+        filename = actions.GitSshAction().make_ssh_wrapper(self.gerrit)
+        script = open(filename).read()
+        self.assertIn('ControlMaster=auto', script)
+        self.assertIn('ControlPersist=60', script)
+        self.assertIn('-i /some/key', script)
+
+    def test_wrapper_without_sharing(self):
+        """Connection sharing can be turned off."""
+        self.gerrit['ssh-control-persist'] = 0
+        filename = actions.GitSshAction().make_ssh_wrapper(self.gerrit)
+        self.assertNotIn('ControlMaster', open(filename).read())
+
+    def test_wrapper_written_once(self):
+        """The wrapper is only written again when it needs to change."""
+        action = actions.GitSshAction()
+        filename = action.make_ssh_wrapper(self.gerrit)
+        inode = os.stat(filename).st_ino
+        action.make_ssh_wrapper(self.gerrit)
+        self.assertEqual(inode, os.stat(filename).st_ino)
+        self.gerrit['key_filename'] = '/another/key'
+        action.make_ssh_wrapper(self.gerrit)
+        self.assertIn('-i /another/key', open(filename).read())
+
+
+class PropagateCommentTestCase(testtools.TestCase):
+    def setUp(self):
+        super(PropagateCommentTestCase, self).setUp()
+        self.target = {'name': 'target', 'client': Mock()}
+        self.target['client'].unknown_revisions = cache.TTLCache(10, 60)
+        self.cfg = Mock()
+        self.cfg.gerrits = {'target': self.target}
+        self.source = {'name': 'source'}
+        self.addCleanup(actions.PropagateCommentAction._pending.clear)
+        patcher = patch.object(
+            actions.PropagateCommentAction, 'dispatch', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def comment(self, text, revision='abc'):
+        return parser.parse(
+            '{"type": "comment-added", "comment": "%s", '
+            '"author": {"name": "Bot", "email": "bot@example.com"}, '
+            '"patchset": {"revision": "%s"}}' % (text, revision))
+
+    def test_comment_propagated(self):
+        action = actions.PropagateCommentAction()
+        action._do_run(
+            self.comment('Looks good'), self.cfg, {'target': 'target'},
+            self.source)
+        self.target['client'].run_command.assert_called_once_with(
+            u'review abc -m "X-FROM-GERRIT: Bot (bot@example.com) - '
+            u'(source gerrit)\n\n--------\n\nLooks good"')
+
+    def test_comments_coalesced(self):
+        """
+        Comments for a revision within the window are posted in one
+        review, each keeping its header.
+        """
+        action_cfg = {'target': 'target', 'coalesce-seconds': 30}
+        futures = [
+            actions.PropagateCommentAction()._do_run(
+                self.comment(text), self.cfg, action_cfg, self.source)
+            for text in ('Build passed', 'Tests passed')]
+        actions.PropagateCommentAction()._do_run(
+            self.comment('Other', 'def'), self.cfg, action_cfg, self.source)
+        self.assertEqual(0, self.target['client'].run_command.call_count)
+
+        actions.PropagateCommentAction.flush_all(self.cfg)
+        commands = sorted(
+            c[0][0] for c in self.target['client'].run_command.call_args_list)
+        self.assertEqual(2, len(commands))
+        self.assertTrue(commands[0].startswith(u'review abc -m "X-FROM'))
+        self.assertEqual(2, commands[0].count('X-FROM-GERRIT'))
+        self.assertIn('Build passed', commands[0])
+        self.assertIn('Tests passed', commands[0])
+        self.assertTrue(commands[1].startswith(u'review def -m "X-FROM'))
+        # the actions are only finished once the review is posted
+        self.assertEqual([None, None], [f.result(0) for f in futures])
+
+    def test_coalesced_comments_fail_together(self):
+        """
+        When the review can't be posted, every comment's action fails
+        with the error, so each can be retried.
+        """
+        error = exceptions.GerritCommandError(
+            'gerrit review', None, 'timed out')
+        self.target['client'].run_command.side_effect = error
+        action_cfg = {'target': 'target', 'coalesce-seconds': 30}
+        futures = [
+            actions.PropagateCommentAction()._do_run(
+                self.comment(text), self.cfg, action_cfg, self.source)
+            for text in ('Build passed', 'Tests passed')]
+        actions.PropagateCommentAction.flush_all(self.cfg)
+        self.assertEqual([error, error], [f.exception(0) for f in futures])
+
+    def test_coalesced_comments_posted_after_window(self):
+        action_cfg = {'target': 'target', 'coalesce-seconds': 0.05}
+        posted = threading.Event()
+        self.target['client'].run_command.side_effect = (
+            lambda cmd: posted.set())
+        actions.PropagateCommentAction()._do_run(
+            self.comment('Build passed'), self.cfg, action_cfg, self.source)
+        self.assertTrue(posted.wait(5))
+        self.assertEqual({}, actions.PropagateCommentAction._pending)
+
+    def test_coalesced_comments_posted_on_target_workers(self):
+        """
+        When the window is up, the review is posted from the target's
+        worker pool, in order with the change's other actions.
+        """
+        action_cfg = {'target': 'target', 'coalesce-seconds': 0.05}
+        dispatched = threading.Event()
+
+        def dispatch(target_name, key, func, *args):
+            func(*args)
+            dispatched.set()
+
+        with patch.object(
+                actions.PropagateCommentAction, 'dispatch',
+                Mock(side_effect=dispatch)) as mock_dispatch:
+            event = parser.parse(
+                '{"type": "comment-added", "comment": "Build passed", '
+                '"author": {"name": "Bot", "email": "bot@example.com"}, '
+                '"change": {"project": "stuff", "number": 1}, '
+                '"patchset": {"revision": "abc"}}')
+            posted = actions.PropagateCommentAction()._do_run(
+                event, self.cfg, action_cfg, self.source)
+            self.assertTrue(dispatched.wait(5))
+        target_name, key = mock_dispatch.call_args[0][:2]
+        self.assertEqual('target', target_name)
+        self.assertEqual('change stuff 1', key)
+        self.assertEqual(None, posted.result(0))
+        self.assertEqual(1, self.target['client'].run_command.call_count)
+
+    def test_unknown_revisions_not_retried(self):
+        """
+        Once the target says it doesn't have a revision, comments for it
+        aren't sent again until the cache entry expires.
+        """
+        client = self.target['client']
+        client.run_command.side_effect = exceptions.GerritCommandError(
+            'gerrit review', 1, 'fatal: "abc" no such patch set')
+        for text in ('one', 'two'):
+            actions.PropagateCommentAction()._do_run(
+                self.comment(text), self.cfg, {'target': 'target'},
+                self.source)
+        self.assertEqual(1, client.run_command.call_count)
+        self.assertIn('abc', client.unknown_revisions)
+
+    def test_synced_revision_forgotten(self):
+        """Pushing a revision to the target takes it out of the cache."""
+        client = self.target['client']
+        client.unknown_revisions.set('abc')
+        event = parser.parse(
+            '{"type": "patchset-created", "change": {"project": "stuff", '
+            '"branch": "master"}, "patchset": {"ref": "refs/changes/1", '
+            '"revision": "abc"}}')
+        action = actions.SyncReviewCodeAction()
+        with patch.object(action, 'mirror'), \
+                patch.object(action, 'push_from_mirror'):
+            action._do_run(event, self.cfg, {'target': 'target'}, {})
+        self.assertNotIn('abc', client.unknown_revisions)
@@ -0,0 +1,49 @@
+import testtools
+from zoidberg import backfill
+from zoidberg import parser
+
+
+class SynthesizeEventsTestCase(testtools.TestCase):
+    def setUp(self):
+        super(SynthesizeEventsTestCase, self).setUp()
+        self.change = parser.parse(
+            '{"project": "stuff", "branch": "master", "id": "I1", '
+            '"number": 1, "status": "NEW", "lastUpdated": 300, '
+            '"patchSets": ['
+            '{"number": 1, "revision": "aaa", "ref": "refs/changes/01/1/1", '
+            '"createdOn": 100},'
+            '{"number": 2, "revision": "bbb", "ref": "refs/changes/01/1/2", '
+            '"createdOn": 200}], '
+            '"comments": ['
+            '{"timestamp": 150, "message": "Patch Set 1: old", '
+            '"reviewer": {"name": "A", "email": "a@example.com"}},'
+            '{"timestamp": 250, "message": "Patch Set 1: late", '
+            '"reviewer": {"name": "B", "email": "b@example.com"}}]}')
+
+    def test_only_events_after_since(self):
+        events = backfill.synthesize_events(self.change, 160)
+        self.assertEqual(
+            [('patchset-created', 200), ('comment-added', 250)],
+            [(e['type'], e['eventCreatedOn']) for e in events])
+
+    def test_only_events_up_to_until(self):
+        """Events after the stream reconnected arrive on it instead."""
+        events = backfill.synthesize_events(self.change, 90, 200)
+        self.assertEqual(
+            [('patchset-created', 100), ('patchset-created', 200),
+             ('comment-added', 150)],
+            [(e['type'], e['eventCreatedOn']) for e in events])
+
+    def test_comment_on_its_patchset(self):
+        """Comments go to the patchset their message names."""
+        comment = backfill.synthesize_events(self.change, 200)[0]
+        self.assertEqual('aaa', comment['patchset']['revision'])
+        self.assertEqual('B', comment['author']['name'])
+        self.assertEqual('Patch Set 1: late', comment['comment'])
+        self.assertEqual('stuff', comment['change']['project'])
+
+    def test_events_parse_like_stream_events(self):
+        event = parser.parse(parser.dump(
+            backfill.synthesize_events(self.change, 160)[0]))
+        self.assertEqual('bbb', event.patchset.revision)
+        self.assertEqual('master', event.change.branch)
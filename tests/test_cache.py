@@ -0,0 +1,44 @@
+import testtools
+from zoidberg import cache
+
+
+class TTLCacheTestCase(testtools.TestCase):
+    def setUp(self):
+        super(TTLCacheTestCase, self).setUp()
+        self.now = 1000.0
+        self.cache = cache.TTLCache(3, 10, clock=lambda: self.now)
+
+    def test_entries_expire(self):
+        self.cache.set('a', 'value')
+        self.assertEqual('value', self.cache.get('a'))
+        self.now += 10
+        self.assertEqual(None, self.cache.get('a'))
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(0, len(self.cache))
+
+    def test_oldest_dropped_when_full(self):
+        for key in 'abcd':
+            self.cache.set(key)
+        self.assertNotIn('a', self.cache)
+        for key in 'bcd':
+            self.assertIn(key, self.cache)
+
+    def test_set_again_refreshes(self):
+        self.cache.set('a')
+        self.now += 5
+        self.cache.set('a')
+        self.now += 6
+        self.assertIn('a', self.cache)
+
+    def test_discard(self):
+        self.cache.set('a')
+        self.cache.discard('a')
+        self.cache.discard('missing')
+        self.assertNotIn('a', self.cache)
+
+    def test_stats(self):
+        self.cache.set('a')
+        self.cache.get('a')
+        self.cache.get('b')
+        self.assertEqual(
+            {'size': 1, 'hits': 1, 'misses': 1}, self.cache.stats())
@@ -4,6 +4,7 @@ import threading
 import socket
 import StringIO
 import testtools
+from zoidberg import exceptions
 from zoidberg import gerrit
 from zoidberg import stream
 
@@ -12,15 +13,62 @@ class ClientTestCase(testtools.TestCase):
     def test_queue_event(self):
         """
         When a JSON representation of an event is passed to
-        queue_event, a python object ends up in the queue.
+        queue_event, a python object comes out of the queue.
         """
         client = gerrit.GerritClient()
         json_event = '{"type": "orsm-event", "something": "value"}'
         client.queue_event(json_event)
-        event = client.event_queue.get(timeout=0.1)
+        event = client.get_event(timeout=0.1)
         self.assertEqual('orsm-event', event.type)
         self.assertEqual('value', event.something)
 
+    def test_queue_event_prefiltered(self):
+        """
+        Events the client's prefilter does not accept never reach
+        the queue.
+        """
+        client = gerrit.GerritClient()
+        client.event_filter = Mock()
+        client.event_filter.accepts.return_value = False
+        json_event = '{"type": "orsm-event", "something": "value"}'
+        client.queue_event(json_event)
+        client.event_filter.accepts.assert_called_once_with(json_event)
+        self.assertTrue(client.event_queue.empty())
+
+    def test_backfilled_duplicates_dropped(self):
+        """
+        While a backfill might make up events the stream also sent, each
+        is only queued once, however its change number is written.
+        """
+        client = gerrit.GerritClient()
+        client.dedupe_until = 200
+        streamed = (
+            '{"type": "patchset-created", "eventCreatedOn": %d, '
+            '"change": {"project": "stuff", "number": "%s"}, '
+            '"patchset": {"number": 1}}')
+        client.queue_event(streamed % (150, '12'))
+        client.queue_event(streamed % (150, 12))
+        # after the backfill's window, nothing is checked
+        client.queue_event(streamed % (250, 12))
+        client.queue_event(streamed % (250, 12))
+        created = []
+        while not client.event_queue.empty():
+            created.append(client.get_event(timeout=0).eventCreatedOn)
+        self.assertEqual([150, 250, 250], created)
+        self.assertEqual(1, client.duplicates)
+
+    def test_unparseable_events_skipped(self):
+        client = gerrit.GerritClient()
+        client.queue_event('{"type": ')
+        client.queue_event('{"type": "orsm-event"}')
+        self.assertEqual('orsm-event', client.get_event(timeout=0.1).type)
+        self.assertEqual(None, client.get_event(timeout=0))
+
+    def test_empty_event_data_raises(self):
+        """The stream stops when it reads nothing, as it's closed."""
+        client = gerrit.GerritClient()
+        self.assertRaises(ValueError, client.queue_event, '')
+
     def test_stream_supplies_client_with_events(self):
         """
         When a stream runs, it should do the following:
@@ -49,3 +97,132 @@ class ClientTestCase(testtools.TestCase):
             'gerrit stream-events')
         client.queue_event.assert_called_once_with(
             '{"type": "orsm-event", "something": "value"}')
+
+
+class RunCommandTestCase(testtools.TestCase):
+    def setUp(self):
+        super(RunCommandTestCase, self).setUp()
+        self.client = gerrit.GerritClient()
+        self.transport = Mock()
+        self.channel = self.transport.open_session.return_value
+        self.channel.makefile.return_value = StringIO.StringIO('one\ntwo\n')
+        self.channel.makefile_stderr.return_value = StringIO.StringIO('')
+        self.channel.recv_exit_status.return_value = 0
+        patcher = patch.object(
+            self.client, 'get_transport', return_value=self.transport)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_command(self):
+        """Commands run on a new channel on the client's transport."""
+        self.assertEqual(
+            ['one\n', 'two\n'], self.client.run_command('version'))
+        self.channel.exec_command.assert_called_once_with('gerrit version')
+        self.channel.close.assert_called_once_with()
+        stats = self.client.command_stats()
+        self.assertEqual(1, stats['count'])
+        self.assertEqual(0, stats['failed'])
+        self.assertEqual(0, stats['running'])
+
+    def test_run_command_failure(self):
+        """Failed commands raise with gerrit's exit status and error."""
+        self.channel.makefile_stderr.return_value = StringIO.StringIO(
+            'fatal: no such change\n')
+        self.channel.recv_exit_status.return_value = 1
+        e = self.assertRaises(
+            exceptions.GerritCommandError, self.client.run_command,
+            'review abc')
+        self.assertEqual(1, e.exit_status)
+        self.assertEqual('fatal: no such change', e.error)
+        self.assertEqual(1, self.client.command_stats()['failed'])
+
+    def test_run_command_ssh_error(self):
+        """Errors opening the channel don't leave anything unbound."""
+        self.transport.open_session.side_effect = paramiko.SSHException(
+            'nope')
+        e = self.assertRaises(
+            exceptions.GerritCommandError, self.client.run_command,
+            'version')
+        self.assertEqual(None, e.exit_status)
+
+    def test_run_command_concurrency(self):
+        """No more than command_concurrency commands run at once."""
+        self.client.configure_commands(2, 60)
+        release = threading.Event()
+        running = []
+        peak = []
+
+        def exec_command(command):
+            running.append(1)
+            peak.append(len(running))
+            release.wait(5)
+            running.pop()
+
+        self.channel.exec_command.side_effect = exec_command
+        self.channel.makefile.side_effect = lambda mode: StringIO.StringIO()
+        self.channel.makefile_stderr.side_effect = (
+            lambda mode: StringIO.StringIO())
+        threads = [
+            threading.Thread(target=self.client.run_command, args=('v',))
+            for _ in range(4)]
+        for t in threads:
+            t.start()
+        for _ in range(500):
+            if self.client.command_stats()['waiting'] == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(2, self.client.command_stats()['running'])
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(2, max(peak))
+        self.assertEqual(4, self.client.command_stats()['count'])
+
+
+class QueryTestCase(testtools.TestCase):
+    def setUp(self):
+        super(QueryTestCase, self).setUp()
+        self.client = gerrit.GerritClient()
+        self.pages = [
+            ['{"type": "change", "number": 1}\n',
+             '{"type": "change", "number": 2}\n',
+             '{"type": "stats", "rowCount": 2, "moreChanges": true}\n'],
+            ['{"type": "change", "number": 3}\n',
+             '{"type": "stats", "rowCount": 1, "moreChanges": false}\n'],
+        ]
+        patcher = patch.object(
+            self.client, 'run_command', side_effect=self.pages)
+        self.run_command = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_query_pages(self):
+        """Queries page through the results, a page at a time."""
+        results = self.client.query('status:open', page_size=2)
+        self.assertEqual(1, next(results).number)
+        # the second page isn't fetched until it's needed
+        self.assertEqual(1, self.run_command.call_count)
+        self.assertEqual([2, 3], [r.number for r in results])
+        self.assertEqual(
+            ['query --format=JSON --start 0 status:open limit:2',
+             'query --format=JSON --start 2 status:open limit:2'],
+            [c[0][0] for c in self.run_command.call_args_list])
+
+    def test_query_cached(self):
+        """Cached queries aren't run again while the results are kept."""
+        first = list(self.client.query('status:open', cached=True))
+        second = list(self.client.query('status:open', cached=True))
+        self.assertEqual(first, second)
+        self.assertEqual(2, self.run_command.call_count)
+
+    def test_query_too_big_to_cache(self):
+        self.client.max_cached_query_rows = 2
+        list(self.client.query('status:open', cached=True))
+        self.assertNotIn(('status:open', ()), self.client.query_cache)
+
+    def test_query_error(self):
+        self.run_command.side_effect = [
+            ['{"type": "error", "message": "bad query"}\n']]
+        e = self.assertRaises(
+            exceptions.GerritCommandError, list,
+            self.client.query('status:nonsense'))
+        self.assertEqual('bad query', e.error)
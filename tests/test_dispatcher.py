@@ -0,0 +1,68 @@
+import testtools
+import threading
+from zoidberg import dispatcher
+from zoidberg import parser
+
+
+class WorkerPoolTestCase(testtools.TestCase):
+    def setUp(self):
+        super(WorkerPoolTestCase, self).setUp()
+        self.pool = dispatcher.WorkerPool('test', 2, 10)
+        self.addCleanup(self.pool.shutdown)
+
+    def test_same_key_runs_in_order(self):
+        """Work submitted with the same key runs in submission order."""
+        ran = []
+        for i in range(20):
+            self.pool.submit('change stuff 1', ran.append, i)
+        self.pool.shutdown()
+        self.assertEqual(range(20), ran)
+
+    def test_different_keys_run_in_parallel(self):
+        """
+        Work for one key does not have to wait for work on another
+        key to finish.
+        """
+        blocker = threading.Event()
+        finished = threading.Event()
+        keys = ['change stuff %d' % i for i in range(10)]
+        # find two keys that land on different workers
+        first = keys[0]
+        second = [k for k in keys if self.pool.queues[
+            dispatcher.zlib.crc32(k) % 2] is not self.pool.queues[
+            dispatcher.zlib.crc32(first) % 2]][0]
+        self.pool.submit(first, blocker.wait, 5)
+        self.pool.submit(second, finished.set)
+        self.assertTrue(finished.wait(5))
+        blocker.set()
+
+    def test_queue_depths(self):
+        """Queue depths are reported for each worker."""
+        self.assertEqual([0, 0], self.pool.queue_depths())
+
+
+class EventOrderingKeyTestCase(testtools.TestCase):
+    def test_change_events(self):
+        """Events for the same change share a key."""
+        first = parser.parse(
+            '{"type": "comment-added", '
+            '"change": {"project": "stuff", "number": "1", "id": "I1"}}')
+        second = parser.parse(
+            '{"type": "patchset-created", '
+            '"change": {"project": "stuff", "number": "1", "id": "I1"}}')
+        self.assertEqual(
+            dispatcher.event_ordering_key(first),
+            dispatcher.event_ordering_key(second))
+
+    def test_ref_events(self):
+        """Ref updates are keyed by project and ref."""
+        event = parser.parse(
+            '{"type": "ref-updated", '
+            '"refUpdate": {"project": "stuff", "refname": "master"}}')
+        self.assertEqual(
+            'ref stuff master', dispatcher.event_ordering_key(event))
+
+    def test_other_events(self):
+        """Events without a change or ref don't need ordering."""
+        event = parser.parse('{"type": "orsm-event"}')
+        self.assertEqual(None, dispatcher.event_ordering_key(event))
@@ -0,0 +1,47 @@
+import testtools
+import threading
+from mock import patch
+from zoidberg import engine
+from zoidberg import gerrit
+
+
+class EngineTestCase(testtools.TestCase):
+    def setUp(self):
+        super(EngineTestCase, self).setUp()
+        self.engine = engine.Engine(2)
+        self.addCleanup(self.engine.shutdown)
+
+    def test_operations_in_flight_together(self):
+        """Several operations can be waiting at the same time."""
+        started = [threading.Event(), threading.Event()]
+        futures = [
+            self.engine.submit(lambda e=e: (e.set(), started[0].wait(5)))
+            for e in started]
+        self.assertEqual(
+            [(None, True), (None, True)], [f.result(5) for f in futures])
+        self.assertEqual(0, self.engine.stats()['in_flight'])
+
+    def test_resize(self):
+        """Resizing the engine keeps it running operations."""
+        self.engine.resize(4)
+        self.assertEqual(4, self.engine.stats()['max'])
+        self.assertEqual(2, self.engine.submit(lambda: 2).result(5))
+
+    def test_gather_raises_failures(self):
+        """gather returns results in order, or the first failure."""
+        self.assertEqual(
+            [1, 2], engine.gather(
+                [self.engine.submit(lambda: 1),
+                 self.engine.submit(lambda: 2)]))
+        self.assertRaises(
+            ZeroDivisionError, engine.gather,
+            [self.engine.submit(lambda: 1), self.engine.submit(lambda: 1 / 0)])
+
+    @patch.object(gerrit.GerritClient, 'run_command')
+    def test_run_command_async(self, mock_run_command):
+        """run_command_async returns a future for run_command's output."""
+        mock_run_command.return_value = ['output']
+        client = gerrit.GerritClient()
+        future = client.run_command_async('version')
+        self.assertEqual(['output'], future.result(5))
+        mock_run_command.assert_called_once_with('version')
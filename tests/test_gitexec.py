@@ -0,0 +1,120 @@
+import mock
+import os
+import shutil
+import tempfile
+import testtools
+import threading
+import time
+from zoidberg import gitexec
+
+
+def process_running(pid):
+    """Is the process still running, and not just waiting to be reaped?"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class GitExecutorTestCase(testtools.TestCase):
+    def test_processes_capped(self):
+        """No more than max_processes slots are handed out at once."""
+        executor = gitexec.GitExecutor(2)
+        running = []
+        peak = []
+        release = threading.Event()
+
+        def work():
+            with executor.slot():
+                running.append(1)
+                peak.append(len(running))
+                release.wait(5)
+                running.pop()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        # wait for two to be running and two to be waiting
+        for _ in range(500):
+            stats = executor.stats()
+            if stats['running'] == 2 and stats['waiting'] == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(
+            {'running': 2, 'waiting': 2, 'max': 2}, executor.stats())
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(2, max(peak))
+        self.assertEqual(0, executor.stats()['running'])
+
+    def test_resize(self):
+        """Slots held under the old cap are given back safely."""
+        executor = gitexec.GitExecutor(1)
+        with executor.slot():
+            executor.resize(3)
+            with executor.slot():
+                self.assertEqual(2, executor.stats()['running'])
+        self.assertEqual(3, executor.stats()['max'])
+        self.assertEqual(0, executor.stats()['running'])
+
+    def test_run_captures_output(self):
+        executor = gitexec.GitExecutor(1)
+        returncode, out, errors = executor.run(
+            ['sh', '-c', 'echo hello; echo oops >&2'], '/', {}, capture=True)
+        self.assertEqual(0, returncode)
+        self.assertEqual('hello\n', out)
+        self.assertEqual('oops', errors)
+
+    def test_run_returns_failures(self):
+        executor = gitexec.GitExecutor(1)
+        returncode, out, errors = executor.run(['sh', '-c', 'exit 3'], '/', {})
+        self.assertEqual(3, returncode)
+
+    def test_run_logs_output_up_to_limit(self):
+        executor = gitexec.GitExecutor(1)
+        executor.log_limit = 11
+        with mock.patch('zoidberg.gitexec.logging') as logging:
+            executor.run(
+                ['sh', '-c', 'printf "one\\rtwo\\n"; echo three; '
+                 'echo fourfourfour'], '/', {})
+        logged = [c[0][0] for c in logging.debug.call_args_list[1:]]
+        self.assertEqual(
+            ['one', 'two', 'three', '(not logging any more output)'],
+            logged)
+
+    def test_run_kills_hung_processes(self):
+        executor = gitexec.GitExecutor(1)
+        executor.timeout = 0.2
+        returncode, out, errors = executor.run(
+            ['sh', '-c', 'sleep 30 & sleep 30'], '/', {})
+        self.assertNotEqual(0, returncode)
+        self.assertEqual(0, executor.stats()['running'])
+
+    def test_run_kills_what_hung_processes_started(self):
+        if gitexec._setsid is None:
+            self.skipTest('no setsid to start a process group with')
+        executor = gitexec.GitExecutor(1)
+        executor.timeout = 0.2
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        pid_file = os.path.join(tmp, 'pid')
+        executor.run(
+            ['sh', '-c', 'sleep 30 & echo $! > %s; wait' % pid_file],
+            '/', {})
+        with open(pid_file) as f:
+            pid = int(f.read())
+        for i in range(50):
+            if not process_running(pid):
+                break
+            time.sleep(0.1)
+        self.assertFalse(process_running(pid))
+
+    def test_configure(self):
+        executor = gitexec.GitExecutor()
+        executor.configure(
+            {'max-processes': 2, 'timeout': 60, 'log-limit-kb': 1})
+        self.assertEqual(2, executor.max_processes)
+        self.assertEqual(60, executor.timeout)
+        self.assertEqual(1024, executor.log_limit)
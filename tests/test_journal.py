@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import testtools
+import time
+from mock import Mock, patch
+from zoidberg import journal
+
+
+class EventJournalTestCase(testtools.TestCase):
+    def setUp(self):
+        super(EventJournalTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'journal')
+
+    def open(self, **kwargs):
+        kwargs.setdefault('sync_interval', 0)
+        return journal.EventJournal(self.path, **kwargs)
+
+    def test_unfinished_events_replayed(self):
+        """Events not done with are replayed, in order, when reopened."""
+        j = self.open()
+        first = j.record('master', '{"type": "one"}\n')
+        second = j.record('master', '{"type": "two"}\n')
+        third = j.record('thirdparty', '{"type": "three"}\n')
+        j.done(second)
+        j.close()
+
+        j = self.open()
+        self.assertEqual(
+            [(first, 'master', '{"type": "one"}'),
+             (third, 'thirdparty', '{"type": "three"}')],
+            j.replay())
+        self.assertEqual([], j.replay())
+        # new events don't reuse old ids
+        self.assertTrue(j.record('master', '{}') > third)
+        j.close()
+
+    def test_non_ascii_events_replayed(self):
+        """Events read from the stream as unicode survive a restart."""
+        data = u'{"author": {"name": "Zo\xeb"}, "comment": "\u2713"}'
+        j = self.open()
+        journal_id = j.record('master', data)
+        j.close()
+
+        j = self.open()
+        self.assertEqual([(journal_id, 'master', data)], j.replay())
+        j.close()
+
+    def test_writer_survives_failed_write(self):
+        j = self.open()
+        with patch.object(
+                j, '_file', Mock(write=Mock(side_effect=IOError('full')))):
+            j.record('master', '{"type": "lost"}')
+            for _ in range(500):
+                if j.stats()['write_errors']:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(1, j.stats()['write_errors'])
+        kept = j.record('master', '{"type": "kept"}')
+        j.close()
+
+        j = self.open()
+        self.assertEqual(
+            [(kept, 'master', '{"type": "kept"}')], j.replay())
+        j.close()
+
+    def test_torn_line_ignored(self):
+        j = self.open()
+        j.record('master', '{"type": "one"}')
+        j.close()
+        with open(self.path, 'a') as f:
+            f.write('A\t2\tmaster\t{"type"')
+        j = self.open()
+        self.assertEqual(1, len(j.replay()))
+        j.close()
+
+    def test_references(self):
+        """An event is done with once the last reference is released."""
+        j = self.open()
+        event = object()
+        j.track(event, j.record('master', '{}'))
+        j.acquire(event)
+        j.release(event)
+        self.assertEqual(1, j.stats()['unfinished'])
+        j.release(event)
+        self.assertEqual(0, j.stats()['unfinished'])
+        j.close()
+        self.assertEqual([], self.open().replay())
+
+    def test_compaction(self):
+        """Once enough events are done, only unfinished ones are kept."""
+        j = self.open(compact_after=2)
+        ids = [j.record('master', '{"n": %d}' % n) for n in range(3)]
+        j.done(ids[0])
+        j.done(ids[1])
+        j.close()
+        with open(self.path) as f:
+            lines = f.readlines()
+        self.assertEqual(['A\t%d\tmaster\t{"n": 2}\n' % ids[2]], lines)
@@ -0,0 +1,59 @@
+import testtools
+from zoidberg import parser
+
+
+class ParserTestCase(testtools.TestCase):
+    def test_parse_nested_objects(self):
+        """
+        Parsed JSON objects, including nested ones, give attribute
+        access to their keys.
+        """
+        event = parser.parse(
+            '{"type": "ref-updated", "refUpdate": '
+            '{"project": "stuff", "refname": "master"}}')
+        self.assertEqual('ref-updated', event.type)
+        self.assertEqual('stuff', event.refUpdate.project)
+        self.assertEqual('master', event.refUpdate.refname)
+        self.assertFalse(hasattr(event, 'change'))
+        self.assertEqual(
+            'no-topic', getattr(event.refUpdate, 'topic', 'no-topic'))
+
+    def test_parse_reuses_classes(self):
+        """
+        Objects with the same keys share a class, rather than a new
+        class being made for every object parsed.
+        """
+        first = parser.parse('{"type": "a", "something": "value"}')
+        second = parser.parse('{"type": "b", "something": "other"}')
+        self.assertIs(type(first), type(second))
+        self.assertEqual('b', second.type)
+        self.assertEqual(
+            {'type': 'b', 'something': 'other'}, second._asdict())
+
+    def test_parse_objects_are_slotted(self):
+        """Parsed objects do not carry a per-instance __dict__."""
+        event = parser.parse('{"type": "orsm-event"}')
+        self.assertFalse(hasattr(event, '__dict__'))
+
+    def test_parse_unusable_keys(self):
+        """Objects with keys that can't be attributes are left as dicts."""
+        event = parser.parse('{"type": "x", "labels": {"Code-Review": 2}}')
+        self.assertEqual({'Code-Review': 2}, event.labels)
+
+    def test_parse_underscored_keys(self):
+        """
+        Keys that could clash with the parsed object's own attributes
+        are left as dicts too.
+        """
+        event = parser.parse(
+            '{"type": "x", "extra": {"_fields": 1, "__init__": 2}}')
+        self.assertEqual({'_fields': 1, '__init__': 2}, event.extra)
+        self.assertEqual({'_values': 3}, parser.parse('{"_values": 3}'))
+
+    def test_dump(self):
+        """Parsed objects can be turned back into the same JSON."""
+        data = (
+            '{"type": "x", "change": {"project": "stuff", "number": 1}, '
+            '"labels": {"Code-Review": 2}, "files": [{"file": "a"}]}')
+        event = parser.parse(data)
+        self.assertEqual(event, parser.parse(parser.dump(event)))
@@ -0,0 +1,44 @@
+import re
+import testtools
+from zoidberg import prefilter
+
+
+class PrefilterTestCase(testtools.TestCase):
+    def setUp(self):
+        super(PrefilterTestCase, self).setUp()
+        self.prefilter = prefilter.EventPrefilter({
+            'events': {'comment-added': []},
+            'project_re': re.compile('^stuff$')})
+
+    def test_accepts_configured_event(self):
+        """Events of a configured type, for a wanted project, pass."""
+        self.assertTrue(self.prefilter.accepts(
+            '{"type": "comment-added", "change": {"project": "stuff"}}'))
+        self.assertEqual(1, self.prefilter.stats()['passed'])
+
+    def test_drops_unconfigured_event_type(self):
+        """Event types with no configured actions are dropped."""
+        self.assertFalse(self.prefilter.accepts(
+            '{"type": "ref-updated", "refUpdate": {"project": "stuff"}}'))
+        self.assertEqual(1, self.prefilter.stats()['dropped_type'])
+
+    def test_drops_unwanted_project(self):
+        """Events for projects not matching the project pattern are dropped."""
+        self.assertFalse(self.prefilter.accepts(
+            '{"type": "comment-added", "change": {"project": "other"}}'))
+        self.assertEqual(1, self.prefilter.stats()['dropped_project'])
+
+    def test_nested_types_do_not_drop_event(self):
+        """
+        Nested objects with their own type, like approvals, don't stop
+        the event's real type from being matched.
+        """
+        self.assertTrue(self.prefilter.accepts(
+            '{"approvals": [{"type": "Code-Review", "value": "2"}], '
+            '"type": "comment-added", "change": {"project": "stuff"}}'))
+
+    def test_escaped_project(self):
+        """Escaped characters in the project are decoded before matching."""
+        self.prefilter.project_re = re.compile('^stuff/more$')
+        self.assertTrue(self.prefilter.accepts(
+            '{"type": "comment-added", "change": {"project": "stuff\\/more"}}'))
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import tempfile
+import testtools
+from zoidberg import exceptions
+from zoidberg import parser
+from zoidberg import retry
+
+
+class RetrySchedulerTestCase(testtools.TestCase):
+    def setUp(self):
+        super(RetrySchedulerTestCase, self).setUp()
+        self.now = 1000.0
+        self.scheduler = retry.RetryScheduler(
+            clock=lambda: self.now, jitter=lambda: 1.0)
+        self.down = exceptions.TargetUnavailableError('down')
+        self.event = parser.parse('{"type": "ref-updated"}')
+
+    def retry(self, attempts=1):
+        return retry.Retry(
+            'target', {'action': 'zoidberg.SyncBranch'}, self.event,
+            {'name': 'source'}, attempts)
+
+    def test_is_retryable(self):
+        self.assertTrue(retry.is_retryable(self.down))
+        self.assertTrue(retry.is_retryable(
+            exceptions.GitCommandError('push failed')))
+        self.assertTrue(retry.is_retryable(exceptions.GitCommandError(
+            'push failed', 128,
+            'ssh: connect to host gerrit port 29418: Connection refused\n'
+            'fatal: Could not read from remote repository.')))
+        self.assertTrue(retry.is_retryable(
+            exceptions.GitCommandError('push failed', -9, '')))
+        self.assertFalse(retry.is_retryable(exceptions.GitCommandError(
+            'push failed', 1,
+            ' ! [remote rejected] abc -> refs/for/master (no new changes)\n'
+            'error: failed to push some refs')))
+        self.assertTrue(retry.is_retryable(
+            exceptions.GerritCommandError('review', None, 'closed')))
+        self.assertFalse(retry.is_retryable(
+            exceptions.GerritCommandError('review', 1, 'no such change')))
+        self.assertFalse(retry.is_retryable(ValueError()))
+
+    def test_backoff(self):
+        """
+        Retries wait for the target's delay, which doubles every time
+        they fail again.
+        """
+        error = exceptions.GitCommandError('push failed')
+        r = self.retry()
+        self.scheduler.schedule(r, error)
+        self.assertEqual([], self.scheduler.due('target', True))
+        self.now += 1
+        self.assertEqual([r], self.scheduler.due('target', True))
+
+        self.scheduler.schedule(r, error)
+        self.now += 1
+        self.assertEqual([], self.scheduler.due('target', True))
+        self.now += 1
+        self.assertEqual([r], self.scheduler.due('target', True))
+
+    def test_released_together_when_target_back(self):
+        """Everything waiting for a down target goes once it's back."""
+        retries = [self.retry() for _ in range(3)]
+        for r in retries:
+            self.scheduler.schedule(r, self.down)
+        self.assertEqual({'target': 3}, self.scheduler.stats()['waiting'])
+        self.assertEqual([], self.scheduler.due('target', False))
+        self.assertEqual(retries, self.scheduler.due('target', True))
+        self.assertEqual({}, self.scheduler.stats()['waiting'])
+
+    def test_success_resets_backoff(self):
+        error = exceptions.GitCommandError('push failed')
+        for _ in range(3):
+            self.scheduler.schedule(self.retry(), error)
+            self.now += 10
+            self.scheduler.due('target', True)
+        self.scheduler.succeeded('target')
+        self.scheduler.schedule(self.retry(), error)
+        self.now += 1
+        self.assertEqual(1, len(self.scheduler.due('target', True)))
+
+    def test_dead_letters(self):
+        """Retries out of attempts are dead lettered, and kept on disk."""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'dead-letters')
+        self.scheduler.configure(
+            {'max-attempts': 3, 'dead-letter-path': path})
+        self.assertTrue(self.scheduler.schedule(self.retry(2), self.down))
+        self.assertFalse(self.scheduler.schedule(self.retry(3), self.down))
+        self.assertEqual(1, self.scheduler.stats()['dead_letters'])
+        with open(path) as f:
+            record = json.loads(f.readline())
+        self.assertEqual('target', record['target'])
+        self.assertEqual(3, record['attempts'])
+        self.assertEqual({'type': 'ref-updated'}, record['event'])
+
+    def test_waiting_capped(self):
+        """Retries past max_waiting for a target are dead lettered."""
+        self.scheduler.configure({'max-waiting': 2})
+        results = [
+            self.scheduler.schedule(self.retry(), self.down)
+            for _ in range(3)]
+        self.assertEqual([True, True, False], results)
+        self.assertEqual({'target': 2}, self.scheduler.stats()['waiting'])
+        self.assertEqual(1, self.scheduler.stats()['dead_letters'])
@@ -0,0 +1,88 @@
+import testtools
+from mock import Mock, patch
+from Queue import Queue
+from zoidberg import sharding
+
+
+class ShardingTestCase(testtools.TestCase):
+    def test_shard_for_project(self):
+        """Events for the same project always go to the same shard."""
+        first = sharding.shard_for(
+            '{"type": "comment-added", "change": {"project": "stuff"}}', 4)
+        second = sharding.shard_for(
+            '{"type": "ref-updated", "refUpdate": {"project": "stuff"}}', 4)
+        self.assertEqual(first, second)
+        self.assertEqual(0, sharding.shard_for('{"type": "orsm-event"}', 4))
+
+    def test_router_routes_events_to_shards(self):
+        """
+        Events the router's clients receive are passed, with the name of
+        the gerrit, to the shard for their project, and not queued.
+        """
+        shards = [Mock(inbox=Queue()), Mock(inbox=Queue())]
+        router = sharding.RouterZoidberg('./tests/etc/zoidberg.yaml', shards)
+        self.addCleanup(router.dispatcher.shutdown)
+        client = router.config.gerrits['master']['client']
+        data = '{"type": "ref-updated", "refUpdate": {"project": "stuff"}}'
+        client.queue_event(data)
+        shard = shards[sharding.shard_for(data, 2)]
+        self.assertEqual(('master', data), shard.inbox.get(timeout=1))
+        self.assertTrue(client.event_queue.empty())
+
+    def test_router_asks_first_shard_for_startup_tasks(self):
+        """
+        The router doesn't run startup tasks itself, it asks the first
+        shard to, including when a backfill falls back to them.
+        """
+        shards = [Mock(inbox=Queue()), Mock(inbox=Queue())]
+        router = sharding.RouterZoidberg('./tests/etc/zoidberg.yaml', shards)
+        self.addCleanup(router.dispatcher.shutdown)
+        gerrit_cfg = router.config.gerrits['master']
+        with patch.object(
+                gerrit_cfg['client'], 'query', side_effect=Exception('oops')):
+            router.backfill(gerrit_cfg, 100, 200)
+        self.assertTrue(router.startup_tasks.empty())
+        self.assertEqual(('master', None), shards[0].inbox.get(timeout=1))
+        self.assertTrue(shards[1].inbox.empty())
+
+    def test_shard_queues_routed_events(self):
+        """
+        Shards queue the events routed to them on the right client,
+        and stop when the router sends None.
+        """
+        inbox = Queue()
+        shard = sharding.ShardZoidberg('./tests/etc/zoidberg.yaml', 1, inbox)
+        self.addCleanup(shard.dispatcher.shutdown)
+        client = shard.config.gerrits['master']['client']
+        self.assertFalse(client.streaming)
+        inbox.put((
+            'master',
+            '{"type": "ref-updated", "refUpdate": {"project": "stuff"}}'))
+        inbox.put(None)
+        event = client.get_event(timeout=1)
+        self.assertEqual('stuff', event.refUpdate.project)
+        shard.reader.join(1)
+        self.assertFalse(shard.running)
+
+    def test_shard_runs_startup_tasks_when_asked(self):
+        """
+        Shards don't backfill or run startup tasks when their own
+        clients reconnect, only when the router asks.
+        """
+        inbox = Queue()
+        shard = sharding.ShardZoidberg('./tests/etc/zoidberg.yaml', 0, inbox)
+        self.addCleanup(shard.dispatcher.shutdown)
+        gerrit_cfg = shard.config.gerrits['master']
+        self.assertFalse(shard.can_backfill(gerrit_cfg, 1))
+        client = Mock()
+        client.is_active.return_value = False
+        gerrit_cfg['client'] = client
+        shard.connect_client(gerrit_cfg)
+        self.assertTrue(shard.startup_tasks.empty())
+
+        inbox.put(('master', None))
+        inbox.put(None)
+        shard.reader.join(1)
+        self.assertEqual(
+            {'task': gerrit_cfg['startup'][0], 'source': gerrit_cfg},
+            shard.startup_tasks.get(timeout=0))
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import testtools
+from Queue import Empty
+from zoidberg import spill
+
+
+class SpillingQueueTestCase(testtools.TestCase):
+    def setUp(self):
+        super(SpillingQueueTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.queue = spill.SpillingQueue(
+            'master', max_in_memory=4, spill_dir=self.tmp)
+        self.addCleanup(self.queue.close)
+
+    def test_spills_and_keeps_order(self):
+        """
+        Past the in-memory limit events go to disk, and everything comes
+        back out in the order it went in.
+        """
+        items = [('{"n": %d}' % n, n if n % 2 else None) for n in range(10)]
+        for item in items[:7]:
+            self.queue.put(item)
+        stats = self.queue.stats()
+        self.assertEqual(4, stats['in_memory'])
+        self.assertEqual(3, stats['on_disk'])
+        self.assertEqual(3, stats['spilled'])
+        self.assertEqual(1, len(os.listdir(self.tmp)))
+
+        got = [self.queue.get(timeout=0) for _ in range(5)]
+        for item in items[7:]:
+            self.queue.put(item)
+        while not self.queue.empty():
+            got.append(self.queue.get(timeout=0))
+        self.assertEqual(items, got)
+        # the segment is removed once it's all been read back
+        self.assertEqual([], os.listdir(self.tmp))
+        self.assertRaises(Empty, self.queue.get, timeout=0)
+
+    def test_non_ascii_events_spilled(self):
+        """Events read from the stream as unicode can be spilled."""
+        items = [
+            (u'{"author": {"name": "Zo\xeb"}, "n": %d}' % n, n)
+            for n in range(6)]
+        for item in items:
+            self.queue.put(item)
+        self.assertEqual(2, self.queue.stats()['on_disk'])
+        got = [self.queue.get(timeout=0) for _ in range(6)]
+        self.assertEqual(items, got)
+
+    def test_segments_rolled(self):
+        self.patch(spill, 'SEGMENT_SIZE', 2)
+        items = [('{"n": %d}' % n, None) for n in range(10)]
+        for item in items:
+            self.queue.put(item)
+        self.assertEqual(3, len(os.listdir(self.tmp)))
+        got = [self.queue.get(timeout=0) for _ in range(10)]
+        self.assertEqual(items, got)
+        self.assertEqual([], os.listdir(self.tmp))
+
+    def test_read_across_rollover(self):
+        """
+        A segment that's being read back while it's still written to is
+        read to the end once it rolls over.
+        """
+        self.patch(spill, 'SEGMENT_SIZE', 50)
+        items = [('{"n": %d}' % n, None) for n in range(110)]
+        for item in items[:10]:
+            self.queue.put(item)
+        got = [self.queue.get(timeout=0) for _ in range(6)]
+        for item in items[10:]:
+            self.queue.put(item)
+        while not self.queue.empty():
+            got.append(self.queue.get(timeout=0))
+        self.assertEqual(items, got)
@@ -0,0 +1,86 @@
+import testtools
+from mock import Mock
+from zoidberg import exceptions
+from zoidberg import startup
+
+
+def task(projects=None, action='zoidberg.SyncBranch'):
+    task_cfg = {'action': action, 'target': 'thirdparty'}
+    if projects is not None:
+        task_cfg['projects'] = projects
+    return {'task': task_cfg, 'source': {'name': 'master'}}
+
+
+class SplitTaskTestCase(testtools.TestCase):
+    def test_split_by_project(self):
+        tasks = startup.split_task(task(['a', 'b']))
+        self.assertEqual(
+            [['a'], ['b']], [t['task']['projects'] for t in tasks])
+        self.assertEqual('master', tasks[1]['source']['name'])
+
+    def test_not_split(self):
+        for t in (task(), task(['a'])):
+            self.assertEqual([t], startup.split_task(t))
+
+
+class StartupRunnerTestCase(testtools.TestCase):
+    def setUp(self):
+        super(StartupRunnerTestCase, self).setUp()
+        self.now = 1000.0
+        self.run_task = Mock(return_value=True)
+        self.runner = startup.StartupRunner(
+            self.run_task, clock=lambda: self.now, jitter=lambda: 1.0)
+        self.runner.configure({'max-concurrent': 2})
+
+    def wait(self):
+        # shutting down waits for the running tasks, so start a fresh
+        # executor for the tasks that come after
+        self.runner.executor.shutdown(wait=True)
+        self.runner.executor = startup.ThreadPoolExecutor(2)
+
+    def test_tasks_run(self):
+        for t in (task(['a']), task(['b'])):
+            self.runner.submit(t)
+        self.wait()
+        self.assertEqual(2, self.run_task.call_count)
+        stats = self.runner.stats()
+        self.assertEqual(
+            (2, 2, 0), (stats['total'], stats['done'], stats['running']))
+
+    def test_failed_task_retried_on_its_own(self):
+        """
+        A task that couldn't run backs off and is retried, without the
+        others running again.
+        """
+        self.run_task.side_effect = lambda t: t['task']['projects'] != ['b']
+        for t in (task(['a']), task(['b'])):
+            self.runner.submit(t)
+        self.wait()
+        self.assertEqual(1, self.runner.stats()['waiting'])
+
+        self.runner.release_due()
+        self.wait()
+        self.assertEqual(2, self.run_task.call_count)
+
+        self.now += 1
+        self.run_task.side_effect = None
+        self.runner.release_due()
+        self.wait()
+        self.assertEqual(3, self.run_task.call_count)
+        self.assertEqual(
+            ['b'], self.run_task.call_args[0][0]['task']['projects'])
+        stats = self.runner.stats()
+        self.assertEqual((2, 0), (stats['done'], stats['waiting']))
+
+    def test_retryable_errors_retried(self):
+        self.run_task.side_effect = exceptions.GitCommandError('push failed')
+        self.runner.submit(task(['a']))
+        self.wait()
+        self.assertEqual(1, self.runner.stats()['waiting'])
+
+    def test_other_errors_not_retried(self):
+        self.run_task.side_effect = KeyError('projects')
+        self.runner.submit(task(['a']))
+        self.wait()
+        stats = self.runner.stats()
+        self.assertEqual((1, 0), (stats['failed'], stats['waiting']))
@@ -0,0 +1,86 @@
+import testtools
+import threading
+from mock import Mock
+from zoidberg import supervisor
+
+
+class ConnectionSupervisorTestCase(testtools.TestCase):
+    def setUp(self):
+        super(ConnectionSupervisorTestCase, self).setUp()
+        self.now = 1000.0
+        self.connect = Mock(return_value=False)
+        self.supervisor = supervisor.ConnectionSupervisor(
+            self.connect, clock=lambda: self.now, jitter=lambda: 1.0)
+        self.gerrits = {}
+        for name in ('down', 'up'):
+            client = Mock()
+            client.is_active.return_value = name == 'up'
+            self.gerrits[name] = {'name': name, 'client': client}
+        config = Mock(gerrits=self.gerrits, reconnect={})
+        self.supervisor.configure(config)
+
+    def check(self):
+        for thread in self.supervisor.check_connections():
+            thread.join(5)
+
+    def test_only_inactive_clients_connected(self):
+        self.check()
+        self.connect.assert_called_once_with(self.gerrits['down'])
+
+    def test_backoff(self):
+        """A gerrit that keeps failing waits longer between tries."""
+        self.check()
+        self.check()
+        self.assertEqual(1, self.connect.call_count)
+        self.now += 1
+        self.check()
+        self.assertEqual(2, self.connect.call_count)
+        self.now += 1
+        self.check()
+        self.assertEqual(2, self.connect.call_count)
+        self.now += 1
+        self.check()
+        self.assertEqual(3, self.connect.call_count)
+        self.assertEqual({'down': 3}, self.supervisor.stats())
+
+    def test_backoff_reset_once_connected(self):
+        self.check()
+        self.now += 1
+        self.connect.return_value = True
+        self.check()
+        self.assertEqual({}, self.supervisor.stats())
+
+    def test_connect_errors_survived(self):
+        self.connect.side_effect = Exception('Auth failed')
+        self.check()
+        self.assertEqual({'down': 1}, self.supervisor.stats())
+
+    def test_gerrits_connected_in_parallel(self):
+        """A gerrit that's slow to connect doesn't hold up the others."""
+        release = threading.Event()
+        connected = []
+
+        def connect(gerrit_cfg):
+            if gerrit_cfg['name'] == 'slow':
+                release.wait(5)
+            connected.append(gerrit_cfg['name'])
+            gerrit_cfg['client'].is_active.return_value = True
+            return True
+
+        for name in ('fast', 'slow'):
+            client = Mock()
+            client.is_active.return_value = False
+            self.gerrits[name] = {'name': name, 'client': client}
+        self.supervisor.configure(Mock(gerrits=self.gerrits, reconnect={}))
+        self.supervisor.connect = connect
+        threads = self.supervisor.check_connections()
+        for thread in threads:
+            if thread.name != 'connect-slow':
+                thread.join(5)
+        self.assertEqual(['down', 'fast'], sorted(connected))
+        # still connecting, so not tried again
+        self.assertEqual([], self.supervisor.check_connections())
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(['down', 'fast', 'slow'], sorted(connected))
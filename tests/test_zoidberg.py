@@ -1,13 +1,20 @@
 import logging
 import os
+import shutil
 import socket
+import tempfile
 import testtools
+import time
 import yaml
+from concurrent.futures import Future
 from mock import ANY, Mock, patch
 from weakref import WeakKeyDictionary
 from zoidberg.zoidberg import Zoidberg # woop woop woop
 from zoidberg import actions
 from zoidberg import configuration
+from zoidberg import engine
+from zoidberg import exceptions
+from zoidberg import parser
 
 
 class CountdownToFalse(object):
@@ -35,12 +42,14 @@ class CountdownToFalse(object):
 
 class TestableZoidberg(Zoidberg):
     running = CountdownToFalse(1)
+    idle_timeout = 0
 
 
 class ZoidbergTestCase(testtools.TestCase):
     def setUp(self):
         super(ZoidbergTestCase, self).setUp()
         self.zoidberg = TestableZoidberg('./tests/etc/zoidberg.yaml')
+        self.addCleanup(self.zoidberg.dispatcher.shutdown)
 
     def _setup_process_loop(self, run_times=1):
         # only run the inner loop in process_loop run_times
@@ -48,13 +57,13 @@ class ZoidbergTestCase(testtools.TestCase):
 
     @patch.object(TestableZoidberg, 'load_config')
     @patch.object(TestableZoidberg, 'config_file_has_changed')
-    @patch.object(TestableZoidberg, 'enqueue_failed_events')
+    @patch.object(TestableZoidberg, 'release_retries')
     @patch.object(TestableZoidberg, 'process_event')
     @patch.object(TestableZoidberg, 'get_event')
     @patch.object(TestableZoidberg ,'process_startup_tasks')
     def test_process_loop_startup_tasks(
             self, mock_pst, mock_get_event, mock_process_event,
-            mock_enqueue_failed_events, mock_config_file_has_changed,
+            mock_release_retries, mock_config_file_has_changed,
             mock_load_config):
         """
         Check the process loop calls process_startup_tasks
@@ -67,36 +76,36 @@ class ZoidbergTestCase(testtools.TestCase):
 
     @patch.object(TestableZoidberg, 'load_config')
     @patch.object(TestableZoidberg, 'config_file_has_changed')
-    @patch.object(TestableZoidberg, 'enqueue_failed_events')
+    @patch.object(TestableZoidberg, 'release_retries')
     @patch.object(TestableZoidberg, 'process_event')
     @patch.object(TestableZoidberg, 'get_event')
     @patch.object(TestableZoidberg ,'process_startup_tasks')
-    def test_process_loop_enqueues_failed_events(
+    def test_process_loop_releases_retries(
             self, mock_pst, mock_get_event, mock_process_event,
-            mock_enqueue_failed_events, mock_config_file_has_changed,
+            mock_release_retries, mock_config_file_has_changed,
             mock_load_config):
         """
         Each processing loop should pass each gerrit config to
-        enqueue_failed_events.
+        release_retries.
         """
         self._setup_process_loop(1)
         mock_get_event.return_value = False
         self.zoidberg.process_loop()
-        mock_enqueue_failed_events.assert_any_call(
+        mock_release_retries.assert_any_call(
             self.zoidberg.config.gerrits['master'])
-        mock_enqueue_failed_events.assert_any_call(
+        mock_release_retries.assert_any_call(
             self.zoidberg.config.gerrits['thirdparty'])
-        self.assertEqual(2, mock_enqueue_failed_events.call_count)
+        self.assertEqual(2, mock_release_retries.call_count)
 
     @patch.object(TestableZoidberg, 'load_config')
     @patch.object(TestableZoidberg, 'config_file_has_changed')
-    @patch.object(TestableZoidberg, 'enqueue_failed_events')
+    @patch.object(TestableZoidberg, 'release_retries')
     @patch.object(TestableZoidberg, 'process_event')
     @patch.object(TestableZoidberg, 'get_event')
     @patch.object(TestableZoidberg ,'process_startup_tasks')
     def test_process_loop_get_event_passed_to_process_event(
             self, mock_pst, mock_get_event, mock_process_event,
-            mock_enqueue_failed_events, mock_config_file_has_changed,
+            mock_release_retries, mock_config_file_has_changed,
             mock_load_config):
         """
         Each processing loop should get an event for the gerrit
@@ -114,13 +123,13 @@ class ZoidbergTestCase(testtools.TestCase):
 
     @patch.object(TestableZoidberg, 'load_config')
     @patch.object(TestableZoidberg, 'config_file_has_changed')
-    @patch.object(TestableZoidberg, 'enqueue_failed_events')
+    @patch.object(TestableZoidberg, 'release_retries')
     @patch.object(TestableZoidberg, 'process_event')
     @patch.object(TestableZoidberg, 'get_event')
     @patch.object(TestableZoidberg ,'process_startup_tasks')
     def test_process_loop_triggers_config_reload(
             self, mock_pst, mock_get_event, mock_process_event,
-            mock_enqueue_failed_events, mock_config_file_has_changed,
+            mock_release_retries, mock_config_file_has_changed,
             mock_load_config):
         """
         The process loop should check if the config file has
@@ -132,6 +141,56 @@ class ZoidbergTestCase(testtools.TestCase):
         self.zoidberg.process_loop()
         mock_load_config.assert_called_once_with('./tests/etc/zoidberg.yaml')
 
+    @patch.object(TestableZoidberg, 'process_event')
+    @patch.object(TestableZoidberg, 'get_event')
+    def test_process_events_round_robin(
+            self, mock_get_event, mock_process_event):
+        """
+        process_events should take events from each gerrit in turn,
+        rather than draining one gerrit before moving on to the next.
+        """
+        queued = {
+            'master': ['m1', 'm2', 'm3'],
+            'thirdparty': ['t1'],
+        }
+
+        def get_event(gerrit_cfg, timeout):
+            if queued[gerrit_cfg['name']]:
+                return queued[gerrit_cfg['name']].pop(0)
+
+        mock_get_event.side_effect = get_event
+        self.zoidberg.process_events(['master', 'thirdparty'])
+        self.assertEqual(
+            ['m1', 't1', 'm2', 'm3'],
+            [c[0][0] for c in mock_process_event.call_args_list])
+        self.assertFalse(self.zoidberg.events_ready.is_set())
+
+    @patch.object(TestableZoidberg, 'process_event')
+    @patch.object(TestableZoidberg, 'get_event')
+    def test_process_events_gives_other_work_a_turn(
+            self, mock_get_event, mock_process_event):
+        """
+        process_events should stop after max_events_per_pass events, and
+        make sure the next wait for events does not block.
+        """
+        self.zoidberg.max_events_per_pass = 2
+        mock_get_event.return_value = 'Event'
+        self.zoidberg.events_ready.clear()
+        self.zoidberg.process_events(['master', 'thirdparty'])
+        self.assertEqual(2, mock_process_event.call_count)
+        self.assertTrue(self.zoidberg.events_ready.is_set())
+
+    def test_clients_wake_up_event_wait(self):
+        """
+        Queuing an event on any client wakes up a wait for events.
+        """
+        self.zoidberg.events_ready.clear()
+        client = self.zoidberg.config.gerrits['thirdparty']['client']
+        client.event_filter = None
+        client.queue_event('{"type": "orsm-event"}')
+        self.zoidberg.wait_for_events(timeout=None)
+        self.assertFalse(self.zoidberg.events_ready.is_set())
+
     def test_queue_startup_tasks(self):
         """
         Gerrit configurations that have startup tasks should
@@ -148,36 +207,74 @@ class ZoidbergTestCase(testtools.TestCase):
     @patch.object(actions.SyncBranchAction, 'startup')
     def test_process_startup_tasks(self, mock_startup):
         """
-        Queued startup tasks should have their action instantiated
-        and startup called.
+        Queued startup tasks should be run in the background, with their
+        action instantiated and startup called.
         """
         gerrit_config = self.zoidberg.config.gerrits['master']
         task = gerrit_config['startup'][0]
         mock_startup.return_value = True
         self.zoidberg.queue_startup_tasks(gerrit_config)
         self.zoidberg.process_startup_tasks()
-        mock_startup.assert_called_once_with(
-            self.zoidberg.config, task, gerrit_config)
         self.assertEqual(
             0,
             self.zoidberg.startup_tasks.qsize())
+        self.zoidberg.startup.shutdown()
+        mock_startup.assert_called_once_with(
+            self.zoidberg.config, task, gerrit_config)
+        self.assertEqual(1, self.zoidberg.startup.stats()['done'])
 
     @patch.object(actions.SyncBranchAction, 'startup')
-    def test_process_startup_tasks_requeues_failed(self, mock_startup):
+    def test_process_startup_tasks_retries_failed(self, mock_startup):
         """
-        Queued startup tasks that fail to run should be requeued.
+        Queued startup tasks that fail to run should wait to be retried.
         """
         gerrit_config = self.zoidberg.config.gerrits['master']
-        task = gerrit_config['startup'][0]
         mock_startup.return_value = False
         self.zoidberg.queue_startup_tasks(gerrit_config)
         self.zoidberg.process_startup_tasks()
+        self.zoidberg.startup.shutdown()
+        self.assertEqual(1, self.zoidberg.startup.stats()['retried'])
+
+    @patch.object(actions.SyncBranchAction, 'startup')
+    def test_process_startup_tasks_splits_projects(self, mock_startup):
+        """
+        Startup tasks for several projects run once for each project.
+        """
+        gerrit_config = self.zoidberg.config.gerrits['master']
+        task = dict(gerrit_config['startup'][0], projects=['stuff', 'other'])
+        mock_startup.return_value = True
+        self.zoidberg.startup_tasks.put(
+            {'task': task, 'source': gerrit_config})
+        self.zoidberg.process_startup_tasks()
+        self.zoidberg.startup.shutdown()
         self.assertEqual(
-            1,
-            self.zoidberg.startup_tasks.qsize())
+            [['stuff'], ['other']],
+            sorted([c[0][1]['projects'] for c in mock_startup.call_args_list],
+                   reverse=True))
+
+    @patch.object(TestableZoidberg, '_run_action')
+    def test_run_action_uses_target_pool(self, mock_run_action):
+        """
+        run_action should queue the action on the worker pool for the
+        action's target gerrit.
+        """
+        gerrit_cfg = self.zoidberg.config.gerrits['master']
+        action_cfg = gerrit_cfg['events']['ref-updated'][0]
+        pool = self.zoidberg.dispatcher.pools['thirdparty']
+        self.zoidberg.run_action(action_cfg, 'Event', gerrit_cfg)
+        pool.shutdown()
+        mock_run_action.assert_called_once_with(
+            action_cfg, 'Event', gerrit_cfg, 0)
+
+    def test_worker_pools_configured(self):
+        """
+        Every gerrit gets a worker pool sized from its configuration.
+        """
         self.assertEqual(
-            {'task': task, 'source': gerrit_config},
-            self.zoidberg.startup_tasks.get())
+            ['master', 'thirdparty'],
+            sorted(self.zoidberg.dispatcher.pools.keys()))
+        self.assertEqual(2, self.zoidberg.dispatcher.pools['master'].size)
+        self.assertEqual(1, self.zoidberg.dispatcher.pools['thirdparty'].size)
 
     @patch.object(TestableZoidberg ,'queue_startup_tasks')
     def test_connect_client(self, mock_queue_startup_tasks):
@@ -191,10 +288,11 @@ class ZoidbergTestCase(testtools.TestCase):
         mock_client = Mock()
         gerrit_cfg['client'] = mock_client
         mock_client.is_active.return_value = False
+        mock_client.last_event_created_on = None
         self.zoidberg.connect_client(gerrit_cfg)
         mock_client.activate_ssh.assert_called_once_with(
             hostname=gerrit_cfg['host'], username=gerrit_cfg['username'],
-            key_filename=gerrit_cfg['key_filename'], port=29418)
+            key_filename=gerrit_cfg['key_filename'], port=29418, timeout=30)
         mock_queue_startup_tasks.assert_called_once_with(gerrit_cfg)
 
     @patch.object(TestableZoidberg ,'queue_startup_tasks')
@@ -228,6 +326,63 @@ class ZoidbergTestCase(testtools.TestCase):
         self.assertEqual(1, mock_client.activate_ssh.call_count)
         self.assertEqual(0, mock_queue_startup_tasks.call_count)
 
+    @patch.object(TestableZoidberg, 'queue_startup_tasks')
+    def test_reconnect_backfills(self, mock_queue_startup_tasks):
+        """
+        Reconnecting soon after the last event backfills what was missed
+        instead of running the startup tasks.
+        """
+        gerrit_cfg = self.zoidberg.config.gerrits['master']
+        mock_client = Mock()
+        gerrit_cfg['client'] = mock_client
+        mock_client.is_active.return_value = False
+        since = int(time.time()) - 30
+        mock_client.last_event_created_on = since
+        with patch.object(engine.get_engine(), 'submit') as mock_submit:
+            self.zoidberg.connect_client(gerrit_cfg)
+        mock_submit.assert_called_once_with(
+            self.zoidberg.backfill, gerrit_cfg, since, ANY)
+        # only what was missed before the stream started again, give or
+        # take the clocks not agreeing, and anything the stream sends up
+        # to then is checked for duplicates
+        until = mock_submit.call_args[0][3]
+        self.assertTrue(until >= since + 30 + 60)
+        self.assertEqual(until, mock_client.dedupe_until)
+        self.assertEqual(0, mock_queue_startup_tasks.call_count)
+
+        # too long ago to be worth it
+        mock_client.last_event_created_on = since - 7200
+        self.zoidberg.connect_client(gerrit_cfg)
+        mock_queue_startup_tasks.assert_called_once_with(gerrit_cfg)
+
+    def test_backfill_queues_missed_events(self):
+        gerrit_cfg = self.zoidberg.config.gerrits['master']
+        client = gerrit_cfg['client']
+        change = parser.parse(
+            '{"project": "stuff", "branch": "master", "status": "MERGED", '
+            '"lastUpdated": 130, "patchSets": [{"number": 1, '
+            '"revision": "abc", "ref": "refs/changes/1", "createdOn": 90}]}')
+        with patch.object(client, 'query', return_value=[change]):
+            self.zoidberg.backfill(gerrit_cfg, 100, 200)
+        event = client.get_event(timeout=0)
+        self.assertEqual('ref-updated', event.type)
+        self.assertEqual('master', event.refUpdate.refname)
+        self.assertEqual(None, client.get_event(timeout=0))
+
+    def test_backfill_query(self):
+        """
+        The backfill asks gerrit for the changes updated since the last
+        event, with a minute's slack.
+        """
+        gerrit_cfg = self.zoidberg.config.gerrits['master']
+        client = gerrit_cfg['client']
+        with patch.object(client, 'run_command', return_value=[]) as mock_run:
+            with patch('time.time', return_value=1000):
+                self.zoidberg.backfill(gerrit_cfg, 900, 1000)
+        mock_run.assert_called_once_with(
+            'query --format=JSON --patch-sets --comments --start 0 '
+            'NOT age:160s limit:100')
+
     @patch.object(TestableZoidberg ,'connect_client')
     def test_invalid_configurations(self, mock_connect_client):
         """
@@ -244,16 +399,38 @@ class ZoidbergTestCase(testtools.TestCase):
                 existing_config, self.zoidberg.config, config_file)
 
     @patch.object(TestableZoidberg, 'connect_client')
-    def test_get_client_connects_client_if_not_active(
-            self, mock_connect_client):
-        """If the client is not active, have connect_client connect it."""
+    def test_get_client_does_not_connect(self, mock_connect_client):
+        """
+        The main loop never waits on connecting, the supervisor is left
+        to connect clients that aren't active.
+        """
         mock_client = Mock()
         gerrit_cfg = self.zoidberg.config.gerrits['master']
         gerrit_cfg['client'] = mock_client
         mock_client.is_active.return_value = False
-        self.zoidberg.get_client(gerrit_cfg)
-        self.assertEqual(1, mock_client.is_active.call_count)
-        mock_connect_client.assert_called_once_with(gerrit_cfg)
+        self.assertIs(mock_client, self.zoidberg.get_client(gerrit_cfg))
+        self.assertEqual(0, mock_connect_client.call_count)
+
+    def test_supervisor_watches_gerrits(self):
+        self.assertEqual(
+            ['master', 'thirdparty'],
+            sorted(self.zoidberg.supervisor.gerrits.keys()))
+
+    def test_load_config_rebuilds_prefilters(self):
+        """
+        Loading configuration gives every client a prefilter built from
+        that configuration, including clients reused from the old one.
+        """
+        client = self.zoidberg.config.gerrits['master']['client']
+        old_filter = client.event_filter
+        self.assertEqual(
+            frozenset(['ref-updated']), old_filter.event_types)
+        self.zoidberg.load_config('./tests/etc/zoidberg.yaml')
+        client = self.zoidberg.config.gerrits['master']['client']
+        self.assertIsNot(old_filter, client.event_filter)
+        self.assertIs(
+            self.zoidberg.config.gerrits['master']['project_re'],
+            client.event_filter.project_re)
 
     def test_plugins_loaded(self):
         """
@@ -279,13 +456,13 @@ class ZoidbergTestCase(testtools.TestCase):
 
     @patch.object(TestableZoidberg, 'load_config')
     @patch.object(TestableZoidberg, 'config_file_has_changed')
-    @patch.object(TestableZoidberg, 'enqueue_failed_events')
+    @patch.object(TestableZoidberg, 'release_retries')
     @patch.object(TestableZoidberg, 'process_event')
     @patch.object(TestableZoidberg, 'get_event')
     @patch.object(TestableZoidberg ,'process_startup_tasks')
     def test_faulty_processing_does_not_crash_zoidberg(
             self, mock_pst, mock_get_event, mock_process_event,
-            mock_enqueue_failed_events, mock_config_file_has_changed,
+            mock_release_retries, mock_config_file_has_changed,
             mock_load_config):
         """
         Each processing loop should get an event for the gerrit
@@ -318,3 +495,146 @@ class ZoidbergTestCase(testtools.TestCase):
         # check the client has changed
         client = self.zoidberg.config.gerrits['master']['client']
         self.assertEqual(None, getattr(client, 'marker', None))
+
+
+class JournalTestCase(testtools.TestCase):
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.journal_path = os.path.join(self.tmp, 'journal')
+        cfg = yaml.load(open('./tests/etc/zoidberg.yaml'))
+        cfg.append({'journal': {
+            'path': self.journal_path, 'sync-interval-ms': 0}})
+        self.config_file = os.path.join(self.tmp, 'zoidberg.yaml')
+        yaml.dump(cfg, open(self.config_file, 'w'))
+
+    def make_zoidberg(self):
+        zoidberg = TestableZoidberg(self.config_file)
+        self.addCleanup(zoidberg.dispatcher.shutdown)
+        self.addCleanup(zoidberg.journal.close)
+        return zoidberg
+
+    @patch.object(actions.Action, 'run')
+    def test_unfinished_events_replayed(self, mock_run):
+        """
+        Events still queued when zoidberg stops are queued again when
+        it starts, and are done with once their actions have run.
+        """
+        event = (
+            '{"type": "ref-updated", "refUpdate": {"project": "stuff", '
+            '"refname": "refs/heads/master"}}')
+        zoidberg = self.make_zoidberg()
+        zoidberg.config.gerrits['master']['client'].queue_event(event)
+        self.assertEqual(1, zoidberg.journal.stats()['unfinished'])
+        zoidberg.journal.close()
+
+        zoidberg = self.make_zoidberg()
+        self.assertEqual(1, zoidberg.journal.stats()['unfinished'])
+        zoidberg.process_events(['master'])
+        zoidberg.dispatcher.shutdown()
+        self.assertEqual(1, mock_run.call_count)
+        self.assertEqual(0, zoidberg.journal.stats()['unfinished'])
+
+    @patch.object(actions.Action, 'run')
+    def test_event_kept_until_action_finishes(self, mock_run):
+        """
+        Actions that finish later, like coalesced comments, keep their
+        event in the journal until they have.
+        """
+        finished = Future()
+        mock_run.return_value = finished
+        zoidberg = self.make_zoidberg()
+        zoidberg.config.gerrits['master']['client'].queue_event(
+            '{"type": "ref-updated", "refUpdate": {"project": "stuff", '
+            '"refname": "refs/heads/master"}}')
+        zoidberg.process_events(['master'])
+        zoidberg.dispatcher.shutdown()
+        self.assertEqual(1, zoidberg.journal.stats()['unfinished'])
+        finished.set_result(None)
+        self.assertEqual(0, zoidberg.journal.stats()['unfinished'])
+
+
+    @patch.object(TestableZoidberg, 'process_loop')
+    def test_streams_stopped_before_journal_closed(self, mock_process_loop):
+        """
+        Events stop coming in before the journal is closed, so none
+        arrive that it can't record.
+        """
+        zoidberg = self.make_zoidberg()
+        calls = []
+        for name, gerrit_cfg in zoidberg.config.gerrits.items():
+            client = Mock()
+            client.stop_stream.side_effect = (
+                lambda name=name: calls.append('stop %s' % name))
+            gerrit_cfg['client'] = client
+        close = zoidberg.journal.close
+        zoidberg.journal.close = lambda: calls.append('close') or close()
+        with patch.object(zoidberg.supervisor, 'start'), \
+                patch.object(engine.get_engine(), 'shutdown'):
+            zoidberg.run()
+        self.assertEqual(
+            ['stop master', 'stop thirdparty', 'close'],
+            sorted(calls[:2]) + calls[2:])
+
+
+class RetryTestCase(testtools.TestCase):
+    def setUp(self):
+        super(RetryTestCase, self).setUp()
+        self.zoidberg = TestableZoidberg('./tests/etc/zoidberg.yaml')
+        self.addCleanup(self.zoidberg.dispatcher.shutdown)
+        self.gerrit_cfg = self.zoidberg.config.gerrits['master']
+        self.action_cfg = self.gerrit_cfg['events']['ref-updated'][0]
+        self.event = parser.parse(
+            '{"type": "ref-updated", "refUpdate": {"project": "stuff", '
+            '"refname": "master"}}')
+
+    @patch.object(actions.SyncBranchAction, '_do_run')
+    def test_target_down_retried_when_back(self, mock_do_run):
+        """
+        Actions for a target that's down are retried, once, when the
+        target comes back, without going through the event again.
+        """
+        target = self.zoidberg.config.gerrits['thirdparty']['client']
+        target.is_active = Mock(return_value=False)
+        self.zoidberg._run_action(self.action_cfg, self.event, self.gerrit_cfg)
+        self.assertEqual(0, mock_do_run.call_count)
+        self.assertEqual(
+            {'thirdparty': 1}, self.zoidberg.retries.stats()['waiting'])
+
+        self.zoidberg.release_retries(
+            self.zoidberg.config.gerrits['thirdparty'])
+        self.assertEqual(
+            {'thirdparty': 1}, self.zoidberg.retries.stats()['waiting'])
+
+        target.is_active.return_value = True
+        with patch.object(self.zoidberg, 'run_action') as mock_run_action:
+            self.zoidberg.release_retries(
+                self.zoidberg.config.gerrits['thirdparty'])
+        mock_run_action.assert_called_once_with(
+            self.action_cfg, self.event, self.gerrit_cfg, 1)
+        self.assertEqual({}, self.zoidberg.retries.stats()['waiting'])
+
+    @patch.object(actions.SyncBranchAction, '_do_run')
+    def test_other_errors_not_retried(self, mock_do_run):
+        mock_do_run.side_effect = ValueError('Boom!')
+        self.zoidberg.config.gerrits['thirdparty']['client'].is_active = (
+            Mock(return_value=True))
+        self.assertRaises(
+            ValueError, self.zoidberg._run_action, self.action_cfg,
+            self.event, self.gerrit_cfg)
+        self.assertEqual({}, self.zoidberg.retries.stats()['waiting'])
+
+    @patch.object(actions.SyncBranchAction, 'run')
+    def test_later_failures_retried(self, mock_run):
+        """
+        Actions that fail after they've returned, like coalesced comments
+        whose target went down, are retried too.
+        """
+        finished = Future()
+        mock_run.return_value = finished
+        self.zoidberg._run_action(self.action_cfg, self.event, self.gerrit_cfg)
+        self.assertEqual({}, self.zoidberg.retries.stats()['waiting'])
+        finished.set_exception(exceptions.TargetUnavailableError('down'))
+        self.assertEqual(
+            {'thirdparty': 1}, self.zoidberg.retries.stats()['waiting'])
@@ -1,8 +1,22 @@
+import gitcache
 import logging
 import os
+import re
 import stat
-import subprocess
-from exceptions import ActionValidationError
+import tempfile
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dispatcher import event_ordering_key
+from engine import gather, get_engine
+from exceptions import (
+    ActionValidationError, GerritCommandError, GitCommandError,
+    TargetUnavailableError)
+from gitexec import get_executor
+from retry import is_retryable
+from threading import Lock, Timer
+
+# how gerrit review says it doesn't have the revision
+_unknown_revision_re = re.compile(r'no such (change|patch ?set)', re.I)
 
 
 class ActionRegistry(object):
@@ -45,6 +59,10 @@ class Action(object):
         """
         Implement this method on your subclass.
 
+        If the action only finishes later, return a Future that's done
+        when it has, so zoidberg keeps the event in its journal, and can
+        retry the action if the future fails with a retryable error.
+
         event: the event object from pygerrit
         cfg: the whole zoidberg configuration
         action_cfg: the action config dict
@@ -104,15 +122,38 @@ class Action(object):
 
         target_client = cfg.gerrits[action_cfg['target']]['client']
         if not target_client.is_active():
-            # target gerrit isn't up, requeue the event
-            source['client'].store_failed_event(event)
-            return
+            # target gerrit isn't up, zoidberg will retry it later
+            raise TargetUnavailableError(
+                '%s is not connected' % action_cfg['target'])
+
+        return self._do_run(event, cfg, action_cfg, source)
 
-        self._do_run(event, cfg, action_cfg, source)
+
+def ssh_control_dir():
+    """
+    Returns the dir for ssh's shared connection sockets, making it if
+    needed. It's kept short, as socket paths have a small length limit.
+    """
+    path = os.path.join(
+        tempfile.gettempdir(), 'zoidberg-ssh-%d' % os.getuid())
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0700)
+        except OSError:
+            # somebody else made it first
+            pass
+    return path
 
 
 class GitSshAction(Action):
     """Common code to run git+ssh commands."""
+    git_binary = '/usr/bin/git'
+    # what a mirror fetches when it's brought up to date
+    mirror_refspecs = [
+        '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+    _ssh_wrappers = {}
+    _ssh_wrappers_lock = Lock()
+
     def make_ssh_wrapper(self, gerrit):
         """
         Creates a shell script to wrap ssh with the gerrit key.
@@ -121,17 +162,41 @@ class GitSshAction(Action):
         so we have to output a wrapper script around ssh and use the
         GIT_SSH environment variable to use the wrapper script.
 
+        The script has ssh share one connection to the gerrit between git
+        commands, kept open for ssh-control-persist seconds after the
+        last one finishes, so each command doesn't pay for a handshake.
+        It's only written when it's missing or its contents change.
+
         Returns the filename of the script.
         """
         filename = os.path.join(
-            os.getcwd(), '.tmp_ssh_' + gerrit['host'])
-        f = open(filename, 'w')
-        f.write("""#!/bin/bash
-        ssh -o StrictHostKeyChecking=no -i %s $@
-        """ % gerrit['key_filename'])
-        f.close()
-        st = os.stat(filename)
-        os.chmod(filename, st.st_mode | stat.S_IEXEC)
+            os.getcwd(), '.tmp_ssh_' + gerrit['name'])
+        options = ['-o StrictHostKeyChecking=no']
+        control_persist = gerrit.get('ssh-control-persist')
+        if control_persist:
+            options += [
+                '-o ControlMaster=auto',
+                '-o ControlPath=%s' % os.path.join(ssh_control_dir(), '%C'),
+                '-o ControlPersist=%s' % control_persist]
+        script = """#!/bin/bash
+        ssh %s -i %s "$@"
+        """ % (' '.join(options), gerrit['key_filename'])
+
+        with self._ssh_wrappers_lock:
+            if self._ssh_wrappers.get(filename) == script and \
+                    os.path.exists(filename):
+                return filename
+
+            # git may be running the old script, so swap the new one in
+            # rather than writing over it
+            tmp_filename = '%s.%d' % (filename, os.getpid())
+            f = open(tmp_filename, 'w')
+            f.write(script)
+            f.close()
+            st = os.stat(tmp_filename)
+            os.chmod(tmp_filename, st.st_mode | stat.S_IEXEC)
+            os.rename(tmp_filename, filename)
+            self._ssh_wrappers[filename] = script
         return filename
 
     def get_working_dir(self, gerrit, project):
@@ -139,22 +204,170 @@ class GitSshAction(Action):
         return os.path.join(
             os.getcwd(), '%s-%s-tmp' % (gerrit['host'],  project))
 
+    def get_git_url(self, gerrit, project):
+        return 'ssh://%s@%s:%s/%s' % (
+            gerrit['username'], gerrit['host'], gerrit['port'], project)
+
     def _run_cmd(self, cmd, wdir, ssh_wrapper=''):
-        out, err = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            close_fds=True, env={'GIT_SSH': ssh_wrapper},
-            cwd=wdir).communicate()
+        """Runs the command, logging its output, returning its exit code."""
+        returncode, out, errors = get_executor().run(
+            cmd, wdir, {'GIT_SSH': ssh_wrapper})
+        return returncode
 
-        logging.debug(cmd)
-        logging.debug(out)
-        logging.debug(err)
+    def _check_cmd(self, cmd, wdir, ssh_wrapper, message):
+        """
+        Runs the command, logging its output, and raises GitCommandError
+        with the message if it fails.
+        """
+        returncode, out, errors = get_executor().run(
+            cmd, wdir, {'GIT_SSH': ssh_wrapper})
+        if returncode != 0:
+            raise GitCommandError(message, returncode, errors)
+
+    def _read_cmd(self, cmd, wdir, ssh_wrapper=''):
+        """
+        Runs the command, returning its exit code, its output, and the
+        end of its stderr.
+        """
+        return get_executor().run(
+            cmd, wdir, {'GIT_SSH': ssh_wrapper}, capture=True)
+
+    def ls_remote(self, gerrit, project, refs, check=False):
+        """
+        Lists the given refs on the gerrit's project, without fetching
+        anything.
+
+        Returns a dict of ref name to sha for the refs that exist. If the
+        refs could not be listed, raises GitCommandError if check is set,
+        otherwise returns None.
+        """
+        returncode, out, errors = self._read_cmd(
+            [self.git_binary, 'ls-remote', self.get_git_url(gerrit, project)]
+            + refs, os.getcwd(), self.make_ssh_wrapper(gerrit))
+        if returncode != 0:
+            if check:
+                raise GitCommandError(
+                    'Could not list branches of %s on %s'
+                    % (project, gerrit['name']), returncode, errors)
+            return None
+
+        heads = {}
+        for line in out.splitlines():
+            sha, ref = line.split(None, 1)
+            heads[ref] = sha
+        return heads
+
+    def ls_remote_async(self, gerrit, project, refs, check=False):
+        """Runs ls_remote on the engine, returning a future for its heads."""
+        return get_engine().submit(
+            self.ls_remote, gerrit, project, refs, check)
+
+    @contextmanager
+    def mirror(self, cfg, gerrit, project, refspecs=None, wanted=None):
+        """
+        Brings the cached bare mirror of the gerrit's project up to date,
+        and lets the caller read from it, e.g. to push to a target
+
+            with self.mirror(cfg, source, project) as mirror_dir:
+                self.push_from_mirror(mirror_dir, target, ...)
+
+        refspecs are fetched instead of all the branches and tags, if
+        given. If the mirror already has the wanted commit, nothing is
+        fetched, so several targets syncing the same event share a single
+        fetch. Any number of actions can push from a mirror at once.
+        """
+        cache = gitcache.get_cache(cfg.git)
+
+        def update(mirror_dir):
+            if wanted is not None and self.mirror_has(mirror_dir, wanted):
+                logging.debug('%s already has %s' % (mirror_dir, wanted))
+                return
+            self.update_mirror(cache, gerrit, project, mirror_dir, refspecs)
+
+        mirror_dir = cache.mirror_dir(gerrit, project)
+        with cache.use(mirror_dir, update):
+            yield mirror_dir
+
+    def mirror_has(self, mirror_dir, sha):
+        """Checks if the mirror has the commit, without fetching anything."""
+        if not os.path.isdir(mirror_dir):
+            return False
+        return self._run_cmd(
+            [self.git_binary, 'cat-file', '-e', '%s^{commit}' % sha],
+            mirror_dir) == 0
+
+    def update_mirror(self, cache, gerrit, project, mirror_dir, refspecs):
+        """
+        Fetches into the mirror, creating it if it doesn't exist yet and
+        rebuilding it if it turns out to be corrupt.
+        """
+        ssh_wrapper = self.make_ssh_wrapper(gerrit)
+        cmd = [self.git_binary, 'fetch']
+        if refspecs is None:
+            cmd += ['--prune', self.get_git_url(gerrit, project)]
+            cmd += self.mirror_refspecs
+        else:
+            cmd += [self.get_git_url(gerrit, project)] + refspecs
+
+        if not os.path.isdir(mirror_dir):
+            self.init_mirror(mirror_dir)
+
+        try:
+            self._check_cmd(
+                cmd, mirror_dir, ssh_wrapper,
+                'Failed to fetch %s from %s' % (project, gerrit['name']))
+            return
+        except GitCommandError:
+            if not self.mirror_is_corrupt(mirror_dir):
+                # most likely the gerrit is having problems, not the mirror
+                raise
+
+        logging.error('Mirror %s is corrupt, rebuilding it' % mirror_dir)
+        cache.remove(mirror_dir)
+        self.init_mirror(mirror_dir)
+        if refspecs is not None:
+            # a fresh mirror needs its branches as well
+            self._run_cmd(
+                [self.git_binary, 'fetch', self.get_git_url(gerrit, project)]
+                + self.mirror_refspecs, mirror_dir, ssh_wrapper)
+        self._check_cmd(
+            cmd, mirror_dir, ssh_wrapper,
+            'Failed to fetch %s from %s into a rebuilt mirror'
+            % (project, gerrit['name']))
+
+    def init_mirror(self, mirror_dir):
+        if not os.path.isdir(mirror_dir):
+            os.makedirs(mirror_dir)
+        self._run_cmd(
+            [self.git_binary, 'init', '--bare', '--quiet'], mirror_dir)
+
+    def mirror_is_corrupt(self, mirror_dir):
+        return self._run_cmd(
+            [self.git_binary, 'fsck', '--connectivity-only', '--no-dangling'],
+            mirror_dir) != 0
+
+    def push_from_mirror(self, mirror_dir, target, project, refspecs,
+                         force=False):
+        """Pushes refs from a mirror to the same project on the target."""
+        cmd = [self.git_binary, 'push', self.get_git_url(target, project)]
+        cmd += refspecs
+        if force:
+            cmd.append('--force')
+        self._check_cmd(
+            cmd, mirror_dir, self.make_ssh_wrapper(target),
+            'Failed to push %s to %s' % (project, target['name']))
 
     def git(self, git_command, gerrit, project, args=None, branch=None,
             working_dir=None, cleanup=False):
-        """Wrapper around running git commands."""
-        binary = '/usr/bin/git'
-        git_ssh_url = 'ssh://%s@%s:%s/%s' % (
-            gerrit['username'], gerrit['host'], gerrit['port'], project)
+        """
+        Wrapper around running git commands.
+
+        Clones go to a working dir shared by everything working on the
+        gerrit/project, with nothing keeping them apart, so actions that
+        can run at once for the same project should use mirror instead.
+        """
+        binary = self.git_binary
+        git_ssh_url = self.get_git_url(gerrit, project)
 
         if git_command == 'clone':
             # cloning repos is done inside the current zoidberg working dir
@@ -194,32 +407,145 @@ class GitSshAction(Action):
             self._run_cmd(['rm', '-rf', working_dir], working_dir)
 
 
+# gerrit's oldRev/newRev when a branch is created/deleted
+NULL_SHA = '0' * 40
+
+
+def branch_name(refname):
+    """Gerrit sends either a bare branch name, or the full ref."""
+    if refname.startswith('refs/heads/'):
+        return refname[len('refs/heads/'):]
+    return refname
+
+
 @ActionRegistry.register('zoidberg.SyncBranch')
 class SyncBranchAction(GitSshAction):
-    def push_branch_to_target(self, source, target, project, branch):
-        self.git('clone', gerrit=source, project=project, branch=branch)
+    def push_branch_to_target(self, cfg, source, target, project, branch):
+        self.push_branches_to_target(cfg, source, target, project, [branch])
 
-        # working_dir is set explicitly here because we're working inside
-        # a repo cloned from the source gerrit, but running a git command
-        # targeted at the target gerrit
-        self.git(
-            'push', gerrit=target, project=project,
-            args=['%s:refs/heads/%s' % (branch, branch), '--force'],
-            cleanup=True, working_dir=self.get_working_dir(source, project))
+    def push_branches_to_target(self, cfg, source, target, project,
+                                branches):
+        """
+        Syncs the branches with one fetch from the source and one push
+        to the target, however many branches there are.
+        """
+        refs = ['refs/heads/%s' % branch for branch in branches]
+        fetch_refspecs = ['+%s:%s' % (ref, ref) for ref in refs]
+        with self.mirror(
+                cfg, source, project, refspecs=fetch_refspecs) as mirror_dir:
+            self.push_from_mirror(
+                mirror_dir, target, project,
+                ['%s:%s' % (ref, ref) for ref in refs], force=True)
 
     def _do_run(self, event, cfg, action_cfg, source):
         target = cfg.gerrits[action_cfg['target']]
-        branch = event.refUpdate.refname
+        branch = branch_name(event.refUpdate.refname)
         project = event.refUpdate.project
+        old_rev = getattr(event.refUpdate, 'oldRev', None)
+        new_rev = getattr(event.refUpdate, 'newRev', None)
+
+        if new_rev is None:
+            # nothing to go on, sync the whole branch
+            self.push_branch_to_target(cfg, source, target, project, branch)
+        elif new_rev == NULL_SHA:
+            logging.info(
+                'Not syncing deletion of %s in %s' % (branch, project))
+        else:
+            self.push_revision_to_target(
+                cfg, source, target, project, branch, new_rev, old_rev)
+
+    def push_revision_to_target(self, cfg, source, target, project, branch,
+                                new_rev, old_rev=None):
+        """
+        Moves the target's branch to new_rev, unless it's already there.
+
+        The mirror already has the branch's old revision from earlier
+        syncs, so fetching the branch only transfers the new objects.
+
+        If the target's branch is somewhere other than old_rev, the event
+        may be stale, like a retry overtaken by later updates to the
+        branch, so the branch's current head is synced instead of force
+        pushing new_rev over whatever is there now.
+        """
+        ref = 'refs/heads/%s' % branch
+        target_heads = self.ls_remote(target, project, [ref])
+        if target_heads is not None:
+            target_rev = target_heads.get(ref, NULL_SHA)
+            if target_rev == new_rev:
+                logging.debug(
+                    '%s in %s is already at %s on %s'
+                    % (branch, project, new_rev, target['name']))
+                return
+            if old_rev is not None and target_rev != old_rev:
+                logging.info(
+                    '%s in %s is at %s on %s, not %s, syncing its current '
+                    'head instead of %s'
+                    % (branch, project, target_rev, target['name'], old_rev,
+                       new_rev))
+                self.push_branch_to_target(
+                    cfg, source, target, project, branch)
+                return
 
-        self.push_branch_to_target(source, target, project, branch)
+        with self.mirror(
+                cfg, source, project, refspecs=['+%s:%s' % (ref, ref)],
+                wanted=new_rev) as mirror_dir:
+            self.push_from_mirror(
+                mirror_dir, target, project, ['%s:%s' % (new_rev, ref)],
+                force=True)
 
     def _do_startup(self, cfg, action_cfg, source, target):
         projects = action_cfg['projects']
         branches = action_cfg['branches']
+        pushed = failed = 0
+        errors = []
         for project in projects:
-            for branch in branches:
-                self.push_branch_to_target(source, target, project, branch)
+            to_sync = branches
+            try:
+                to_sync = self.branches_to_sync(
+                    source, target, project, branches)
+                if not to_sync:
+                    continue
+                self.push_branches_to_target(
+                    cfg, source, target, project, to_sync)
+                pushed += len(to_sync)
+            except GitCommandError as e:
+                # carry on with the other projects
+                logging.error(str(e))
+                failed += len(to_sync)
+                errors.append(e)
+        skipped = len(projects) * len(branches) - pushed - failed
+        logging.info(
+            'Startup sync from %s to %s: %d branches pushed, %d skipped, '
+            '%d failed'
+            % (source['name'], target['name'], pushed, skipped, failed))
+        if errors:
+            # the startup runner tries again if any of the failures are
+            # worth trying again
+            error = sorted(errors, key=is_retryable, reverse=True)[0]
+            raise GitCommandError(
+                'Startup sync from %s to %s failed for %d branches'
+                % (source['name'], target['name'], failed),
+                error.returncode, error.errors)
+
+    def branches_to_sync(self, source, target, project, branches):
+        """
+        Compares the branch heads on the source and target, and returns
+        the branches that differ. Raises GitCommandError if the source's
+        branches can't be listed.
+        """
+        refs = ['refs/heads/%s' % branch for branch in branches]
+        # both gerrits are asked at once, as each is an ssh round trip
+        source_heads, target_heads = gather([
+            self.ls_remote_async(source, project, refs, check=True),
+            self.ls_remote_async(target, project, refs)])
+
+        # if the target can't tell us, it probably doesn't have the
+        # project yet, so everything needs pushing
+        target_heads = target_heads or {}
+        return [
+            branch for branch, ref in zip(branches, refs)
+            if ref in source_heads
+            and source_heads[ref] != target_heads.get(ref)]
 
 
 @ActionRegistry.register('zoidberg.SyncReviewCode')
@@ -229,23 +555,43 @@ class SyncReviewCodeAction(GitSshAction):
         branch = event.change.branch
         project = event.change.project
         ref = event.patchset.ref
+        revision = getattr(event.patchset, 'revision', None)
         topic = getattr(event.change, 'topic', 'no-topic')
 
-        self.git(
-            'clone', gerrit=source, project=project, branch=branch)
-
-        # fetch the ref submitted
-        self.git('fetch', gerrit=source, project=project, args=[ref])
-
-        # push FETCH_HEAD to the target gerrit and clean up
-        self.git(
-            'push', gerrit=target, project=project,
-            args=['FETCH_HEAD:refs/for/%s/%s' % (branch, topic)],
-            cleanup=True, working_dir=self.get_working_dir(source, project))
+        # fetch the ref submitted into the mirror, unless another target
+        # syncing this patchset already has, and push it from there
+        with self.mirror(
+                cfg, source, project, refspecs=[ref],
+                wanted=revision) as mirror_dir:
+            self.push_from_mirror(
+                mirror_dir, target, project,
+                ['%s:refs/for/%s/%s' % (revision or 'FETCH_HEAD', branch,
+                                        topic)])
+        if revision:
+            # comments for it can go to the target now
+            target['client'].unknown_revisions.discard(revision)
 
 
 @ActionRegistry.register('zoidberg.PropagateComment')
 class PropagateCommentAction(Action):
+    """
+    Posts comments to the same revision on the target gerrit.
+
+    With coalesce-seconds set on the action, comments for a revision that
+    arrive within that many seconds of the first are posted together, in
+    one review command. Each comment's action returns a future that's
+    done once the review has been posted.
+
+    The review is posted from the target's worker pool, in order with
+    the other actions for the change, through dispatch, which zoidberg
+    sets to its ActionDispatcher.dispatch.
+    """
+    # (target name, revision) -> ([messages], [futures], timer), shared
+    # by every instance, since actions are created per event
+    _pending = {}
+    _pending_lock = Lock()
+    dispatch = None
+
     def _do_run(self, event, cfg, action_cfg, source):
         target_gerrit = cfg.gerrits[action_cfg['target']]
         commit = event.patchset.revision
@@ -262,10 +608,104 @@ class PropagateCommentAction(Action):
 
         # prepare the message
         message = u'%s\n\n--------\n\n%s' % (message_header, event.comment)
-        cmd = u'review %s -m "%s"' % (commit, message)
+
+        window = action_cfg.get('coalesce-seconds')
+        if not window:
+            self.post_review(target_gerrit, commit, [message])
+            return
+
+        key = (target_gerrit['name'], commit)
+        posted = Future()
+        with self._pending_lock:
+            if key in self._pending:
+                self._pending[key][0].append(message)
+                self._pending[key][1].append(posted)
+                return posted
+            timer = Timer(
+                window, self.queue_flush,
+                args=(key, target_gerrit, event_ordering_key(event)))
+            timer.daemon = True
+            self._pending[key] = ([message], [posted], timer)
+            timer.start()
+        return posted
+
+    @classmethod
+    def queue_flush(cls, key, target_gerrit, ordering_key):
+        """
+        Hands the comments collected for a revision to the target's
+        worker pool once their window is up.
+        """
+        if cls.dispatch is not None:
+            try:
+                cls.dispatch(
+                    target_gerrit['name'], ordering_key, cls.flush, key,
+                    target_gerrit)
+                return
+            except KeyError:
+                # the target has gone from the configuration
+                pass
+        cls.flush(key, target_gerrit)
+
+    @classmethod
+    def flush(cls, key, target_gerrit):
+        """Posts the comments collected for a revision."""
+        with cls._pending_lock:
+            pending = cls._pending.pop(key, None)
+        if pending is not None:
+            cls._post_pending(target_gerrit, key[1], pending[0], pending[1])
+
+    @classmethod
+    def flush_all(cls, cfg):
+        """Posts every comment still waiting, for when zoidberg stops."""
+        with cls._pending_lock:
+            pending = cls._pending.items()
+            cls._pending.clear()
+        for (target_name, commit), (messages, futures, timer) in pending:
+            timer.cancel()
+            if target_name in cfg.gerrits:
+                cls._post_pending(
+                    cfg.gerrits[target_name], commit, messages, futures)
+            else:
+                for posted in futures:
+                    posted.set_result(None)
+
+    @classmethod
+    def _post_pending(cls, target_gerrit, commit, messages, futures):
+        # whoever ran the actions finds out how it went through the
+        # futures, and retries them if the target was down
+        try:
+            cls.post_review(target_gerrit, commit, messages)
+        except Exception as e:
+            for posted in futures:
+                posted.set_exception(e)
+        else:
+            for posted in futures:
+                posted.set_result(None)
+
+    @classmethod
+    def post_review(cls, target_gerrit, commit, messages):
+        unknown_revisions = target_gerrit['client'].unknown_revisions
+        if commit in unknown_revisions:
+            logging.debug(
+                'Not propagating comments for %s, %s does not have it'
+                % (commit, target_gerrit['name']))
+            return
+
+        # each message keeps its own X-FROM-GERRIT header, and the
+        # first one starts the review, so it's never propagated back
+        cmd = u'review %s -m "%s"' % (commit, u'\n\n'.join(messages))
         # if the comment is for a change the target gerrit does not have,
         # gerrit will tell us that and we just carry on, because it's more
         # efficient to try to submit the comment and fail than to do another
         # gerrit call to see if the change exists and then do the comment
-        # if it does
-        target_gerrit['client'].run_command(cmd)
+        # if it does. We remember that it failed for a while, so the next
+        # comments for it don't have to try.
+        try:
+            target_gerrit['client'].run_command(cmd)
+        except GerritCommandError as e:
+            if e.exit_status is None:
+                # never got as far as gerrit
+                raise
+            if _unknown_revision_re.search(e.error):
+                unknown_revisions.set(commit)
+            logging.info('Comment not propagated: %s' % e.error)
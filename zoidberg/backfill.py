@@ -0,0 +1,103 @@
+import json
+import re
+
+# comments on a patchset start with this, e.g. "Patch Set 3: Code-Review+2"
+_patchset_number_re = re.compile(r'^Patch Set (\d+)')
+
+
+def _account(account):
+    return dict(
+        (k, getattr(account, k)) for k in ('name', 'email', 'username')
+        if hasattr(account, k))
+
+
+def _patchset(patchset):
+    return dict(
+        (k, getattr(patchset, k))
+        for k in ('number', 'revision', 'ref', 'createdOn')
+        if hasattr(patchset, k))
+
+
+def event_identity(data):
+    """
+    Returns what tells a raw JSON event apart from others, the same for
+    an event from the stream and one synthesized from a query, or None
+    for events that aren't synthesized, or can't be told apart.
+    """
+    try:
+        event = json.loads(data)
+        change = event['change']
+        identity = (
+            event['type'], change['project'], str(change['number']),
+            str(event['patchset']['number']))
+    except (ValueError, KeyError, TypeError):
+        return None
+    if event['type'] == 'patchset-created':
+        return identity
+    if event['type'] == 'comment-added':
+        author = event.get('author', {})
+        return identity + (
+            author.get('username') or author.get('email'),
+            event.get('comment'))
+
+
+def synthesize_events(change, since, until=None):
+    """
+    Makes up the stream events a change from a gerrit query would have
+    sent after the time since, up to and including until, in seconds
+    since the epoch. Events after until are left to the event stream.
+
+    The query needs --patch-sets and --comments. Only the events the
+    bundled actions use are made up: patchset-created, comment-added,
+    and a ref-updated without revisions for a merge, which syncs the
+    whole branch.
+    """
+    change_info = {
+        'project': change.project, 'branch': change.branch,
+        'id': getattr(change, 'id', None),
+        'number': getattr(change, 'number', None)}
+    if hasattr(change, 'topic'):
+        change_info['topic'] = change.topic
+
+    def missed(created_on):
+        return created_on > since and (until is None or created_on <= until)
+
+    patchsets = list(getattr(change, 'patchSets', []))
+    by_number = dict((str(p.number), p) for p in patchsets)
+    events = []
+
+    for patchset in patchsets:
+        if missed(getattr(patchset, 'createdOn', 0)):
+            event = {
+                'type': 'patchset-created',
+                'eventCreatedOn': patchset.createdOn,
+                'change': change_info, 'patchset': _patchset(patchset)}
+            if hasattr(patchset, 'uploader'):
+                event['uploader'] = _account(patchset.uploader)
+            events.append(event)
+
+    for comment in getattr(change, 'comments', []):
+        if not missed(comment.timestamp):
+            continue
+        match = _patchset_number_re.match(comment.message)
+        patchset = by_number.get(match.group(1)) if match else None
+        if patchset is None and patchsets:
+            patchset = patchsets[-1]
+        if patchset is None:
+            continue
+        events.append({
+            'type': 'comment-added', 'eventCreatedOn': comment.timestamp,
+            'change': change_info, 'patchset': _patchset(patchset),
+            'author': _account(comment.reviewer),
+            'comment': comment.message})
+
+    # lastUpdated can be later than the merge, so a change updated after
+    # until may have been merged before it, syncing the branch again is
+    # better than missing the merge
+    if getattr(change, 'status', None) == 'MERGED' and \
+            getattr(change, 'lastUpdated', 0) > since:
+        events.append({
+            'type': 'ref-updated', 'eventCreatedOn': change.lastUpdated,
+            'refUpdate': {'project': change.project,
+                          'refname': change.branch}})
+    return events
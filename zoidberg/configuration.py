@@ -32,7 +32,42 @@ class Configuration(object):
             name = gerrit.keys()[0]
             self.gerrits[name] = {
                 'name': name,
-                'port': gerrit[name].get('port', 29418)
+                'port': gerrit[name].get('port', 29418),
+                # seconds to wait for the ssh connection to come up
+                'connect-timeout': gerrit[name].get('connect-timeout', 30),
+                # actions targeting this gerrit run on a pool this size
+                'workers': gerrit[name].get('workers', 1),
+                'worker-queue-size': gerrit[name].get(
+                    'worker-queue-size', 100),
+                # seconds git's ssh connections to this gerrit are kept
+                # open after their last command, 0 to not share them
+                'ssh-control-persist': gerrit[name].get(
+                    'ssh-control-persist', 300),
+                # gerrit commands run at once over the client's
+                # connection, and seconds before one is given up on
+                'command-concurrency': gerrit[name].get(
+                    'command-concurrency', 4),
+                'command-timeout': gerrit[name].get('command-timeout', 60),
+                # seconds to remember revisions this gerrit doesn't have,
+                # so comments for them aren't sent, 0 to always send them
+                'unknown-revision-ttl': gerrit[name].get(
+                    'unknown-revision-ttl', 300),
+                'unknown-revision-cache-size': gerrit[name].get(
+                    'unknown-revision-cache-size', 10000),
+                # events kept in memory waiting to be processed, any
+                # more are spilled to disk
+                'event-queue-size': gerrit[name].get(
+                    'event-queue-size', 10000),
+                'event-queue-spill-dir': gerrit[name].get(
+                    'event-queue-spill-dir'),
+                # after reconnecting within this many seconds of the
+                # last event, query for what was missed instead of
+                # running the startup tasks, 0 to always run them
+                'backfill-max-age': gerrit[name].get(
+                    'backfill-max-age', 3600),
+                # how many cached queries are kept, and for how long
+                'query-cache-size': gerrit[name].get('query-cache-size', 100),
+                'query-cache-ttl': gerrit[name].get('query-cache-ttl', 60),
             }
 
             to_copy = [
@@ -66,6 +101,12 @@ class Configuration(object):
                 self.gerrits[name]['events'][event_type].append(event.copy())
 
         self.plugins = self.get_section(cfg, 'plugins', [])
+        self.engine = self.get_section(cfg, 'engine', {})
+        self.git = self.get_section(cfg, 'git', {})
+        self.journal = self.get_section(cfg, 'journal', {})
+        self.retry = self.get_section(cfg, 'retry', {})
+        self.reconnect = self.get_section(cfg, 'reconnect', {})
+        self.startup_tasks = self.get_section(cfg, 'startup-tasks', {})
 
     def get_section(self, cfg, name, default):
         for section in cfg:
@@ -79,5 +120,5 @@ class Configuration(object):
             # shutting down the event stream also closes the client
             if self.gerrits[gerrit_name]['client'] is not None:
                 logging.info('Shutting down client for %s' % gerrit_name)
-                self.gerrits[gerrit_name]['client'].stop_event_stream()
+                self.gerrits[gerrit_name]['client'].shutdown()
                 logging.info('Shut down client for %s' % gerrit_name)
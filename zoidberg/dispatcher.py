@@ -0,0 +1,122 @@
+import logging
+import zlib
+from Queue import Queue
+from threading import Thread
+
+
+def event_ordering_key(event):
+    """
+    Returns the key that events have to be kept in order by.
+
+    Events for the same change, or for the same ref, get the same key.
+    Returns None for events that don't need to be kept in order.
+    """
+    if hasattr(event, 'change'):
+        change = event.change
+        return 'change %s %s' % (
+            change.project, getattr(change, 'number', None) or change.id)
+    elif hasattr(event, 'refUpdate'):
+        return 'ref %s %s' % (event.refUpdate.project, event.refUpdate.refname)
+    return None
+
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads, each with its own bounded queue.
+
+    Work submitted with the same key always goes to the same worker, so it
+    runs in the order it was submitted, while work with different keys can
+    run in parallel on other workers.
+    """
+    def __init__(self, name, size, queue_size):
+        self.name = name
+        self.size = size
+        self.queue_size = queue_size
+        self.queues = [Queue(queue_size) for _ in range(size)]
+        self.workers = []
+        for i, queue in enumerate(self.queues):
+            worker = Thread(
+                target=self._work, args=(queue,),
+                name='%s-worker-%d' % (name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self, queue):
+        while True:
+            work = queue.get()
+            if work is None:
+                # asked to shut down
+                break
+            func, args = work
+            try:
+                func(*args)
+            except Exception as e:
+                logging.critical('Internal error in %s worker:' % self.name)
+                logging.critical(repr(e))
+
+    def submit(self, key, func, *args):
+        """
+        Queues func(*args) to run on a worker.
+
+        Blocks if the worker's queue is full, so a target that has fallen
+        behind slows down the event loop rather than using up all memory.
+        """
+        if key is None:
+            # no ordering to keep, so pick the least busy worker
+            queue = min(self.queues, key=lambda q: q.qsize())
+        else:
+            index = zlib.crc32(key.encode('utf-8')) % self.size
+            queue = self.queues[index]
+        queue.put((func, args))
+
+    def queue_depths(self):
+        return [queue.qsize() for queue in self.queues]
+
+    def shutdown(self, wait=True):
+        """Stops the workers once they have finished their queued work."""
+        for queue in self.queues:
+            queue.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+class ActionDispatcher(object):
+    """Runs actions on worker pools, one pool per target gerrit."""
+    def __init__(self):
+        self.pools = {}
+
+    def configure(self, config):
+        """Makes sure there's a pool of the configured size for each gerrit."""
+        for gerrit_name in config.gerrits:
+            gerrit_cfg = config.gerrits[gerrit_name]
+            size = gerrit_cfg['workers']
+            queue_size = gerrit_cfg['worker-queue-size']
+            pool = self.pools.get(gerrit_name)
+            if pool is not None:
+                if (pool.size, pool.queue_size) == (size, queue_size):
+                    continue
+                # let the old pool finish up first, otherwise events for
+                # the same change could run out of order
+                pool.shutdown(wait=True)
+
+            logging.info(
+                'Starting %d workers for %s' % (size, gerrit_name))
+            self.pools[gerrit_name] = WorkerPool(gerrit_name, size, queue_size)
+
+        for gerrit_name in self.pools.keys():
+            if gerrit_name not in config.gerrits:
+                self.pools.pop(gerrit_name).shutdown(wait=False)
+
+    def dispatch(self, target_name, key, func, *args):
+        self.pools[target_name].submit(key, func, *args)
+
+    def stats(self):
+        return dict(
+            (name, pool.queue_depths()) for name, pool in self.pools.items())
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+        self.pools = {}
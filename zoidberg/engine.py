@@ -0,0 +1,75 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+DEFAULT_MAX_IN_FLIGHT = 32
+
+
+class Engine(object):
+    """
+    Runs blocking operations, like gerrit commands and git processes, so
+    callers can keep many of them in flight at once.
+
+    Every operation returns a concurrent.futures.Future, which can be
+    waited on, given callbacks, or gathered with other futures. Futures
+    should only be waited on from actions and zoidberg's own threads,
+    never from inside another operation running on the engine.
+    """
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_in_flight)
+        self.in_flight = 0
+        self._lock = Lock()
+
+    def submit(self, func, *args, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def resize(self, max_in_flight):
+        """
+        Changes how many operations can run at once. Operations already
+        running on the old pool are left to finish.
+        """
+        if max_in_flight == self.max_in_flight:
+            return
+        logging.info(
+            'Engine now running up to %d operations at once' % max_in_flight)
+        old_executor = self.executor
+        self.executor = ThreadPoolExecutor(max_in_flight)
+        self.max_in_flight = max_in_flight
+        old_executor.shutdown(wait=False)
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'max': self.max_in_flight}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def gather(futures, timeout=None):
+    """
+    Waits for all the futures and returns their results, in order.
+
+    Raises the exception of the first future that failed.
+    """
+    return [future.result(timeout) for future in futures]
+
+
+_engine = None
+_engine_lock = Lock()
+
+
+def get_engine():
+    """Returns the engine shared by everything in this process."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Engine()
+        return _engine
@@ -4,3 +4,25 @@ class ConfigValidationError(Exception):
 
 class ActionValidationError(ConfigValidationError):
     pass
+
+
+class GitCommandError(Exception):
+    def __init__(self, message, returncode=None, errors=''):
+        super(GitCommandError, self).__init__(message)
+        # None when it's not down to a single git command
+        self.returncode = returncode
+        # the end of git's stderr
+        self.errors = errors
+
+
+class GerritCommandError(Exception):
+    def __init__(self, command, exit_status, error):
+        super(GerritCommandError, self).__init__(
+            '%s failed (exit status %s): %s' % (command, exit_status, error))
+        self.command = command
+        self.exit_status = exit_status
+        self.error = error
+
+
+class TargetUnavailableError(Exception):
+    pass
@@ -1,22 +1,64 @@
 import logging
 import paramiko
+import socket
+import time
 from paramiko import SSHClient
 from paramiko.ssh_exception import SSHException
-from Queue import Empty, Queue
+from Queue import Empty
+from threading import BoundedSemaphore, Lock
+from .backfill import event_identity
+from .cache import TTLCache
+from .engine import get_engine
+from .exceptions import GerritCommandError
 from .parser import parse
+from .prefilter import extract_created_on
+from .spill import SpillingQueue
 from .stream import GerritEventStream
 
 
 class GerritClient(SSHClient):
     def __init__(self):
         super(GerritClient, self).__init__()
-        self.failed_events = []
         self.load_system_host_keys()
         self.set_missing_host_key_policy(paramiko.WarningPolicy())
-        self.event_queue = Queue()
+        # events wait here as JSON, with their journal ids, and are
+        # only parsed when they're taken off
+        self.event_queue = SpillingQueue('events')
         self.event_stream = None
+        # set by zoidberg whenever the configuration is (re)loaded
+        self.event_filter = None
+        self.events_ready = None
+        # when set, events are handed to this instead of being queued
+        self.event_router = None
+        # when set, events are recorded here until they're done with
+        self.journal = None
+        self.gerrit_name = None
+        # when the newest event we've received was created, so we know
+        # what we missed if the stream goes down
+        self.last_event_created_on = None
+        # events created up to this time are checked against the ones
+        # recently queued, so those both streamed and backfilled after a
+        # reconnect are only queued once
+        self.dedupe_until = None
+        self.recent_events = TTLCache(10000, 600)
+        self.duplicates = 0
+        # clients that only run commands don't need their own stream
+        self.streaming = True
+        self.command_timeout = 60
+        self.command_concurrency = 4
+        self._command_slots = BoundedSemaphore(self.command_concurrency)
+        self._command_lock = Lock()
+        self._command_stats = {
+            'count': 0, 'failed': 0, 'running': 0, 'waiting': 0,
+            'total_time': 0.0, 'max_time': 0.0}
+        # revisions this gerrit has told us it doesn't have
+        self.unknown_revisions = TTLCache(10000, 300)
+        # results of queries asked to be cached, by query
+        self.query_cache = TTLCache(100, 60)
+        self.max_cached_query_rows = 1000
 
-    def activate_ssh(self, hostname, username, port, key_filename):
+    def activate_ssh(self, hostname, username, port, key_filename,
+                     timeout=None):
         # record connection details so equality works
         self.port = port
         self.hostname = hostname
@@ -25,38 +67,122 @@ class GerritClient(SSHClient):
 
         self.connect(
             username=username, hostname=hostname, port=port,
-            key_filename=key_filename)
+            key_filename=key_filename, timeout=timeout,
+            banner_timeout=timeout)
         self.get_transport().set_keepalive(30)
-        self.event_stream = GerritEventStream(self)
-        self.event_stream.start()
+        if self.streaming:
+            self.event_stream = GerritEventStream(self)
+            self.event_stream.start()
 
-    def store_failed_event(self, event):
-        """Stores an event so it can be queued later."""
-        self.failed_events.append(event)
+    def queue_event(self, data, journal_id=None):
+        """
+        puts the json in the queue, it's converted to an object when
+        it's taken off
 
-    def enqueue_failed_events(self):
-        for e in self.failed_events:
-            self.event_queue.put(e)
-        self.failed_events = []
+        journal_id is given for events replayed from the journal.
+        """
+        if not data.strip():
+            # what the stream reads once it's closed, raise like parsing
+            # it would, so the stream stops
+            raise ValueError('No event data')
+        created_on = extract_created_on(data)
+        if created_on > self.last_event_created_on:
+            self.last_event_created_on = created_on
+        if self.event_filter is not None and \
+                not self.event_filter.accepts(data):
+            if journal_id is not None:
+                self.journal.done(journal_id)
+            return
+        if self.is_duplicate(data, created_on):
+            logging.debug('Dropping duplicate event %r' % data)
+            self.duplicates += 1
+            if journal_id is not None:
+                self.journal.done(journal_id)
+            return
+        if self.event_router is not None:
+            self.event_router(data)
+            return
+        if self.journal is not None and journal_id is None:
+            journal_id = self.journal.record(self.gerrit_name, data)
+        self.event_queue.put((data, journal_id))
+        self.notify_events_ready()
 
-    def queue_event(self, data):
-        """converts the json to an object, puts it in the queue"""
-        event = parse(data)
-        self.event_queue.put(event)
+    def is_duplicate(self, data, created_on):
+        """
+        Checks if the event was already queued, while a backfill might
+        be making up events the stream also sent.
+        """
+        if self.dedupe_until is None or created_on is None or \
+                created_on > self.dedupe_until:
+            return False
+        identity = event_identity(data)
+        if identity is None:
+            return False
+        if identity in self.recent_events:
+            return True
+        self.recent_events.set(identity)
+        return False
+
+    def notify_events_ready(self):
+        """Wakes up anything waiting for events from any client."""
+        if self.events_ready is not None:
+            self.events_ready.set()
 
     def get_event(self, timeout):
-        try:
-            return self.event_queue.get(timeout=timeout)
-        except Empty:
-            pass
+        while True:
+            try:
+                data, journal_id = self.event_queue.get(timeout=timeout)
+            except Empty:
+                return None
+            try:
+                event = parse(data)
+            except ValueError as e:
+                logging.error('Could not parse event %r: %s' % (data, e))
+                if journal_id is not None:
+                    self.journal.done(journal_id)
+                continue
+            if journal_id is not None:
+                self.journal.track(event, journal_id)
+            return event
 
     def is_active(self):
         transport = self.get_transport()
-        return (
-            self.event_stream and self.event_stream.is_active() and
-            transport and transport.is_active())
+        stream_active = not self.streaming or (
+            self.event_stream and self.event_stream.is_active())
+        return bool(
+            stream_active and transport and transport.is_active())
+
+    def configure_commands(self, concurrency, timeout):
+        """
+        Sets how many commands can run on this gerrit at once, and how
+        many seconds a command can take.
+        """
+        self.command_timeout = timeout
+        if concurrency != self.command_concurrency:
+            # commands already running hold slots in the old semaphore
+            self._command_slots = BoundedSemaphore(concurrency)
+            self.command_concurrency = concurrency
+
+    def _update_command_stats(self, **changes):
+        with self._command_lock:
+            for k, v in changes.items():
+                self._command_stats[k] += v
+
+    def command_stats(self):
+        with self._command_lock:
+            stats = dict(self._command_stats)
+        if stats['count']:
+            stats['avg_time'] = stats['total_time'] / stats['count']
+        return stats
 
     def run_command(self, command):
+        """
+        Runs a gerrit command, returning the lines of output.
+
+        Commands share the client's ssh connection, each on its own
+        channel, and wait for a free slot if too many are running.
+        Raises GerritCommandError if the command can't be run or fails.
+        """
         gerrit_command = "gerrit " + command
 
         try:
@@ -64,15 +190,122 @@ class GerritClient(SSHClient):
         except UnicodeEncodeError:
             gerrit_command = gerrit_command.encode('utf-8')
 
+        slots = self._command_slots
+        self._update_command_stats(waiting=1)
+        slots.acquire()
+        self._update_command_stats(waiting=-1, running=1)
+        start = time.time()
+        try:
+            return self._exec_gerrit_command(gerrit_command)
+        except GerritCommandError:
+            self._update_command_stats(failed=1)
+            raise
+        finally:
+            elapsed = time.time() - start
+            slots.release()
+            logging.debug('%s took %.3fs' % (gerrit_command, elapsed))
+            with self._command_lock:
+                stats = self._command_stats
+                stats['running'] -= 1
+                stats['count'] += 1
+                stats['total_time'] += elapsed
+                stats['max_time'] = max(stats['max_time'], elapsed)
+
+    def _exec_gerrit_command(self, gerrit_command):
+        transport = self.get_transport()
+        if transport is None or not transport.is_active():
+            raise GerritCommandError(gerrit_command, None, 'not connected')
+
         try:
-            stdin, stdout, stderr = self.exec_command(gerrit_command,
-                                                      bufsize=1,
-                                                      timeout=None,
-                                                      get_pty=False)
-        except SSHException as err:
-            logging.error("Command execution error: %s" % err)
-        return stdout.readlines()
+            channel = transport.open_session(timeout=self.command_timeout)
+        except (SSHException, socket.error) as err:
+            raise GerritCommandError(gerrit_command, None, str(err))
+
+        try:
+            channel.settimeout(self.command_timeout)
+            channel.exec_command(gerrit_command)
+            lines = channel.makefile('r').readlines()
+            error = channel.makefile_stderr('r').read()
+            exit_status = channel.recv_exit_status()
+        except (SSHException, socket.error) as err:
+            raise GerritCommandError(gerrit_command, None, str(err))
+        finally:
+            channel.close()
+
+        if exit_status != 0:
+            raise GerritCommandError(
+                gerrit_command, exit_status, error.strip())
+        return lines
+
+    def query(self, query, options=(), page_size=100, cached=False):
+        """
+        Runs a gerrit query, yielding a parsed object for each result.
+
+        Results are fetched a page at a time, as they're needed, so only
+        one page is ever held in memory. With cached set, results of the
+        same query from the last little while are reused, and complete
+        results of up to max_cached_query_rows are kept for next time.
+        """
+        key = (query, tuple(options))
+        if cached:
+            rows = self.query_cache.get(key)
+            if rows is not None:
+                for row in rows:
+                    yield row
+                return
+
+        kept = [] if cached else None
+        start = 0
+        while True:
+            command = 'query --format=JSON %s--start %d %s limit:%d' % (
+                ''.join('%s ' % o for o in options), start, query,
+                page_size)
+            stats = None
+            for line in self.run_command(command):
+                if not line.strip():
+                    continue
+                row = parse(line)
+                row_type = getattr(row, 'type', None)
+                if row_type == 'stats':
+                    stats = row
+                    continue
+                if row_type == 'error':
+                    raise GerritCommandError(command, 1, row.message)
+                if kept is not None:
+                    if len(kept) < self.max_cached_query_rows:
+                        kept.append(row)
+                    else:
+                        # too big to keep around
+                        kept = None
+                yield row
+
+            row_count = getattr(stats, 'rowCount', 0)
+            more = getattr(stats, 'moreChanges', row_count >= page_size)
+            if not row_count or not more:
+                break
+            start += row_count
+
+        if kept is not None:
+            self.query_cache.set(key, kept)
+
+    def run_command_async(self, command):
+        """
+        Runs a gerrit command on the engine, returning a future for the
+        lines of output.
+        """
+        return get_engine().submit(self.run_command, command)
+
+    def stop_stream(self, timeout=5):
+        """
+        Stops queuing events from the stream, leaving the connection up
+        for commands.
+        """
+        if self.event_stream is not None:
+            self.event_stream.stop()
+            if self.event_stream.is_alive():
+                self.event_stream.join(timeout)
 
     def shutdown(self):
-        self.event_stream.stop()
+        self.stop_stream()
         self.close()
+        self.event_queue.close()
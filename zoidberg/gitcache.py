@@ -0,0 +1,193 @@
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+DEFAULT_CACHE_DIR = 'git-cache'
+
+
+class MirrorLock(object):
+    """
+    Lets any number of pushes read from a mirror at once, while fetches,
+    rebuilds and evictions get the mirror to themselves.
+
+    New readers wait behind a writer that's waiting, so a busy mirror
+    can't keep its fetches waiting forever. Readers mustn't take the
+    lock again while they hold it.
+    """
+    def __init__(self):
+        self._condition = Condition(Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_shared(self):
+        with self._condition:
+            while self._writer or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_shared(self):
+        with self._condition:
+            self._readers -= 1
+            self._condition.notify_all()
+
+    def acquire_exclusive(self, blocking=True):
+        with self._condition:
+            if not blocking:
+                if self._writer or self._readers:
+                    return False
+            else:
+                self._writers_waiting += 1
+                try:
+                    while self._writer or self._readers:
+                        self._condition.wait()
+                finally:
+                    self._writers_waiting -= 1
+                    # readers held back by us may go if we don't
+                    self._condition.notify_all()
+            self._writer = True
+            return True
+
+    def release_exclusive(self):
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+    def downgrade(self):
+        """Swaps exclusive access for shared access, without a gap."""
+        with self._condition:
+            self._writer = False
+            self._readers += 1
+            self._condition.notify_all()
+
+
+class MirrorCache(object):
+    """
+    Keeps long-lived bare mirrors of source repositories on disk, one per
+    gerrit and project, so they only need incremental fetches.
+
+    Mirrors are found again when zoidberg restarts. When the cache grows
+    past max_size bytes, the least recently used mirrors are removed.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.sizes = {}
+        self._locks = {}
+        self._lock = Lock()
+        self._scan()
+
+    def _scan(self):
+        """Finds the mirrors left by previous runs."""
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            if dirpath.endswith('.git'):
+                self.sizes[dirpath] = self._measure(dirpath)
+                # don't go looking inside the mirror itself
+                del dirnames[:]
+
+    def _measure(self, mirror_dir):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(mirror_dir):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    # git removed it while we were looking
+                    pass
+        return size
+
+    def mirror_dir(self, gerrit, project):
+        return os.path.join(self.path, gerrit['host'], project + '.git')
+
+    def lock(self, mirror_dir):
+        with self._lock:
+            return self._locks.setdefault(mirror_dir, MirrorLock())
+
+    @contextmanager
+    def use(self, mirror_dir, update):
+        """
+        Runs update(mirror_dir) with the mirror to itself, then lets the
+        caller read from it alongside anybody else reading from it.
+
+        Afterwards, records the mirror's size and when it was used, and
+        evicts old mirrors.
+        """
+        lock = self.lock(mirror_dir)
+        lock.acquire_exclusive()
+        try:
+            update(mirror_dir)
+        except Exception:
+            lock.release_exclusive()
+            raise
+        lock.downgrade()
+
+        try:
+            yield mirror_dir
+        finally:
+            if os.path.isdir(mirror_dir):
+                now = time.time()
+                os.utime(mirror_dir, (now, now))
+                self.sizes[mirror_dir] = self._measure(mirror_dir)
+            else:
+                self.sizes.pop(mirror_dir, None)
+            lock.release_shared()
+        self.evict()
+
+    def total_size(self):
+        return sum(self.sizes.values())
+
+    def evict(self):
+        """Removes least recently used mirrors until we're under max_size."""
+        if not self.max_size:
+            return
+
+        by_last_use = sorted(self.sizes, key=self._last_used)
+        for mirror_dir in by_last_use:
+            if self.total_size() <= self.max_size:
+                return
+            lock = self.lock(mirror_dir)
+            if not lock.acquire_exclusive(blocking=False):
+                # in use right now, it's not the least recently used
+                continue
+            try:
+                logging.info('Evicting git mirror %s' % mirror_dir)
+                self.remove(mirror_dir)
+            finally:
+                lock.release_exclusive()
+
+    def _last_used(self, mirror_dir):
+        try:
+            return os.stat(mirror_dir).st_mtime
+        except OSError:
+            return 0
+
+    def remove(self, mirror_dir):
+        """Deletes a mirror. The caller must hold its exclusive lock."""
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        self.sizes.pop(mirror_dir, None)
+
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def get_cache(git_cfg):
+    """
+    Returns the mirror cache for the 'git' config section.
+
+    Caches are kept for the life of the process, so locks and sizes
+    survive config reloads.
+    """
+    path = os.path.abspath(git_cfg.get('cache-dir', DEFAULT_CACHE_DIR))
+    max_size = git_cfg.get('cache-size-mb')
+    if max_size is not None:
+        max_size = max_size * 1024 * 1024
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = MirrorCache(path, max_size)
+        cache = _caches[path]
+    cache.max_size = max_size
+    return cache
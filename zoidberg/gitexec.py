@@ -0,0 +1,186 @@
+import logging
+import os
+import re
+import select
+import signal
+import subprocess
+import time
+from collections import deque
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from threading import BoundedSemaphore, Lock
+
+DEFAULT_MAX_PROCESSES = 8
+# seconds before a git process is killed
+DEFAULT_TIMEOUT = 1800
+# how much of a git process's output gets logged
+DEFAULT_LOG_LIMIT_KB = 64
+# lines at the end of a git process's stderr that are kept, so failures
+# can tell what went wrong
+ERROR_LINES = 20
+
+# git uses carriage returns for its progress output
+_line_end_re = re.compile(r'[\r\n]')
+
+# starts git in a process group of its own, so a timeout can kill ssh
+# along with it, without running any python in the forked child
+_setsid = find_executable('setsid')
+
+
+class GitExecutor(object):
+    """
+    Runs the git processes for all the git actions.
+
+    Caps how many run at once, so syncing lots of repositories in parallel
+    doesn't swamp the host, streams their output to the log as it comes
+    rather than holding it all in memory, and kills them if they hang.
+
+    Work on any one mirror is kept in order by its lock, see
+    GitSshAction.mirror and gitcache.MirrorLock.
+    """
+    def __init__(self, max_processes=DEFAULT_MAX_PROCESSES):
+        self.max_processes = max_processes
+        self.timeout = DEFAULT_TIMEOUT
+        self.log_limit = DEFAULT_LOG_LIMIT_KB * 1024
+        self._slots = BoundedSemaphore(max_processes)
+        self._lock = Lock()
+        self.running = 0
+        self.waiting = 0
+
+    def configure(self, git_cfg):
+        """Applies the 'git' config section."""
+        self.resize(git_cfg.get('max-processes', DEFAULT_MAX_PROCESSES))
+        self.timeout = git_cfg.get('timeout', DEFAULT_TIMEOUT)
+        self.log_limit = git_cfg.get(
+            'log-limit-kb', DEFAULT_LOG_LIMIT_KB) * 1024
+
+    def resize(self, max_processes):
+        """
+        Changes the cap. Processes already running finish under the old
+        one, new processes wait for the new one.
+        """
+        if max_processes == self.max_processes:
+            return
+        logging.info('Running up to %d git processes at once' % max_processes)
+        self._slots = BoundedSemaphore(max_processes)
+        self.max_processes = max_processes
+
+    @contextmanager
+    def slot(self):
+        """Waits for a free slot, and holds it while a git process runs."""
+        slots = self._slots
+        with self._lock:
+            self.waiting += 1
+        slots.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.running -= 1
+            slots.release()
+
+    def run(self, cmd, cwd, env, capture=False):
+        """
+        Runs the command once there's a slot for it, and returns its exit
+        code, its output if capture is set, and the last lines of its
+        stderr. Output that isn't captured is logged line by line, up to
+        the log limit.
+
+        Commands still running after the timeout are killed, along with
+        anything they started, and get a non-zero exit code.
+        """
+        with self.slot():
+            logging.debug(cmd)
+            process = subprocess.Popen(
+                [_setsid] + cmd if _setsid else cmd,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True, env=env, cwd=cwd)
+            try:
+                out, errors = self._communicate(cmd, process, capture)
+            finally:
+                process.stdout.close()
+                process.stderr.close()
+                process.wait()
+
+        if process.returncode != 0:
+            logging.error(
+                '%s exited with %d' % (' '.join(cmd), process.returncode))
+        return process.returncode, out, errors
+
+    def _communicate(self, cmd, process, capture):
+        deadline = None
+        if self.timeout:
+            deadline = time.time() + self.timeout
+
+        stdout = process.stdout.fileno()
+        stderr = process.stderr.fileno()
+        buffers = {stdout: '', stderr: ''}
+        captured = []
+        errors = deque(maxlen=ERROR_LINES)
+        logged = [0]
+
+        def log_line(line):
+            if not line or logged[0] > self.log_limit:
+                return
+            logged[0] += len(line)
+            if logged[0] > self.log_limit:
+                logging.debug('(not logging any more output)')
+            else:
+                logging.debug(line)
+
+        while buffers:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    logging.error(
+                        '%s still running after %d seconds, killing it'
+                        % (' '.join(cmd), self.timeout))
+                    if _setsid:
+                        # setsid runs git as the group's leader
+                        os.killpg(process.pid, signal.SIGKILL)
+                    else:
+                        process.kill()
+                    break
+
+            ready, _, _ = select.select(list(buffers), [], [], wait)
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if capture and fd == stdout:
+                    captured.append(data)
+                    if not data:
+                        del buffers[fd]
+                    continue
+
+                if not data:
+                    lines = [buffers.pop(fd)]
+                else:
+                    lines = _line_end_re.split(buffers[fd] + data)
+                    buffers[fd] = lines.pop()
+                for line in lines:
+                    log_line(line)
+                    if fd == stderr and line:
+                        errors.append(line)
+
+        return ''.join(captured), '\n'.join(errors)
+
+    def stats(self):
+        return {
+            'running': self.running, 'waiting': self.waiting,
+            'max': self.max_processes}
+
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_executor():
+    """Returns the git executor shared by everything in this process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = GitExecutor()
+        return _executor
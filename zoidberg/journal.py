@@ -0,0 +1,214 @@
+import logging
+import os
+import time
+from threading import Condition, Lock, Thread
+
+DEFAULT_SYNC_INTERVAL_MS = 100
+DEFAULT_COMPACT_AFTER = 10000
+
+
+class EventJournal(object):
+    """
+    An append-only file of the events zoidberg has received but not yet
+    finished with, so they can be replayed if it stops or crashes.
+
+    Each line is either an event being added:
+
+        A <tab> id <tab> gerrit name <tab> event JSON
+
+    or an event being done with:
+
+        D <tab> id
+
+    Lines are written and fsynced in batches by a writer thread, at most
+    once every sync_interval seconds, so receiving events never waits on
+    the disk. Once compact_after events are done with, the file is
+    rewritten with only the unfinished events.
+
+    Events are reference counted: anything that will still do work for
+    an event, like a queue it sits in or an action about to run for it,
+    holds a reference with acquire() and drops it with release(). When
+    the last reference is dropped, the event is done with.
+    """
+    def __init__(self, path, sync_interval=DEFAULT_SYNC_INTERVAL_MS / 1000.0,
+                 compact_after=DEFAULT_COMPACT_AFTER):
+        self.path = os.path.abspath(path)
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        self._lock = Lock()
+        self._wakeup = Condition(self._lock)
+        self._buffer = []
+        self._closing = False
+        # ids of the events not done with yet
+        self._live = set()
+        # id(event) -> [journal id, references, event], the event is
+        # kept here so its id() can't be reused while it's tracked
+        self._tracked = {}
+        self._done_since_compact = 0
+        self.written = 0
+        self.syncs = 0
+        self.write_errors = 0
+
+        self.unfinished = self._load()
+        self._next_id = max([e[0] for e in self.unfinished] or [0]) + 1
+        self._compact()
+        if self.unfinished:
+            logging.info(
+                '%d unfinished events in %s' % (len(self.unfinished), path))
+
+        self._writer = Thread(target=self._write_loop, name='journal')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _load(self):
+        """Reads the events that weren't done with last time, in order."""
+        if not os.path.exists(self.path):
+            return []
+        added = {}
+        with open(self.path) as journal:
+            for line in journal:
+                if not line.endswith('\n'):
+                    # torn by a crash mid write
+                    break
+                fields = line.rstrip('\n').split('\t', 3)
+                try:
+                    if fields[0] == 'A':
+                        added[int(fields[1])] = (
+                            fields[2], fields[3].decode('utf-8'))
+                    elif fields[0] == 'D':
+                        added.pop(int(fields[1]), None)
+                except (IndexError, ValueError):
+                    logging.error('Skipping bad journal line: %r' % line)
+        self._live = set(added)
+        return [
+            (journal_id, gerrit_name, data)
+            for journal_id, (gerrit_name, data) in sorted(added.items())]
+
+    def replay(self):
+        """
+        Returns, once, the (journal id, gerrit name, event JSON) of the
+        events that weren't done with when zoidberg last stopped.
+        """
+        unfinished, self.unfinished = self.unfinished, []
+        return unfinished
+
+    def record(self, gerrit_name, data):
+        """Adds a newly received event, returning its journal id."""
+        if isinstance(data, unicode):
+            # what the stream reads, the file takes bytes
+            data = data.encode('utf-8')
+        with self._lock:
+            journal_id = self._next_id
+            self._next_id += 1
+            self._live.add(journal_id)
+            self._buffer.append(
+                'A\t%d\t%s\t%s\n' % (journal_id, gerrit_name, data.strip()))
+            self._wakeup.notify()
+        return journal_id
+
+    def track(self, event, journal_id):
+        """Ties a parsed event to its journal id, with one reference."""
+        with self._lock:
+            self._tracked[id(event)] = [journal_id, 1, event]
+
+    def acquire(self, event):
+        with self._lock:
+            tracked = self._tracked.get(id(event))
+            if tracked is not None:
+                tracked[1] += 1
+
+    def release(self, event):
+        with self._lock:
+            tracked = self._tracked.get(id(event))
+            if tracked is None:
+                return
+            tracked[1] -= 1
+            if tracked[1] > 0:
+                return
+            del self._tracked[id(event)]
+            self._done(tracked[0])
+
+    def done(self, journal_id):
+        """Marks an event done with, whatever references it has."""
+        with self._lock:
+            self._done(journal_id)
+
+    def _done(self, journal_id):
+        if journal_id not in self._live:
+            return
+        self._live.discard(journal_id)
+        self._done_since_compact += 1
+        self._buffer.append('D\t%d\n' % journal_id)
+        self._wakeup.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                while not self._buffer and not self._closing:
+                    self._wakeup.wait()
+                lines, self._buffer = self._buffer, []
+                closing = self._closing
+                compact = self._done_since_compact >= self.compact_after
+
+            if lines:
+                try:
+                    self._file.write(''.join(lines))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self.written += len(lines)
+                    self.syncs += 1
+                except Exception as e:
+                    # keep going, or nothing after this gets journaled
+                    self.write_errors += 1
+                    logging.error(
+                        'Could not write %d lines to %s: %r'
+                        % (len(lines), self.path, e))
+            if compact:
+                self._compact()
+            if closing and not lines:
+                return
+            # let the next batch build up, so lots of events arriving at
+            # once share an fsync
+            time.sleep(self.sync_interval)
+
+    def _compact(self):
+        """Rewrites the journal with only the unfinished events."""
+        with self._lock:
+            live = set(self._live)
+            self._done_since_compact = 0
+
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as compacted:
+            if os.path.exists(self.path):
+                with open(self.path) as journal:
+                    for line in journal:
+                        if not line.startswith('A\t') or \
+                                not line.endswith('\n'):
+                            continue
+                        try:
+                            journal_id = int(line.split('\t', 2)[1])
+                        except (IndexError, ValueError):
+                            continue
+                        if journal_id in live:
+                            compacted.write(line)
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        os.rename(tmp_path, self.path)
+        self._file = open(self.path, 'a')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'unfinished': len(self._live), 'written': self.written,
+                'syncs': self.syncs, 'write_errors': self.write_errors}
+
+    def close(self):
+        """Writes out anything buffered and stops the writer."""
+        with self._lock:
+            self._closing = True
+            self._wakeup.notify()
+        self._writer.join()
+        self._file.close()
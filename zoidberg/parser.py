@@ -1,9 +1,87 @@
 import json
-from collections import namedtuple
+import re
+
+# gerrit only ever sends a handful of object shapes, but keep the cache
+# bounded in case something starts sending us arbitrary keys
+MAX_CACHED_CLASSES = 1024
+
+# no leading underscore, so keys can't clash with the generated class's
+# own attributes, like _fields or __init__
+_identifier_re = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+_classes = {}
+
+
+class ParsedJsonObject(object):
+    """
+    Base class for objects parsed from JSON.
+
+    Subclasses are generated once per set of keys, and use __slots__
+    so each parsed object is a compact fixed-size record, much like
+    the namedtuples we used to build for every object.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def _asdict(self):
+        return dict(zip(self._fields, self._values()))
+
+    def _values(self):
+        return [getattr(self, f) for f in self._fields]
+
+    def __eq__(self, other):
+        return (
+            type(self) is type(other) and self._values() == other._values())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ParsedJsonObject(%s)' % ', '.join(
+            '%s=%r' % (f, getattr(self, f)) for f in self._fields)
+
+
+def _make_class(fields):
+    def __init__(self, values):
+        for setter, value in zip(setters, values):
+            setter(self, value)
+
+    klazz = type('ParsedJsonObject', (ParsedJsonObject,), {
+        '__slots__': fields,
+        '_fields': fields,
+        '__init__': __init__})
+    setters = [klazz.__dict__[f].__set__ for f in fields]
+    return klazz
+
+
+def _object_hook(d):
+    fields = tuple(d)
+    klazz = _classes.get(fields)
+    if klazz is None:
+        if not all(_identifier_re.match(f) for f in fields):
+            # can't make attributes out of these keys, leave it as a dict
+            return d
+        if len(_classes) >= MAX_CACHED_CLASSES:
+            _classes.clear()
+        klazz = _classes[fields] = _make_class(fields)
+    return klazz(d.values())
 
 
 def parse(data):
-    """Quick, easy, and quite dirty, JSON to object."""
-    return json.loads(
-        data, object_hook=lambda d: namedtuple(
-            'ParsedJsonObject', d.keys())(*d.values()))
+    """
+    JSON to object.
+
+    Objects get attribute access to their keys, using a class cached
+    for each set of keys, so parsing an event doesn't build new types.
+    """
+    return json.loads(data, object_hook=_object_hook)
+
+
+def _default(obj):
+    if isinstance(obj, ParsedJsonObject):
+        return obj._asdict()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def dump(obj):
+    """Object back to JSON, so parse(dump(obj)) == obj."""
+    return json.dumps(obj, default=_default, separators=(',', ':'))
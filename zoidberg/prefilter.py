@@ -0,0 +1,70 @@
+import json
+import re
+
+# these match every "type" and "project" string in an event, nested or
+# not, e.g. approvals have a type too. That's fine, we only drop an event
+# when none of the candidates could match, so we never drop too much.
+_type_re = re.compile(r'"type"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_project_re = re.compile(r'"project"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_created_on_re = re.compile(r'"eventCreatedOn"\s*:\s*(\d+)')
+
+
+def _strings(regexp, data):
+    for value in regexp.findall(data):
+        if '\\' in value:
+            # rare enough that we can afford to let json unescape it
+            value = json.loads('"%s"' % value)
+        yield value
+
+
+def extract_types(data):
+    """Returns all the candidate event types in a raw JSON event."""
+    return list(_strings(_type_re, data))
+
+
+def extract_projects(data):
+    """Returns all the candidate projects in a raw JSON event."""
+    return list(_strings(_project_re, data))
+
+
+def extract_created_on(data):
+    """Returns when gerrit says a raw JSON event happened, if it says."""
+    match = _created_on_re.search(data)
+    if match:
+        return int(match.group(1))
+
+
+class EventPrefilter(object):
+    """
+    Cheaply checks raw stream-events lines against a gerrit config block.
+
+    Events that no configured action could match, because of their type
+    or their project, are counted and dropped before they get decoded.
+    """
+    def __init__(self, gerrit_cfg):
+        self.event_types = frozenset(gerrit_cfg['events'])
+        self.project_re = gerrit_cfg['project_re']
+        self.passed = 0
+        self.dropped = {'type': 0, 'project': 0}
+
+    def accepts(self, data):
+        if not data.strip():
+            # let the parser deal with anything that isn't an event
+            return True
+
+        if not any(t in self.event_types for t in extract_types(data)):
+            self.dropped['type'] += 1
+            return False
+
+        if not any(self.project_re.match(p) for p in extract_projects(data)):
+            self.dropped['project'] += 1
+            return False
+
+        self.passed += 1
+        return True
+
+    def stats(self):
+        return {
+            'passed': self.passed,
+            'dropped_type': self.dropped['type'],
+            'dropped_project': self.dropped['project']}
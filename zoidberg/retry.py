@@ -0,0 +1,201 @@
+import json
+import logging
+import random
+import re
+import time
+from collections import deque
+from threading import Lock
+from .exceptions import (
+    GerritCommandError, GitCommandError, TargetUnavailableError)
+from .parser import dump
+
+DEFAULT_BASE_DELAY = 1
+DEFAULT_MAX_DELAY = 600
+DEFAULT_MAX_ATTEMPTS = 20
+# retries kept in memory for each target
+DEFAULT_MAX_WAITING = 10000
+
+# what git says when it couldn't get through to the gerrit, as opposed to
+# the gerrit refusing what it was asked
+_git_connection_error_re = re.compile(
+    r'could not read from remote repository|remote end hung up|'
+    r'early EOF|connection (refused|reset|closed|timed out)|'
+    r'could not resolve hostname|ssh: connect to host|broken pipe|'
+    r'operation timed out', re.I)
+
+
+def backoff_delay(failures, base_delay, max_delay, jitter=random.random):
+    """
+    Exponential backoff: base_delay doubled for every failure after the
+    first, up to max_delay, then jittered down by up to half, so things
+    that failed together don't all try again together.
+    """
+    delay = min(max_delay, base_delay * 2 ** (failures - 1))
+    return delay / 2.0 + jitter() * delay / 2.0
+
+
+def is_retryable(error):
+    """Is this an error that trying again later could get past?"""
+    if isinstance(error, GerritCommandError):
+        # gerrit said no, asking again won't change its mind
+        return error.exit_status is None
+    if isinstance(error, GitCommandError):
+        if error.returncode is None:
+            # nothing to go on, so give it another go
+            return True
+        # killed for running too long, or the gerrit couldn't be reached,
+        # anything else, like a rejected push, will only fail again
+        return error.returncode < 0 or bool(
+            _git_connection_error_re.search(error.errors))
+    return isinstance(error, TargetUnavailableError)
+
+
+class Retry(object):
+    """Something to try again once its target gerrit is back."""
+    def __init__(self, target_name, action_cfg, event, source, attempts):
+        self.target_name = target_name
+        self.action_cfg = action_cfg
+        self.event = event
+        self.source = source
+        self.attempts = attempts
+
+
+class DeadLetters(object):
+    """
+    Where retries that have run out of attempts end up.
+
+    The most recent are kept in memory, and if a path is configured,
+    every one of them is appended to it as a line of JSON.
+    """
+    def __init__(self, path=None, keep=100):
+        self.path = path
+        self.recent = deque(maxlen=keep)
+        self.count = 0
+        self._lock = Lock()
+
+    def add(self, retry, error):
+        record = {
+            'time': time.time(),
+            'target': retry.target_name,
+            'action': retry.action_cfg['action'],
+            'source': retry.source['name'],
+            'attempts': retry.attempts,
+            'error': str(error),
+            'event': json.loads(dump(retry.event)),
+        }
+        with self._lock:
+            self.count += 1
+            self.recent.append(record)
+            if self.path:
+                with open(self.path, 'a') as dead_letters:
+                    dead_letters.write(json.dumps(record) + '\n')
+
+
+class RetryScheduler(object):
+    """
+    Holds on to actions that failed because their target was down, and
+    hands them back when it's worth trying them again.
+
+    Each target backs off on its own: the delay doubles, with jitter,
+    every time its retries fail again, up to max_delay, and goes back
+    to the start once something succeeds. All the retries waiting for
+    a target are handed back together, as soon as the target is active
+    again or its delay runs out. Retries that fail max_attempts times,
+    or that turn up with max_waiting already waiting for the target,
+    go to the dead letters.
+    """
+    def __init__(self, clock=time.time, jitter=random.random):
+        self.base_delay = DEFAULT_BASE_DELAY
+        self.max_delay = DEFAULT_MAX_DELAY
+        self.max_attempts = DEFAULT_MAX_ATTEMPTS
+        self.max_waiting = DEFAULT_MAX_WAITING
+        self.dead_letters = DeadLetters()
+        self.clock = clock
+        self.jitter = jitter
+        self._lock = Lock()
+        # target name -> [retries]
+        self._waiting = {}
+        # target name -> [failures, next attempt time, target was down]
+        self._backoff = {}
+
+    def configure(self, retry_cfg):
+        """Applies the 'retry' config section."""
+        self.base_delay = retry_cfg.get('base-delay', DEFAULT_BASE_DELAY)
+        self.max_delay = retry_cfg.get('max-delay', DEFAULT_MAX_DELAY)
+        self.max_attempts = retry_cfg.get(
+            'max-attempts', DEFAULT_MAX_ATTEMPTS)
+        self.max_waiting = retry_cfg.get('max-waiting', DEFAULT_MAX_WAITING)
+        self.dead_letters.path = retry_cfg.get('dead-letter-path')
+
+    def delay(self, failures):
+        return backoff_delay(
+            failures, self.base_delay, self.max_delay, self.jitter)
+
+    def schedule(self, retry, error):
+        """
+        Holds on to a retry, returning False if it went to the dead
+        letters instead.
+        """
+        if retry.attempts >= self.max_attempts:
+            logging.error(
+                'Giving up on %s for %s after %d attempts: %s'
+                % (retry.action_cfg['action'], retry.target_name,
+                   retry.attempts, error))
+            self.dead_letters.add(retry, error)
+            return False
+
+        now = self.clock()
+        with self._lock:
+            waiting = self._waiting.setdefault(retry.target_name, [])
+            full = len(waiting) >= self.max_waiting
+            if not full:
+                waiting.append(retry)
+                self._back_off(retry.target_name, error, now)
+        if full:
+            logging.error(
+                'Too many retries waiting for %s, giving up on %s'
+                % (retry.target_name, retry.action_cfg['action']))
+            self.dead_letters.add(retry, error)
+            return False
+        return True
+
+    def _back_off(self, target_name, error, now):
+        backoff = self._backoff.get(target_name)
+        if backoff is None or backoff[1] <= now:
+            # the target's first failure, or the first since its
+            # retries were last handed back, so back off further
+            failures = backoff[0] + 1 if backoff else 1
+            backoff = [failures, now + self.delay(failures), False]
+            self._backoff[target_name] = backoff
+            logging.info(
+                'Retrying actions for %s in %.1fs'
+                % (target_name, backoff[1] - now))
+        if isinstance(error, TargetUnavailableError):
+            backoff[2] = True
+
+    def due(self, target_name, target_active):
+        """Hands back all the retries for a target, if it's time."""
+        with self._lock:
+            if not self._waiting.get(target_name):
+                return []
+            failures, next_attempt, was_down = self._backoff[target_name]
+            came_back = was_down and target_active
+            if not came_back and next_attempt > self.clock():
+                return []
+            # anything failing from here on backs off further
+            self._backoff[target_name] = [failures, 0, False]
+            return self._waiting.pop(target_name)
+
+    def succeeded(self, target_name):
+        """Something worked on the target, so stop backing off."""
+        if target_name in self._backoff:
+            with self._lock:
+                if not self._waiting.get(target_name):
+                    self._backoff.pop(target_name, None)
+
+    def stats(self):
+        with self._lock:
+            waiting = dict(
+                (name, len(retries))
+                for name, retries in self._waiting.items() if retries)
+        return {'waiting': waiting, 'dead_letters': self.dead_letters.count}
@@ -1,6 +1,7 @@
 import argparse
 import logging
 import signal
+import sharding
 import zoidberg
 
 
@@ -14,20 +15,31 @@ def main():
                         action='store_true')
     parser.add_argument('--logfile', default=None,
                         help='File to log to (default: stdout)')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of processes to run actions in, '
+                             'sharded by project (default: 1)')
     options = parser.parse_args()
 
     log_level = logging.INFO
+    log_format = '%(asctime)s %(levelname)s %(message)s'
 
     if options.verbose:
         log_level = logging.DEBUG
 
+    if options.processes > 1:
+        log_format = '%(asctime)s %(processName)s %(levelname)s %(message)s'
+
     if options.logfile:
         logging.basicConfig(filename=options.logfile,
-            format='%(asctime)s %(levelname)s %(message)s', level=log_level)
+            format=log_format, level=log_level)
     else:
-        logging.basicConfig(
-            format='%(asctime)s %(levelname)s %(message)s', level=log_level)
+        logging.basicConfig(format=log_format, level=log_level)
 
-    zoidbergd = zoidberg.Zoidberg(options.config_file)
+    if options.processes > 1:
+        shards = sharding.make_shards(options.config_file, options.processes)
+        zoidbergd = sharding.RouterZoidberg(options.config_file, shards)
+    else:
+        zoidbergd = zoidberg.Zoidberg(options.config_file)
     signal.signal(signal.SIGTERM, zoidbergd.handle_signal)
+    signal.signal(signal.SIGUSR1, zoidbergd.handle_signal)
     zoidbergd.run()
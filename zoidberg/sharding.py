@@ -0,0 +1,168 @@
+import logging
+import multiprocessing
+import signal
+import zlib
+from functools import partial
+from threading import Thread
+from .prefilter import extract_projects
+from .zoidberg import Zoidberg
+
+# events waiting to be picked up by each shard, after which the stream
+# threads wait for the shard to catch up
+SHARD_QUEUE_SIZE = 1000
+
+
+def shard_for(data, shard_count):
+    """
+    Picks the shard for a raw JSON event by hashing its project, so all
+    the events for a project are handled, in order, by one shard.
+    """
+    projects = extract_projects(data)
+    if not projects:
+        # nothing will run for it anyway
+        return 0
+    return zlib.crc32(projects[0].encode('utf-8')) % shard_count
+
+
+class RouterZoidberg(Zoidberg):
+    """
+    Owns the gerrit event streams, and routes every event that gets past
+    the prefilter to the shard process for its project.
+
+    It runs no actions and no startup tasks itself. It does backfill
+    after reconnecting, routing the missed events like any others, and
+    tells the first shard when the startup tasks need running.
+    """
+    def __init__(self, config_file, shards):
+        self.shards = shards
+        super(RouterZoidberg, self).__init__(config_file)
+
+    def setup_client(self, gerrit_cfg):
+        super(RouterZoidberg, self).setup_client(gerrit_cfg)
+        gerrit_cfg['client'].event_router = partial(
+            self.route_event, gerrit_cfg['name'])
+
+    def route_event(self, gerrit_name, data):
+        shard = self.shards[shard_for(data, len(self.shards))]
+        shard.inbox.put((gerrit_name, data))
+
+    def journal_path(self, config):
+        # the shards journal the events routed to them
+        return None
+
+    def queue_startup_tasks(self, gerrit_config):
+        # the first shard runs them, None instead of an event asks it to
+        if self.shards:
+            self.shards[0].inbox.put((gerrit_config['name'], None))
+
+    def process_events(self, gerrit_names):
+        # nothing is queued here, but this is where we'd have noticed a
+        # shard dying, and we can't fork a replacement from a process
+        # with streams running in other threads, so stop everything and
+        # let whatever runs zoidbergd restart us
+        for shard in self.shards:
+            if not shard.is_alive():
+                logging.critical(
+                    'Shard %d exited, shutting down' % shard.index)
+                self.running = False
+
+    def run(self):
+        super(RouterZoidberg, self).run()
+        for shard in self.shards:
+            shard.stop()
+
+
+class ShardZoidberg(Zoidberg):
+    """
+    Runs the actions for the projects that hash to this shard.
+
+    Events come from the router process, so clients here only connect
+    to run commands and never open an event stream of their own. It's
+    the router's streams that decide when to backfill or run startup
+    tasks, not these clients reconnecting.
+    """
+    def __init__(self, config_file, index, inbox):
+        self.index = index
+        self.inbox = inbox
+        super(ShardZoidberg, self).__init__(config_file)
+        self.reader = Thread(target=self.read_inbox, name='shard-inbox')
+        self.reader.daemon = True
+        self.reader.start()
+
+    def setup_client(self, gerrit_cfg):
+        super(ShardZoidberg, self).setup_client(gerrit_cfg)
+        gerrit_cfg['client'].streaming = False
+
+    def journal_path(self, config):
+        path = config.journal.get('path')
+        if path:
+            return '%s.%d' % (path, self.index)
+
+    def read_inbox(self):
+        while True:
+            routed = self.inbox.get()
+            if routed is None:
+                # the router is shutting down
+                self.running = False
+                self.events_ready.set()
+                return
+            gerrit_name, data = routed
+            gerrit_cfg = self.config.gerrits.get(gerrit_name)
+            if gerrit_cfg is None:
+                continue
+            if data is None:
+                # the router reconnected and wants the startup tasks run
+                super(ShardZoidberg, self).queue_startup_tasks(gerrit_cfg)
+            else:
+                gerrit_cfg['client'].queue_event(data)
+
+    def can_backfill(self, gerrit_config, since):
+        # the router backfills, and routes what it finds to us
+        return False
+
+    def queue_startup_tasks(self, gerrit_config):
+        # only when the router asks, see read_inbox
+        pass
+
+
+def run_shard(config_file, index, inbox):
+    # the router tells us when to stop, so it can finish routing first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    zoidbergd = ShardZoidberg(config_file, index, inbox)
+    signal.signal(signal.SIGUSR1, zoidbergd.handle_signal)
+    zoidbergd.run()
+
+
+class Shard(object):
+    """A worker process and the queue of events routed to it."""
+    def __init__(self, config_file, index):
+        self.index = index
+        self.inbox = multiprocessing.Queue(SHARD_QUEUE_SIZE)
+        self.process = multiprocessing.Process(
+            target=run_shard, args=(config_file, index, self.inbox),
+            name='zoidberg-shard-%d' % index)
+
+    def start(self):
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        logging.info('Waiting for shard %d to finish' % self.index)
+        self.inbox.put(None)
+        self.process.join()
+
+
+def make_shards(config_file, count):
+    """
+    Starts count shard processes.
+
+    This has to happen before the router connects to anything, so the
+    shards are forked from a process without any threads running.
+    """
+    shards = [Shard(config_file, i) for i in range(count)]
+    for shard in shards:
+        shard.start()
+    return shards
@@ -0,0 +1,164 @@
+import logging
+import os
+import tempfile
+import time
+from collections import deque
+from Queue import Empty
+from threading import Condition, Lock
+
+DEFAULT_MAX_IN_MEMORY = 10000
+# events per segment file, fully read segments are deleted
+SEGMENT_SIZE = 10000
+
+
+def default_spill_dir():
+    return os.path.join(
+        tempfile.gettempdir(), 'zoidberg-spill-%d' % os.getuid())
+
+
+class _Segment(object):
+    def __init__(self, path):
+        self.path = path
+        self.writer = open(path, 'w')
+        self.reader = None
+        self.written = 0
+        self.read = 0
+
+
+class SpillingQueue(object):
+    """
+    A FIFO queue of (event JSON, journal id) pairs that keeps at most
+    max_in_memory of them in memory, and writes the rest to segment
+    files in spill_dir, reading them back in order as the queue drains.
+
+    Once anything has been spilled, everything after it is spilled too
+    until the spilled events have been read back, so order is kept.
+
+    Spilling is only there to keep memory bounded, the journal is what
+    keeps events across restarts, so spill files are not synced.
+    """
+    def __init__(self, name, max_in_memory=DEFAULT_MAX_IN_MEMORY,
+                 spill_dir=None):
+        self.name = name
+        self.max_in_memory = max_in_memory
+        self.spill_dir = spill_dir or default_spill_dir()
+        self._memory = deque()
+        self._segments = deque()
+        self._sequence = 0
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self.spilled = 0
+        self.spilled_bytes = 0
+
+    def put(self, item):
+        with self._not_empty:
+            if self._segments or len(self._memory) >= self.max_in_memory:
+                self._spill(item)
+            else:
+                self._memory.append(item)
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        """Like Queue.get, raises Empty if nothing turns up in time."""
+        with self._not_empty:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._memory and not self._segments:
+                if timeout is None:
+                    self._not_empty.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Empty
+                self._not_empty.wait(remaining)
+            if not self._memory:
+                self._unspill()
+            return self._memory.popleft()
+
+    def _spill(self, item):
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.written >= SEGMENT_SIZE:
+            if segment is not None:
+                # nothing more goes in it, and it may already be being
+                # read, so _unspill won't flush it again
+                segment.writer.flush()
+            if not os.path.isdir(self.spill_dir):
+                os.makedirs(self.spill_dir, 0o700)
+            self._sequence += 1
+            segment = _Segment(os.path.join(
+                self.spill_dir, '%s-%d-%d.spill'
+                % (self.name, os.getpid(), self._sequence)))
+            self._segments.append(segment)
+            if len(self._segments) == 1:
+                logging.warning(
+                    'Event queue for %s is full, spilling to disk'
+                    % self.name)
+
+        data, journal_id = item
+        if isinstance(data, unicode):
+            # what the stream reads, the file takes bytes
+            data = data.encode('utf-8')
+        line = '%s\t%s\n' % (
+            '' if journal_id is None else journal_id, data.strip())
+        segment.writer.write(line)
+        segment.written += 1
+        self.spilled += 1
+        self.spilled_bytes += len(line)
+
+    def _unspill(self):
+        """Reads the oldest spilled events back into memory."""
+        segment = self._segments[0]
+        if segment.reader is None:
+            segment.writer.flush()
+            segment.reader = open(segment.path)
+        elif segment is self._segments[-1]:
+            # still being written to
+            segment.writer.flush()
+
+        batch = max(1, self.max_in_memory / 2)
+        while len(self._memory) < batch and segment.read < segment.written:
+            journal_id, data = segment.reader.readline().rstrip(
+                '\n').split('\t', 1)
+            self._memory.append((
+                data.decode('utf-8'),
+                int(journal_id) if journal_id else None))
+            segment.read += 1
+
+        if segment.read == segment.written and (
+                segment.written >= SEGMENT_SIZE or len(self._segments) == 1):
+            # all read back, and nothing more will be written to it
+            self._remove(self._segments.popleft())
+            if not self._segments:
+                logging.info(
+                    'Event queue for %s caught up with what it spilled'
+                    % self.name)
+
+    def _remove(self, segment):
+        segment.writer.close()
+        if segment.reader is not None:
+            segment.reader.close()
+        try:
+            os.remove(segment.path)
+        except OSError:
+            pass
+
+    def qsize(self):
+        with self._lock:
+            return len(self._memory) + sum(
+                s.written - s.read for s in self._segments)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def stats(self):
+        with self._lock:
+            on_disk = sum(s.written - s.read for s in self._segments)
+            return {
+                'in_memory': len(self._memory), 'on_disk': on_disk,
+                'spilled': self.spilled, 'spilled_bytes': self.spilled_bytes}
+
+    def close(self):
+        """Throws away anything spilled."""
+        with self._lock:
+            while self._segments:
+                self._remove(self._segments.popleft())
@@ -0,0 +1,160 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from .retry import backoff_delay, is_retryable
+
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_BASE_DELAY = 1
+DEFAULT_MAX_DELAY = 300
+
+
+def split_task(task):
+    """
+    Splits a startup task with a list of projects into one task per
+    project, so each project can be run, and retried, on its own.
+    """
+    projects = task['task'].get('projects')
+    if not isinstance(projects, list) or len(projects) < 2:
+        return [task]
+    return [
+        dict(task, task=dict(task['task'], projects=[project]))
+        for project in projects]
+
+
+def describe(task):
+    name = '%s for %s' % (task['task']['action'], task['source']['name'])
+    projects = task['task'].get('projects')
+    if isinstance(projects, list) and len(projects) == 1:
+        name += ' (%s)' % projects[0]
+    return name
+
+
+class StartupRunner(object):
+    """
+    Runs startup tasks in the background, at most max_concurrent at once,
+    so events keep being processed while a big sync runs.
+
+    run_task(task) runs one task and returns whether it could run. Tasks
+    that couldn't, most likely because their target was down, and tasks
+    that failed with an error worth retrying, are tried again on their
+    own once they've backed off, without rerunning the others.
+    """
+    def __init__(self, run_task, clock=time.time, jitter=random.random):
+        self.run_task = run_task
+        self.clock = clock
+        self.jitter = jitter
+        self.max_concurrent = DEFAULT_MAX_CONCURRENT
+        self.base_delay = DEFAULT_BASE_DELAY
+        self.max_delay = DEFAULT_MAX_DELAY
+        self.executor = ThreadPoolExecutor(self.max_concurrent)
+        self._lock = Lock()
+        # [next attempt time, task], for tasks backing off
+        self._waiting = []
+        # counts since zoidberg started
+        self.total = 0
+        self.queued = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.retried = 0
+
+    def configure(self, startup_cfg):
+        """Applies the 'startup-tasks' config section."""
+        self.base_delay = startup_cfg.get('base-delay', DEFAULT_BASE_DELAY)
+        self.max_delay = startup_cfg.get('max-delay', DEFAULT_MAX_DELAY)
+        max_concurrent = startup_cfg.get(
+            'max-concurrent', DEFAULT_MAX_CONCURRENT)
+        if max_concurrent == self.max_concurrent:
+            return
+        logging.info(
+            'Running up to %d startup tasks at once' % max_concurrent)
+        # tasks already queued on the old executor still run there
+        old_executor = self.executor
+        self.executor = ThreadPoolExecutor(max_concurrent)
+        self.max_concurrent = max_concurrent
+        old_executor.shutdown(wait=False)
+
+    def submit(self, task):
+        with self._lock:
+            self.total += 1
+        self._queue(task)
+
+    def _queue(self, task):
+        with self._lock:
+            self.queued += 1
+        self.executor.submit(self._run, task)
+
+    def _run(self, task):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        logging.info('Running startup task %s' % describe(task))
+        error = None
+        try:
+            has_run = self.run_task(task)
+        except Exception as e:
+            has_run = False
+            error = e
+
+        retry = not has_run and (error is None or is_retryable(error))
+        with self._lock:
+            self.running -= 1
+            if has_run:
+                self.done += 1
+            elif retry:
+                task['attempts'] = task.get('attempts', 0) + 1
+                delay = backoff_delay(
+                    task['attempts'], self.base_delay, self.max_delay,
+                    self.jitter)
+                self._waiting.append([self.clock() + delay, task])
+                self.retried += 1
+            else:
+                self.failed += 1
+
+        if retry:
+            logging.info(
+                'Could not run startup task %s%s, trying again in %.1fs'
+                % (describe(task), ': %s' % error if error else '', delay))
+        elif not has_run:
+            logging.error(
+                'Startup task %s failed: %r' % (describe(task), error))
+        self.log_progress()
+
+    def release_due(self):
+        """Queues the tasks that have backed off long enough to try again."""
+        now = self.clock()
+        with self._lock:
+            due = [task for when, task in self._waiting if when <= now]
+            self._waiting = [w for w in self._waiting if w[0] > now]
+        for task in due:
+            self._queue(task)
+
+    def log_progress(self):
+        stats = self.stats()
+        finished = stats['done'] + stats['failed']
+        if finished == stats['total']:
+            logging.info(
+                'Startup tasks finished: %d done, %d failed'
+                % (stats['done'], stats['failed']))
+        else:
+            logging.info(
+                'Startup tasks: %d of %d finished, %d running, '
+                '%d waiting to retry'
+                % (finished, stats['total'], stats['running'],
+                   stats['waiting']))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'total': self.total, 'queued': self.queued,
+                'running': self.running, 'waiting': len(self._waiting),
+                'done': self.done, 'failed': self.failed,
+                'retried': self.retried}
+
+    def shutdown(self, wait=True):
+        """Stops, dropping the tasks that are waiting to be retried."""
+        with self._lock:
+            self._waiting = []
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,144 @@
+import logging
+import random
+import time
+from threading import Event, Lock, Thread
+from .retry import backoff_delay
+
+DEFAULT_BASE_DELAY = 1
+DEFAULT_MAX_DELAY = 300
+# seconds between checks that the clients are still connected
+CHECK_INTERVAL = 1
+
+
+class ConnectionSupervisor(object):
+    """
+    Keeps the gerrit clients connected from a background thread, so the
+    main loop never waits on a gerrit that's down.
+
+    connect(gerrit_cfg) is called for each client that isn't active,
+    and returns whether it connected. Gerrits are connected in parallel,
+    each on a thread of its own, so a slow one doesn't hold up the rest.
+    Each gerrit backs off on its own while it keeps failing, and starts
+    over once it's connected.
+    """
+    def __init__(self, connect, clock=time.time, jitter=random.random):
+        self.connect = connect
+        self.clock = clock
+        self.jitter = jitter
+        self.base_delay = DEFAULT_BASE_DELAY
+        self.max_delay = DEFAULT_MAX_DELAY
+        self.gerrits = {}
+        # gerrit name -> [failures, next attempt time]
+        self._backoff = {}
+        # gerrits with a connection attempt running
+        self._connecting = set()
+        # gerrits that have connected at least once, for logging how
+        # long it took to be ready
+        self._ready = set()
+        self._all_ready = False
+        self.started = clock()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._thread = None
+
+    def configure(self, config):
+        """Watches the gerrits in a newly loaded configuration."""
+        self.base_delay = config.reconnect.get(
+            'base-delay', DEFAULT_BASE_DELAY)
+        self.max_delay = config.reconnect.get('max-delay', DEFAULT_MAX_DELAY)
+        with self._lock:
+            self.gerrits = dict(config.gerrits)
+            for name in self._backoff.keys():
+                if name not in self.gerrits:
+                    del self._backoff[name]
+        self._wakeup.set()
+
+    def start(self):
+        self.started = self.clock()
+        self._thread = Thread(target=self._run, name='reconnect')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.check_connections()
+            self._wakeup.wait(CHECK_INTERVAL)
+            self._wakeup.clear()
+
+    def check_connections(self):
+        """
+        Starts connecting every inactive client that's due a try, and
+        returns the threads doing it.
+        """
+        with self._lock:
+            gerrits = sorted(self.gerrits.items())
+        threads = []
+        for name, gerrit_cfg in gerrits:
+            if self._stopping.is_set():
+                break
+            with self._lock:
+                if name in self._connecting:
+                    continue
+            if gerrit_cfg['client'].is_active():
+                with self._lock:
+                    self._backoff.pop(name, None)
+                continue
+
+            with self._lock:
+                failures, next_attempt = self._backoff.get(name, (0, 0))
+                if next_attempt > self.clock():
+                    continue
+                self._connecting.add(name)
+            thread = Thread(
+                target=self._attempt, args=(name, gerrit_cfg),
+                name='connect-%s' % name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _attempt(self, name, gerrit_cfg):
+        try:
+            connected = self.connect(gerrit_cfg)
+        except Exception as e:
+            logging.error('Error connecting to %s: %r' % (name, e))
+            connected = False
+
+        with self._lock:
+            self._connecting.discard(name)
+            if connected:
+                self._backoff.pop(name, None)
+                self._log_ready(name)
+                return
+            failures = self._backoff.get(name, (0, 0))[0] + 1
+            delay = backoff_delay(
+                failures, self.base_delay, self.max_delay, self.jitter)
+            self._backoff[name] = (failures, self.clock() + delay)
+        logging.info(
+            'Trying %s again in %.1fs (attempt %d)'
+            % (name, delay, failures + 1))
+
+    def _log_ready(self, name):
+        if name in self._ready:
+            return
+        self._ready.add(name)
+        logging.info(
+            '%s ready %.1fs after starting'
+            % (name, self.clock() - self.started))
+        if not self._all_ready and set(self.gerrits) <= self._ready:
+            self._all_ready = True
+            logging.info(
+                'All %d gerrits ready %.1fs after starting'
+                % (len(self.gerrits), self.clock() - self.started))
+
+    def stats(self):
+        return dict(
+            (name, failures)
+            for name, (failures, next_attempt) in self._backoff.items())
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
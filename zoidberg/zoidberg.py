@@ -21,33 +21,86 @@
 #                                '!!!!!!!!!!!!!!!!!!!!!!!M
 #                                J!!!!!!!!!!!!!!!!!!!!!!!F K!%n.
 import actions
+import backfill
 import importlib
+import json
 import logging
 import os
 import signal
 import socket
+import time
 import yaml
 import configuration
+import engine
+import gitexec
+import journal
+import retry
+import startup
+from concurrent.futures import Future
+from dispatcher import ActionDispatcher, event_ordering_key
+from functools import partial
+from prefilter import EventPrefilter
 from Queue import Queue
+from supervisor import ConnectionSupervisor
+from threading import Event
+
+
+# seconds of slack for gerrit's clock not agreeing with ours
+CLOCK_SLACK = 60
 
 
 class Zoidberg(object):
+    # seconds to wait for events before checking for config changes
+    idle_timeout = 5
+    # most events to process before giving startup tasks and config
+    # changes a turn
+    max_events_per_pass = 100
+
     def __init__(self, config_file):
         self.config = None
+        # every client sets this when it queues an event
+        self.events_ready = Event()
+        self.dispatcher = ActionDispatcher()
+        # coalesced comments are posted on the target's workers too
+        actions.PropagateCommentAction.dispatch = self.dispatcher.dispatch
+        self.journal = None
+        self.retries = retry.RetryScheduler()
+        # connects the clients, and reconnects them when they drop
+        self.supervisor = ConnectionSupervisor(self.connect_client)
+        # runs the startup tasks in the background
+        self.startup = startup.StartupRunner(self.run_startup_task)
         self.load_config(config_file, raise_exception=True)
         self.startup_tasks = Queue()
         self.running = True
 
     def run(self):
+        self.supervisor.start()
         try:
             self.process_loop()
         except KeyboardInterrupt:
             pass
+        self.supervisor.stop()
+
+        # nothing new comes in while we finish up, anything that did
+        # would be missed by the journal
+        for gerrit_name in self.config.gerrits:
+            logging.info('Stopping event stream for %s' % gerrit_name)
+            self.config.gerrits[gerrit_name]['client'].stop_stream()
+
+        logging.info('Waiting for running startup tasks to finish')
+        self.startup.shutdown()
+        logging.info('Waiting for queued actions to finish')
+        self.dispatcher.shutdown()
+        actions.PropagateCommentAction.flush_all(self.config)
+        engine.get_engine().shutdown()
+        if self.journal is not None:
+            # anything still queued is replayed next time
+            self.journal.close()
 
         for gerrit_name in self.config.gerrits:
-            logging.info('Shutting down stream for %s' % gerrit_name)
+            logging.info('Shutting down client for %s' % gerrit_name)
             self.config.gerrits[gerrit_name]['client'].shutdown()
-            logging.info('Shut down stream for %s' % gerrit_name)
+            logging.info('Shut down client for %s' % gerrit_name)
 
     def process_loop(self):
         while self.running:
@@ -56,70 +109,171 @@ class Zoidberg(object):
             gerrit_names = self.config.gerrits.keys()
             gerrit_names.sort()
             for gerrit_name in gerrit_names:
-                logging.debug('Polling %s for events' % gerrit_name)
+                # actions that failed because of connection issues get
+                # tried again once the target is back, or has waited long
+                # enough
+                self.release_retries(self.config.gerrits[gerrit_name])
 
-                # most things are based around these blocks of configuration
-                # which get augmented with useful objects like gerrit clients
-                # and regular expressions
-                gerrit_cfg = self.config.gerrits[gerrit_name]
-
-                # any failed actions due to connection issues get requeued
-                self.enqueue_failed_events(gerrit_cfg)
-
-                event = self.get_event(gerrit_cfg, timeout=1)
-
-                while event:
-                    try:
-                        self.process_event(event, gerrit_cfg)
-                    except Exception, e:
-                        logging.critical('Internal error processing event:')
-                        logging.critical(repr(event))
-                        logging.critical(repr(e))
-                    event = self.get_event(gerrit_cfg, timeout=1)
+            # sleep until any of the gerrits has events for us, waking up
+            # now and again so config changes still get picked up
+            self.wait_for_events(timeout=self.idle_timeout)
+            self.process_events(gerrit_names)
 
             if self.config_file_has_changed():
                 logging.info(
                     'Reloading configuration from %s' % self.config_filename)
                 self.load_config(self.config_filename)
 
-    def process_startup_tasks(self):
-        # keep track of the tasks that could not be run
-        # so we can re-queue them later on
-        could_not_run = []
+    def wait_for_events(self, timeout):
+        """
+        Blocks until one of the clients has queued an event, or until
+        the timeout runs out.
+        """
+        self.events_ready.wait(timeout)
+        # clear before draining, so anything queued while we process
+        # sets the flag again and we don't sleep through it
+        self.events_ready.clear()
+
+    def process_events(self, gerrit_names):
+        """
+        Takes one event at a time from each gerrit in turn, so a busy gerrit
+        can't starve the others, until they're all drained or we've done
+        enough to give startup tasks and config changes a turn.
+        """
+        pending = list(gerrit_names)
+        processed = 0
+        while pending and processed < self.max_events_per_pass:
+            for gerrit_name in list(pending):
+                # most things are based around these blocks of configuration
+                # which get augmented with useful objects like gerrit clients
+                # and regular expressions
+                gerrit_cfg = self.config.gerrits[gerrit_name]
+                event = self.get_event(gerrit_cfg, timeout=0)
+                if not event:
+                    pending.remove(gerrit_name)
+                    continue
+
+                try:
+                    self.process_event(event, gerrit_cfg)
+                except Exception, e:
+                    logging.critical('Internal error processing event:')
+                    logging.critical(repr(event))
+                    logging.critical(repr(e))
+                finally:
+                    if self.journal is not None:
+                        # the queue's reference, the actions have their own
+                        self.journal.release(event)
+                processed += 1
+
+        if pending:
+            # we stopped early, make sure we don't wait before carrying on
+            self.events_ready.set()
 
+    def process_startup_tasks(self):
+        """
+        Hands newly queued startup tasks, and the ones that have backed
+        off long enough, to the startup runner.
+        """
         while not self.startup_tasks.empty():
             task = self.startup_tasks.get(block=False)
-            logging.info(
-                'Running startup task %s for %s'
-                % (task['task']['action'], task['source']['name']))
-
-            # task['task']['action'] will be the name the action is
-            # registered with, e.g. zoidberg.FooSomeBars
-            a = actions.ActionRegistry.get(task['task']['action'])
-            has_run = a().startup(
-                self.config, task['task'], task['source'])
-
-            # if the task could not be run for some reason (most likely
-            # that the target gerrit was down), we want to put it back
-            # in the queue
-            if not has_run:
-                logging.debug(
-                    'Failed running startup task %s for %s'
-                    % (task['task']['action'], task['source']['name']))
-                could_not_run.append(task)
+            for t in startup.split_task(task):
+                self.startup.submit(t)
+        self.startup.release_due()
+
+    def run_startup_task(self, task):
+        """
+        Runs a startup task on one of the startup runner's threads,
+        returning False if it couldn't be run, most likely because the
+        target gerrit was down.
+        """
+        # task['task']['action'] will be the name the action is
+        # registered with, e.g. zoidberg.FooSomeBars
+        a = actions.ActionRegistry.get(task['task']['action'])
+        return a().startup(self.config, task['task'], task['source'])
 
-        # these will be run the next time round, so there's a chance for
-        # failed gerrit clients to get connected again
-        for task in could_not_run:
-            self.startup_tasks.put(task)
+    def run_action(self, action_cfg, event, gerrit_cfg, attempts=0):
+        """
+        Queues the action on the target gerrit's worker pool, keeping it
+        in order with other actions for the same change or ref.
+        """
+        if self.journal is not None:
+            self.journal.acquire(event)
+        self.dispatcher.dispatch(
+            action_cfg['target'], event_ordering_key(event),
+            self._run_action, action_cfg, event, gerrit_cfg, attempts)
 
-    def run_action(self, action_cfg, event, gerrit_cfg):
+    def _run_action(self, action_cfg, event, gerrit_cfg, attempts=0):
         logging.info(
             'Running %s for %s' % (action_cfg['action'], gerrit_cfg['name']))
         a = actions.ActionRegistry.get(action_cfg['action'])
-        a().run(
-            event=event, cfg=self.config, action_cfg=action_cfg,
-            source=gerrit_cfg)
+        release = True
+        try:
+            finished = a().run(
+                event=event, cfg=self.config, action_cfg=action_cfg,
+                source=gerrit_cfg)
+            if isinstance(finished, Future):
+                # the action finishes later, like comments waiting to be
+                # coalesced, and holds on to the event until then
+                release = False
+                finished.add_done_callback(partial(
+                    self._action_finished, action_cfg, event, gerrit_cfg,
+                    attempts))
+            else:
+                self.retries.succeeded(action_cfg['target'])
+        except Exception as e:
+            if not retry.is_retryable(e):
+                raise
+            self._retry_action(action_cfg, event, gerrit_cfg, attempts, e)
+        finally:
+            if release and self.journal is not None:
+                self.journal.release(event)
+
+    def _action_finished(self, action_cfg, event, gerrit_cfg, attempts,
+                         finished):
+        """Called with the future of an action that finished later."""
+        try:
+            error = finished.exception()
+            if error is None:
+                self.retries.succeeded(action_cfg['target'])
+            elif retry.is_retryable(error):
+                self._retry_action(
+                    action_cfg, event, gerrit_cfg, attempts, error)
+            else:
+                logging.critical(
+                    'Internal error in %s:' % action_cfg['action'])
+                logging.critical(repr(error))
+        finally:
+            if self.journal is not None:
+                self.journal.release(event)
+
+    def _retry_action(self, action_cfg, event, gerrit_cfg, attempts, error):
+        logging.warning(
+            '%s for %s failed: %s'
+            % (action_cfg['action'], gerrit_cfg['name'], error))
+        self.schedule_retry(
+            retry.Retry(
+                action_cfg['target'], action_cfg, event, gerrit_cfg,
+                attempts + 1),
+            error)
+
+    def schedule_retry(self, r, error):
+        if self.journal is not None:
+            # the retry holds on to the event until it's tried again
+            self.journal.acquire(r.event)
+        if not self.retries.schedule(r, error) and self.journal is not None:
+            self.journal.release(r.event)
+
+    def release_retries(self, gerrit_cfg):
+        """Runs the retries waiting for the gerrit, if it's time."""
+        due = self.retries.due(
+            gerrit_cfg['name'], gerrit_cfg['client'].is_active())
+        if due:
+            logging.info(
+                'Retrying %d actions for %s' % (len(due), gerrit_cfg['name']))
+        for r in due:
+            self.run_action(r.action_cfg, r.event, r.source, r.attempts)
+            if self.journal is not None:
+                self.journal.release(r.event)
 
     def config_connection_is_equal(self, client, config_block):
         """
@@ -163,6 +317,21 @@ class Zoidberg(object):
 
                 self.config.close_clients()
             self.config = config
+            self.dispatcher.configure(config)
+            engine.get_engine().resize(config.engine.get(
+                'max-in-flight', engine.DEFAULT_MAX_IN_FLIGHT))
+            gitexec.get_executor().configure(config.git)
+            self.retries.configure(config.retry)
+            self.supervisor.configure(config)
+            self.startup.configure(config.startup_tasks)
+            replay = self.journal is None
+            if replay:
+                self.journal = self.open_journal(config)
+
+            for gerrit_name in config.gerrits:
+                self.setup_client(config.gerrits[gerrit_name])
+            if replay and self.journal is not None:
+                self.replay_journal()
         except Exception as e:
             logging.error(
                 'Could not load configuration file, '
@@ -170,6 +339,56 @@ class Zoidberg(object):
             if raise_exception:
                 raise e
 
+    def setup_client(self, gerrit_cfg):
+        """Hooks a new or reused client up to the loaded configuration."""
+        client = gerrit_cfg['client']
+        # the prefilters depend on the event and project config,
+        # so every client gets a fresh one for the new config
+        client.event_filter = EventPrefilter(gerrit_cfg)
+        client.events_ready = self.events_ready
+        client.journal = self.journal
+        client.gerrit_name = gerrit_cfg['name']
+        client.event_queue.name = gerrit_cfg['name']
+        client.event_queue.max_in_memory = gerrit_cfg['event-queue-size']
+        if gerrit_cfg['event-queue-spill-dir']:
+            client.event_queue.spill_dir = gerrit_cfg['event-queue-spill-dir']
+        client.configure_commands(
+            gerrit_cfg['command-concurrency'], gerrit_cfg['command-timeout'])
+        client.unknown_revisions.ttl = gerrit_cfg['unknown-revision-ttl']
+        client.unknown_revisions.max_size = gerrit_cfg[
+            'unknown-revision-cache-size']
+        client.query_cache.ttl = gerrit_cfg['query-cache-ttl']
+        client.query_cache.max_size = gerrit_cfg['query-cache-size']
+
+    def journal_path(self, config):
+        return config.journal.get('path')
+
+    def open_journal(self, config):
+        """Opens the event journal, if one is configured."""
+        path = self.journal_path(config)
+        if not path:
+            return None
+        logging.info('Journaling events to %s' % path)
+        return journal.EventJournal(
+            path,
+            sync_interval=config.journal.get(
+                'sync-interval-ms', journal.DEFAULT_SYNC_INTERVAL_MS) / 1000.0,
+            compact_after=config.journal.get(
+                'compact-after', journal.DEFAULT_COMPACT_AFTER))
+
+    def replay_journal(self):
+        """Queues the events that weren't done with last time."""
+        unfinished = self.journal.replay()
+        if unfinished:
+            logging.info('Replaying %d events' % len(unfinished))
+        for journal_id, gerrit_name, data in unfinished:
+            gerrit_cfg = self.config.gerrits.get(gerrit_name)
+            if gerrit_cfg is None:
+                # not configured any more
+                self.journal.done(journal_id)
+                continue
+            gerrit_cfg['client'].queue_event(data, journal_id=journal_id)
+
     def validate_config(self, config):
         # TODO: verify startup tasks here too
         for gerrit_name in config.gerrits:
@@ -180,29 +399,93 @@ class Zoidberg(object):
                     a().validate_config(config, action)
 
     def connect_client(self, gerrit_config):
-            # client connection details
-            username = gerrit_config.get('username')
-            host = gerrit_config.get('host')
-            key_filename = gerrit_config.get('key_filename')
-            name = gerrit_config.get('name')
-            port = gerrit_config.get('port', 29418)
-            client = gerrit_config.get('client')
-
-            try:
-                # activate the client's ssh and start streaming events
-                if not client.is_active():
-                    client.activate_ssh(
-                        hostname=host, username=username,
-                        key_filename=key_filename, port=port)
+        """
+        Connects the client and starts its event stream, if it isn't
+        already, and returns whether it's connected.
+
+        Only called from the supervisor's thread, so the startup tasks
+        or the backfill are queued exactly once for every connection.
+        """
+        # client connection details
+        username = gerrit_config.get('username')
+        host = gerrit_config.get('host')
+        key_filename = gerrit_config.get('key_filename')
+        name = gerrit_config.get('name')
+        port = gerrit_config.get('port', 29418)
+        client = gerrit_config.get('client')
+
+        try:
+            # activate the client's ssh and start streaming events
+            if not client.is_active():
+                since = client.last_event_created_on
+                # a backfill may make up events the stream sends too, so
+                # remember them from the start
+                client.dedupe_until = float('inf')
+                client.activate_ssh(
+                    hostname=host, username=username,
+                    key_filename=key_filename, port=port,
+                    timeout=gerrit_config['connect-timeout'])
+                if self.can_backfill(gerrit_config, since):
+                    # the stream is running, anything after this arrives
+                    # on it, give or take gerrit's clock
+                    until = time.time() + CLOCK_SLACK
+                    client.dedupe_until = until
+                    # catch up on what we missed while disconnected
+                    engine.get_engine().submit(
+                        self.backfill, gerrit_config, since, until)
+                else:
+                    client.dedupe_until = None
                     # queue any tasks that need to be run on connection
                     self.queue_startup_tasks(gerrit_config)
-            except socket.error, e:
-                # if there's a connection error, log it and we'll try later
-                # we can do this because get_client tries to connect
-                # if you get a client that is not connected
-                logging.error(
-                    'Could not connect to %s at %s (%s)'
-                    % (name, host, repr(e)))
+            return True
+        except socket.error, e:
+            # if there's a connection error, log it and the supervisor
+            # will try again later
+            logging.error(
+                'Could not connect to %s at %s (%s)'
+                % (name, host, repr(e)))
+            return False
+
+    def can_backfill(self, gerrit_config, since):
+        """
+        Can we catch up by querying for what we missed since the last
+        event, rather than running the startup tasks?
+        """
+        max_age = gerrit_config['backfill-max-age']
+        return bool(since and max_age and time.time() - since <= max_age)
+
+    def backfill(self, gerrit_config, since, until):
+        """
+        Queries for the changes updated since the last event we received,
+        and queues the events we missed up until we reconnected, oldest
+        first.
+
+        Falls back to the startup tasks if the query fails.
+        """
+        name = gerrit_config['name']
+        client = gerrit_config['client']
+        age = int(time.time() - since) + CLOCK_SLACK
+        logging.info('Backfilling the last %ds of events for %s' % (age, name))
+        try:
+            events = []
+            # '-age:' would be taken for an option by gerrit's query
+            for change in client.query(
+                    'NOT age:%ds' % age,
+                    options=['--patch-sets', '--comments']):
+                if gerrit_config['project_re'].match(change.project):
+                    events.extend(
+                        backfill.synthesize_events(change, since, until))
+        except Exception as e:
+            logging.error(
+                'Backfill for %s failed, running startup tasks: %s'
+                % (name, e))
+            self.queue_startup_tasks(gerrit_config)
+            return
+
+        events.sort(key=lambda e: e['eventCreatedOn'])
+        for event in events:
+            client.queue_event(json.dumps(event))
+        logging.info('Backfilled %d events for %s' % (len(events), name))
 
     def queue_startup_tasks(self, gerrit_config):
         if 'startup' in gerrit_config and gerrit_config['startup']:
@@ -214,6 +497,8 @@ class Zoidberg(object):
                 # so the task has access to everything when it's run
                 self.startup_tasks.put(
                     {'task': task, 'source': gerrit_config})
+            # don't leave the new tasks waiting for an event to turn up
+            self.events_ready.set()
 
     def process_event(self, event, gerrit_cfg):
         project = None
@@ -238,24 +523,53 @@ class Zoidberg(object):
         return self.config_mtime < os.stat(self.config_filename).st_mtime
 
     def get_client(self, gerrit_cfg):
-        client = gerrit_cfg.get('client')
-        if not client.is_active():
-            # this allows us to lazily connect clients, and reconnect if
-            # a gerrit goes down for whatever reason
-            logging.error(
-                'Client for %s was not active, trying to connect...'
-                % gerrit_cfg['name'])
-            self.connect_client(gerrit_cfg)
-        return client
-
-    def enqueue_failed_events(self, gerrit_cfg):
-        client = self.get_client(gerrit_cfg)
-        client.enqueue_failed_events()
+        # the supervisor does the connecting, events already queued on
+        # a client that has dropped can still be processed
+        return gerrit_cfg.get('client')
 
     def get_event(self, gerrit_cfg, timeout=1):
         client = self.get_client(gerrit_cfg)
         return client.get_event(timeout=timeout)
 
+    def log_stats(self):
+        gerrit_names = self.config.gerrits.keys()
+        gerrit_names.sort()
+        for gerrit_name in gerrit_names:
+            client = self.config.gerrits[gerrit_name]['client']
+            if client.event_filter is not None:
+                logging.info(
+                    'Prefilter stats for %s: %s'
+                    % (gerrit_name, client.event_filter.stats()))
+            logging.info(
+                'Event queue stats for %s: %s'
+                % (gerrit_name, client.event_queue.stats()))
+            logging.info(
+                'Command stats for %s: %s'
+                % (gerrit_name, client.command_stats()))
+            logging.info(
+                'Unknown revision cache for %s: %s'
+                % (gerrit_name, client.unknown_revisions.stats()))
+            logging.info(
+                'Query cache for %s: %s'
+                % (gerrit_name, client.query_cache.stats()))
+            logging.info(
+                'Duplicate events dropped for %s: %d'
+                % (gerrit_name, client.duplicates))
+        for gerrit_name, depths in sorted(self.dispatcher.stats().items()):
+            logging.info(
+                'Worker queue depths for %s: %s' % (gerrit_name, depths))
+        logging.info('Engine stats: %s' % engine.get_engine().stats())
+        logging.info(
+            'Git process stats: %s' % gitexec.get_executor().stats())
+        if self.journal is not None:
+            logging.info('Journal stats: %s' % self.journal.stats())
+        logging.info('Retry stats: %s' % self.retries.stats())
+        logging.info(
+            'Reconnect failures: %s' % self.supervisor.stats())
+        logging.info('Startup task stats: %s' % self.startup.stats())
+
     def handle_signal(self, signum, frame):
         if signum == signal.SIGTERM:
             self.running = False
+        elif signum == signal.SIGUSR1:
+            self.log_stats()